@@ -0,0 +1,3 @@
+from musicsync.benchmark.benchmark import main
+
+main()
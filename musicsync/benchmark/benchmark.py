@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import tracemalloc
+import multiprocessing
+import concurrent.futures
+
+import musicsync.core.sync_plan as sync_plan
+from musicsync.core.file_copiers import MSCFileCopier, ParallelMSCFileCopier
+from musicsync.core.adb_file_copiers import BatchADBFileCopier, TarADBFileCopier
+from musicsync.core.controller import Controller
+from musicsync.core.async_controller import AsyncController
+from musicsync.core.metadata_index import MetadataIndex
+from musicsync.core.conversion_policy import ConversionPolicy
+from musicsync.benchmark.synthetic_library import LibraryOptions, generate_library, change_songs
+from musicsync.benchmark.fake_adb import install_fake_adb, LATENCY_ENV_VAR, BANDWIDTH_ENV_VAR, FILE_LATENCY_ENV_VAR
+
+TRANSPORTS = ("msc", "adb", "adb-tar")
+ADB_TRANSPORTS = ("adb", "adb-tar")
+DEFAULT_TRANSPORTS = ("msc", "adb")
+ENGINES = ("sync", "async")
+FULL_SYNC = "full"
+INCREMENTAL_SYNC = "incremental"
+PLAN_RUN = "plan"
+DEFAULT_RESULTS_DIR_PATH = "benchmark_results"
+DEFAULT_CHANGED_RATIO = 0.05
+DEFAULT_ADB_LATENCY = 0.02 # Seconds
+MIB = 1024 ** 2
+PROJECTED_SONGS_COUNT = 1000000
+
+
+class BenchmarkOptions():
+    def __init__(self, transports=DEFAULT_TRANSPORTS, engine="sync", jobs=1, copy_threads=1, output_format=None, output_bitrate=None, use_sync_manifest=False, use_metadata_index=False, always_convert=False, changed_ratio=DEFAULT_CHANGED_RATIO, adb_latency=DEFAULT_ADB_LATENCY, adb_bandwidth=0, adb_file_latency=0):
+        self.transports = transports
+        self.engine = engine
+        self.jobs = jobs
+        self.copy_threads = copy_threads
+        self.output_format = output_format
+        self.output_bitrate = output_bitrate
+        self.use_sync_manifest = use_sync_manifest
+        self.use_metadata_index = use_metadata_index
+        self.always_convert = always_convert # Every song not in the output format is converted, as without the conversion policy
+        self.changed_ratio = changed_ratio # Songs whose tags are changed before the incremental sync
+        self.adb_latency = adb_latency
+        self.adb_bandwidth = adb_bandwidth
+        self.adb_file_latency = adb_file_latency
+
+
+# It generates the library in work_dir_path, then for every transport it runs a full sync into an empty destination
+# and an incremental sync after changing some songs, then it plans a sync of the unchanged library to measure the memory
+# used by the planning. Every run is made in a new process, so its peak RSS is its own.
+def run_benchmark(work_dir_path, library_options, benchmark_options):
+    library_dir_path = os.path.join(work_dir_path, "library")
+    songs_paths = generate_library(library_dir_path, library_options)
+    if any(transport in ADB_TRANSPORTS for transport in benchmark_options.transports):
+        _setup_fake_adb(os.path.join(work_dir_path, "bin"), benchmark_options)
+    results = []
+    for transport in benchmark_options.transports:
+        dest_dir_path = os.path.join(work_dir_path, "dest-" + transport)
+        os.makedirs(dest_dir_path)
+        metadata_index_path = os.path.join(work_dir_path, "metadata-index-{}.sqlite3".format(transport)) if benchmark_options.use_metadata_index else None
+        for sync_kind in (FULL_SYNC, INCREMENTAL_SYNC):
+            if sync_kind == INCREMENTAL_SYNC:
+                change_songs(songs_paths, benchmark_options.changed_ratio, library_options.seed)
+            results.append(_run_in_new_process(run_sync, library_dir_path, dest_dir_path, transport, sync_kind, benchmark_options, metadata_index_path))
+        results.append(_run_in_new_process(run_plan, library_dir_path, dest_dir_path, transport, benchmark_options, metadata_index_path))
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "library": vars(library_options),
+        "options": vars(benchmark_options),
+        "results": results,
+    }
+
+def _setup_fake_adb(bin_dir_path, benchmark_options):
+    install_fake_adb(bin_dir_path)
+    os.environ["PATH"] = bin_dir_path + os.pathsep + os.environ.get("PATH", "")
+    os.environ[LATENCY_ENV_VAR] = str(benchmark_options.adb_latency)
+    os.environ[BANDWIDTH_ENV_VAR] = str(benchmark_options.adb_bandwidth)
+    os.environ[FILE_LATENCY_ENV_VAR] = str(benchmark_options.adb_file_latency)
+
+def _run_in_new_process(function, *args):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+def run_sync(src, dest, transport, sync_kind, benchmark_options, metadata_index_path=None):
+    metadata_index = None
+    if metadata_index_path is not None:
+        metadata_index = MetadataIndex(metadata_index_path)
+    controller = _setup_controller(transport, benchmark_options, metadata_index)
+    start_time = time.perf_counter()
+    try:
+        controller.sync(src, dest)
+    finally:
+        if metadata_index is not None:
+            metadata_index.close()
+    elapsed_time = time.perf_counter() - start_time
+    transferred_files_count, transferred_bytes = _get_transferred_files(controller.sync_plan)
+    return _get_result(controller, controller.sync_plan, transport, sync_kind, elapsed_time, transferred_files_count, transferred_bytes)
+
+# The planning keeps a record of every song of the library (scanned file, metadata and plan item), so its memory grows
+# with the library. It is measured by tracemalloc while the plan is still referenced, and projected to a larger library
+# from the bytes used by every song, because a library of a million songs takes too long to generate.
+def run_plan(src, dest, transport, benchmark_options, metadata_index_path=None):
+    metadata_index = None
+    if metadata_index_path is not None:
+        metadata_index = MetadataIndex(metadata_index_path)
+    controller = _setup_controller(transport, benchmark_options, metadata_index)
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    try:
+        plan = controller.plan(src, dest)
+        elapsed_time = time.perf_counter() - start_time
+        traced_peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        if metadata_index is not None:
+            metadata_index.close()
+    result = _get_result(controller, plan, transport, PLAN_RUN, elapsed_time, 0, 0)
+    result["traced_peak_bytes"] = traced_peak_bytes
+    result["bytes_per_song"] = traced_peak_bytes / result["songs"] if result["songs"] else None
+    return result
+
+def _get_result(controller, plan, transport, kind, elapsed_time, transferred_files_count, transferred_bytes):
+    songs_count = sum(1 for plan_item in plan.items if plan_item.song_flag)
+    return {
+        "transport": transport,
+        "kind": kind,
+        "songs": songs_count,
+        "copied_songs": controller.copied_songs_count,
+        "updated_songs": controller.updated_songs_count,
+        "unchanged_songs": controller.unchanged_songs_count,
+        "transferred_files": transferred_files_count,
+        "transferred_bytes": transferred_bytes,
+        "seconds": elapsed_time,
+        "files_per_second": transferred_files_count / elapsed_time,
+        "songs_per_second": songs_count / elapsed_time,
+        "mib_per_second": transferred_bytes / MIB / elapsed_time,
+        "stages": controller.sync_stats.to_dict()["stages"],
+        "peak_rss_bytes": _get_peak_rss(),
+    }
+
+def _setup_controller(transport, benchmark_options, metadata_index):
+    if transport == "adb":
+        file_copier = BatchADBFileCopier()
+    elif transport == "adb-tar":
+        file_copier = TarADBFileCopier()
+    elif benchmark_options.engine == "async":
+        file_copier = MSCFileCopier()
+    else:
+        file_copier = ParallelMSCFileCopier(benchmark_options.copy_threads)
+    controller_kwargs = {
+        "output_format": benchmark_options.output_format,
+        "output_bitrate": benchmark_options.output_bitrate,
+        "metadata_index": metadata_index,
+        "use_sync_manifest": benchmark_options.use_sync_manifest,
+        "jobs": benchmark_options.jobs,
+    }
+    if benchmark_options.always_convert:
+        controller_kwargs["conversion_policy"] = ConversionPolicy(benchmark_options.output_format, benchmark_options.output_bitrate, skip_low_bitrates_flag=False)
+    if benchmark_options.engine == "async":
+        return AsyncController(file_copier, transfer_jobs=benchmark_options.copy_threads, **controller_kwargs)
+    return Controller(file_copier, **controller_kwargs)
+
+def _get_transferred_files(plan):
+    transferred_files_count = 0
+    transferred_bytes = 0
+    for plan_item in plan.get_work_items():
+        if plan_item.action != sync_plan.DELETE_ACTION and os.path.isfile(plan_item.path_dest):
+            transferred_files_count += 1
+            transferred_bytes += os.path.getsize(plan_item.path_dest)
+    return (transferred_files_count, transferred_bytes)
+
+# ru_maxrss is in KiB on Linux and in bytes on macOS, the resource module isn't available on Windows
+def _get_peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+def main():
+    parser = _setup_parser()
+    args = parser.parse_args()
+    try:
+        _validate_args(args)
+    except ValueError as exc:
+        parser.error(str(exc))
+        sys.exit(1)
+    library_options = LibraryOptions(args.songs, args.flac_ratio, args.lyrics_ratio, args.duration, seed=args.seed)
+    benchmark_options = BenchmarkOptions(args.transports, args.engine, args.jobs, args.copy_threads, args.output_format, args.output_bitrate, args.manifest, args.metadata_index, args.always_convert, args.changed_ratio, args.adb_latency, args.adb_bandwidth, args.adb_file_latency)
+    work_dir_path = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="musicsync-benchmark-")
+    try:
+        report = run_benchmark(work_dir_path, library_options, benchmark_options)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir_path, ignore_errors=True)
+    baseline_report = _read_report(args.baseline) if args.baseline is not None else None
+    _print_report(report, baseline_report)
+    report_path = _write_report(report, args.results_dir)
+    print("Results written to {}".format(report_path))
+
+def _setup_parser():
+    parser = argparse.ArgumentParser(description="Measure the speed of MusicSync on a synthetic music library")
+    library_group = parser.add_argument_group("synthetic library")
+    library_group.add_argument("-n", "--songs", metavar="<arg>", action="store", dest="songs", type=int, default=500, help="number of songs (default: 500)")
+    library_group.add_argument("-F", "--flac-ratio", metavar="<arg>", action="store", dest="flac_ratio", type=float, default=0.3, help="ratio of FLAC songs, the others are MP3 songs (default: 0.3)")
+    library_group.add_argument("-L", "--lyrics-ratio", metavar="<arg>", action="store", dest="lyrics_ratio", type=float, default=0.5, help="ratio of songs with a lyrics file (default: 0.5)")
+    library_group.add_argument("-D", "--duration", metavar="<arg>", action="store", dest="duration", type=float, default=30.0, help="duration of every song in seconds (default: 30)")
+    library_group.add_argument("-C", "--changed-ratio", metavar="<arg>", action="store", dest="changed_ratio", type=float, default=DEFAULT_CHANGED_RATIO, help=f"ratio of songs changed before the incremental sync (default: {DEFAULT_CHANGED_RATIO})")
+    library_group.add_argument("-S", "--seed", metavar="<arg>", action="store", dest="seed", type=int, default=0, help="seed of the random tags (default: 0)")
+    sync_group = parser.add_argument_group("sync")
+    sync_group.add_argument("-t", "--transports", metavar="<arg>", action="store", dest="transports", type=str, nargs="+", choices=TRANSPORTS, default=list(DEFAULT_TRANSPORTS), help="transfer protocols to measure, adb-tar is ADB with the tar streams (default: msc adb)")
+    sync_group.add_argument("-e", "--engine", metavar="<arg>", action="store", dest="engine", type=str, choices=ENGINES, default="sync", help="sync engine, sync or async (default: sync)")
+    sync_group.add_argument("-j", "--jobs", metavar="<arg>", action="store", dest="jobs", type=int, default=1, help="number of songs converted at the same time (default: 1)")
+    sync_group.add_argument("-p", "--copy-threads", metavar="<arg>", action="store", dest="copy_threads", type=int, default=1, help="number of files copied at the same time with MSC (default: 1)")
+    sync_group.add_argument("-f", "--output-format", metavar="<arg>", action="store", dest="output_format", type=str, help="audio format of the converted songs")
+    sync_group.add_argument("-b", "--output-bitrate", metavar="<arg>", action="store", dest="output_bitrate", type=str, help="audio bitrate of the converted songs")
+    sync_group.add_argument("-m", "--manifest", action="store_true", dest="manifest", help="use the sync manifest")
+    sync_group.add_argument("-A", "--always-convert", action="store_true", dest="always_convert", help="convert every song not in the output format, even if its bitrate isn't greater than the output one")
+    sync_group.add_argument("-x", "--metadata-index", action="store_true", dest="metadata_index", help="use a metadata index, built by the full sync")
+    adb_group = parser.add_argument_group("fake adb", "the adb commands are run on the local machine")
+    adb_group.add_argument("-l", "--adb-latency", metavar="<arg>", action="store", dest="adb_latency", type=float, default=DEFAULT_ADB_LATENCY, help=f"seconds waited by every adb call (default: {DEFAULT_ADB_LATENCY})")
+    adb_group.add_argument("-w", "--adb-bandwidth", metavar="<arg>", action="store", dest="adb_bandwidth", type=float, default=0, help="MiB per second of the pushed files, 0 means unlimited (default: 0)")
+    adb_group.add_argument("-i", "--adb-file-latency", metavar="<arg>", action="store", dest="adb_file_latency", type=float, default=0, help="seconds waited for every file pushed by adb push (default: 0)")
+    results_group = parser.add_argument_group("results")
+    results_group.add_argument("-o", "--results-dir", metavar="<arg>", action="store", dest="results_dir", type=str, default=DEFAULT_RESULTS_DIR_PATH, help=f"directory of the JSON results (default: {DEFAULT_RESULTS_DIR_PATH})")
+    results_group.add_argument("-c", "--baseline", metavar="<arg>", action="store", dest="baseline", type=str, help="JSON results of a previous run to compare with")
+    parser.add_argument("-d", "--work-dir", metavar="<arg>", action="store", dest="work_dir", type=str, help="directory of the library and of the destinations (default: a temporary directory)")
+    parser.add_argument("-k", "--keep", action="store_true", dest="keep", help="don't delete the work directory")
+    return parser
+
+def _validate_args(args):
+    if args.songs < 1:
+        raise ValueError("The number of songs must be at least 1.")
+    for ratio in (args.flac_ratio, args.lyrics_ratio, args.changed_ratio):
+        if ratio < 0 or ratio > 1:
+            raise ValueError("The ratios must be between 0 and 1.")
+    if args.duration <= 0:
+        raise ValueError("The duration must be greater than 0.")
+    if args.jobs < 1 or args.copy_threads < 1:
+        raise ValueError("The number of jobs and copy threads must be at least 1.")
+    if args.output_bitrate is not None and args.output_format is None:
+        raise ValueError("Output format required if output bitrate is selected.")
+    if any(transport in ADB_TRANSPORTS for transport in args.transports) and os.name == "nt":
+        raise ValueError("The fake adb needs a POSIX system.")
+    if args.work_dir is not None and os.path.exists(args.work_dir) and os.listdir(args.work_dir):
+        raise ValueError("The work directory must be empty.")
+    args.adb_bandwidth *= MIB
+
+def _read_report(path):
+    with open(path, "r", encoding="utf-8") as report_file:
+        return json.load(report_file)
+
+def _write_report(report, results_dir_path):
+    os.makedirs(results_dir_path, exist_ok=True)
+    report_path = os.path.join(results_dir_path, "benchmark-{}.json".format(report["date"].replace(":", "")))
+    with open(report_path, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2)
+    return report_path
+
+def _print_report(report, baseline_report=None):
+    baseline_results = {}
+    if baseline_report is not None:
+        baseline_results = {(result["transport"], result["kind"]): result for result in baseline_report["results"]}
+    print("{:<10} {:<12} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10} {:>9}".format("transport", "sync", "files", "MiB", "seconds", "files/s", "MiB/s", "peak MiB", "baseline"))
+    for result in report["results"]:
+        peak_rss = result["peak_rss_bytes"] / MIB if result["peak_rss_bytes"] is not None else float("nan")
+        baseline_result = baseline_results.get((result["transport"], result["kind"]))
+        speedup = "{:.2f}x".format(baseline_result["seconds"] / result["seconds"]) if baseline_result is not None else "-"
+        print("{:<10} {:<12} {:>7} {:>9.1f} {:>9.2f} {:>9.1f} {:>9.2f} {:>10.1f} {:>9}".format(result["transport"], result["kind"], result["transferred_files"], result["transferred_bytes"] / MIB, result["seconds"], result["files_per_second"], result["mib_per_second"], peak_rss, speedup))
+        stages = ", ".join("{} {:.2f} s".format(stage, stage_result["seconds"]) for stage, stage_result in result["stages"].items())
+        print("    stages: {}".format(stages))
+        if result.get("bytes_per_song") is not None:
+            print("    planning memory: {:.1f} MiB, {:.0f} bytes per song, about {:.0f} MiB for {} songs".format(result["traced_peak_bytes"] / MIB, result["bytes_per_song"], result["bytes_per_song"] * PROJECTED_SONGS_COUNT / MIB, PROJECTED_SONGS_COUNT))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import shutil
+import subprocess
+
+LATENCY_ENV_VAR = "MUSICSYNC_FAKE_ADB_LATENCY" # Seconds waited by every adb call, like the round trip to a real device
+BANDWIDTH_ENV_VAR = "MUSICSYNC_FAKE_ADB_BANDWIDTH" # Bytes per second of the pushed files and of the exec-in input, 0 means unlimited
+FILE_LATENCY_ENV_VAR = "MUSICSYNC_FAKE_ADB_FILE_LATENCY" # Seconds waited for every pushed file, like the round trips of the adb sync protocol
+STREAM_CHUNK_SIZE = 64 * 1024
+DEVICE_SHELL = "bash" # It understands the $'...' literals like the shell of the Android devices
+
+
+# It is a stand-in for adb that runs the commands of the file copiers on the local machine, so the destination paths
+# are local paths. It is installed on the PATH by the benchmark, see install_fake_adb.
+def main():
+    args = sys.argv[1:]
+    time.sleep(float(os.environ.get(LATENCY_ENV_VAR, "0")))
+    if args[:1] == ["-s"]:
+        args = args[2:] # Every serial selects the local machine
+    if not args:
+        sys.exit(1)
+    command = args[0]
+    if command in ("start-server", "kill-server"):
+        sys.exit(0)
+    elif command in ("shell", "exec-out"):
+        sys.exit(subprocess.call([DEVICE_SHELL, "-c", " ".join(args[1:])]))
+    elif command == "exec-in":
+        sys.exit(_exec_in(" ".join(args[1:])))
+    elif command == "push":
+        _push(args[1:-1], args[-1])
+        sys.exit(0)
+    print("adb: unknown command {}".format(command), file=sys.stderr)
+    sys.exit(1)
+
+def _push(src_paths, dest_path):
+    bandwidth = float(os.environ.get(BANDWIDTH_ENV_VAR, "0"))
+    file_latency = float(os.environ.get(FILE_LATENCY_ENV_VAR, "0"))
+    for src_path in src_paths:
+        time.sleep(file_latency)
+        if dest_path.endswith("/") or len(src_paths) > 1:
+            file_dest_path = os.path.join(dest_path, os.path.basename(src_path))
+        else:
+            file_dest_path = dest_path
+        shutil.copyfile(src_path, file_dest_path)
+        if bandwidth > 0:
+            time.sleep(os.path.getsize(src_path) / bandwidth)
+    print("{} files pushed.".format(len(src_paths)))
+
+# The standard input is sent to the command at the bandwidth of the pushes
+def _exec_in(command):
+    bandwidth = float(os.environ.get(BANDWIDTH_ENV_VAR, "0"))
+    if bandwidth <= 0:
+        return subprocess.call([DEVICE_SHELL, "-c", command])
+    process = subprocess.Popen([DEVICE_SHELL, "-c", command], stdin=subprocess.PIPE)
+    try:
+        for chunk in iter(lambda: sys.stdin.buffer.read(STREAM_CHUNK_SIZE), b""):
+            process.stdin.write(chunk)
+            time.sleep(len(chunk) / bandwidth)
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    return process.wait()
+
+# It creates an adb executable in bin_dir_path, which must be added at the beginning of the PATH
+def install_fake_adb(bin_dir_path):
+    os.makedirs(bin_dir_path, exist_ok=True)
+    adb_path = os.path.join(bin_dir_path, "adb")
+    package_parent_dir_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    with open(adb_path, "w", encoding="utf-8") as adb_file:
+        adb_file.write("#!{}\n".format(sys.executable))
+        adb_file.write("import sys\n")
+        adb_file.write("sys.path.insert(0, {!r})\n".format(package_parent_dir_path))
+        adb_file.write("from musicsync.benchmark.fake_adb import main\n")
+        adb_file.write("main()\n")
+    os.chmod(adb_path, 0o755)
+    return adb_path
+
+if __name__ == "__main__":
+    main()
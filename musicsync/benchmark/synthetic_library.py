@@ -0,0 +1,195 @@
+import os
+import time
+import random
+import struct
+
+import mutagen.id3
+import mutagen.flac
+
+SAMPLE_RATE = 44100
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x64" # MPEG-1 Layer III, 128 kbps, 44100 Hz, joint stereo, no CRC
+MP3_FRAME_SIZE = 417 # 144 * 128000 / 44100 bytes
+MP3_FRAME_SAMPLES = 1152
+FLAC_BLOCK_SIZE = 4096
+FLAC_BITRATE = 900000 # The silent FLAC frames are very small, the files are filled up to the size of a real song
+FLAC_MAX_BLOCK_SIZE = 2 ** 24 - 1 # The size of a metadata block has 24 bits
+FLAC_APPLICATION_ID = b"MSYN"
+FLAC_TAGS_PADDING = 8192 # Space for the tags, which are written later
+POPM_EMAIL = "Windows Media Player 9 Series"
+CHANGED_SONGS_MTIME_DELAY = 10 * 10 ** 9 # Nanoseconds added to the modification time of a changed song
+
+GENRES = ("Rock", "Pop", "Jazz", "Classical", "Electronic", "Hip Hop", "Folk", "Metal", "Blues", "Soundtrack")
+ARTIST_WORDS = ("The", "Blue", "Night", "Echo", "Silver", "River", "Ghost", "Velvet", "Static", "Paper", "Björk", "Sigur")
+
+
+class LibraryOptions():
+    def __init__(self, songs_count=500, flac_ratio=0.3, lyrics_ratio=0.5, duration=30.0, artists_count=50, albums_per_artist=3, seed=0):
+        self.songs_count = songs_count
+        self.flac_ratio = flac_ratio
+        self.lyrics_ratio = lyrics_ratio
+        self.duration = duration # Seconds of silence of every song
+        self.artists_count = artists_count
+        self.albums_per_artist = albums_per_artist
+        self.seed = seed
+
+
+# It creates a library of valid silent MP3 and FLAC songs with the tags read by songs_metadata (POPM and rating
+# included) and some lyrics files, in an Artist/Album/Song tree. The same options always create the same library.
+def generate_library(dir_path, options):
+    rng = random.Random(options.seed)
+    artists = [_get_artist_name(rng, index) for index in range(options.artists_count)]
+    mp3_audio = _get_mp3_audio(options.duration) if options.flac_ratio < 1 else None
+    flac_audio = _get_flac_audio(options.duration) if options.flac_ratio > 0 else None
+    songs_paths = []
+    for index in range(options.songs_count):
+        artist = artists[index % len(artists)]
+        album_dir_path = os.path.join(dir_path, artist, "Album {}".format(index // len(artists) % options.albums_per_artist + 1))
+        os.makedirs(album_dir_path, exist_ok=True)
+        extension = ".flac" if rng.random() < options.flac_ratio else ".mp3"
+        song_path = os.path.join(album_dir_path, "{:05d} Song{}".format(index, extension))
+        tags = _get_random_tags(rng, artist, index)
+        if extension == ".flac":
+            _write_flac_song(song_path, flac_audio, tags)
+        else:
+            _write_mp3_song(song_path, mp3_audio, tags)
+        if rng.random() < options.lyrics_ratio:
+            _write_lyrics(os.path.splitext(song_path)[0] + ".lrc", tags["title"], options.duration)
+        songs_paths.append(song_path)
+    return songs_paths
+
+# The tags of the songs are rewritten in their padding, like a tags editor does, so their size doesn't change and only
+# their modification time does. A tags editor runs long after the last sync, while the benchmark changes the songs
+# right after it, so the modification time is moved a few seconds later than the copies made by the sync. Without the
+# sync manifest, the changed songs are found only through the modification time of the destination files.
+def change_songs(songs_paths, ratio, seed=0):
+    rng = random.Random(seed)
+    changed_songs_paths = [song_path for song_path in songs_paths if rng.random() < ratio]
+    for song_path in changed_songs_paths:
+        mtime_ns = os.stat(song_path).st_mtime_ns
+        if song_path.endswith(".flac"):
+            song = mutagen.flac.FLAC(song_path)
+            song["comment"] = "Changed {}".format(rng.random())
+            song.save(padding=_keep_padding)
+        else:
+            id3 = mutagen.id3.ID3(song_path)
+            id3.add(mutagen.id3.COMM(encoding=3, lang="eng", desc="", text="Changed {}".format(rng.random())))
+            id3.save(song_path)
+        new_mtime_ns = max(time.time_ns(), mtime_ns) + CHANGED_SONGS_MTIME_DELAY
+        os.utime(song_path, ns=(new_mtime_ns, new_mtime_ns))
+    return changed_songs_paths
+
+def _get_artist_name(rng, index):
+    return "{} {} {}".format(rng.choice(ARTIST_WORDS), rng.choice(ARTIST_WORDS), index)
+
+def _get_random_tags(rng, artist, index):
+    genres = rng.sample(GENRES, rng.choice((1, 1, 1, 2)))
+    return {
+        "title": "Song {}".format(index),
+        "artist": artist,
+        "genre": genres,
+        "year": rng.randint(1960, 2024),
+        "rating": rng.choice((None, 1, 2, 3, 4, 5)), # Stars
+    }
+
+def _get_mp3_audio(duration):
+    frames_count = int(duration * SAMPLE_RATE / MP3_FRAME_SAMPLES)
+    return (MP3_FRAME_HEADER + bytes(MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))) * frames_count
+
+def _write_mp3_song(song_path, audio, tags):
+    with open(song_path, "wb") as song_file:
+        song_file.write(audio)
+    id3 = mutagen.id3.ID3()
+    id3.add(mutagen.id3.TIT2(encoding=3, text=tags["title"]))
+    id3.add(mutagen.id3.TPE1(encoding=3, text=tags["artist"]))
+    id3.add(mutagen.id3.TCON(encoding=3, text=tags["genre"]))
+    id3.add(mutagen.id3.TDRC(encoding=3, text=str(tags["year"])))
+    if tags["rating"] is not None:
+        id3.add(mutagen.id3.POPM(email=POPM_EMAIL, rating=tags["rating"] * 51, count=0))
+    id3.save(song_path)
+
+def _get_flac_audio(duration):
+    frames_count = max(1, int(duration * SAMPLE_RATE / FLAC_BLOCK_SIZE))
+    frames = b"".join(_get_flac_silent_frame(frame_number) for frame_number in range(frames_count))
+    streaminfo = _get_flac_streaminfo(frames_count * FLAC_BLOCK_SIZE)
+    filler_size = max(0, int(duration * FLAC_BITRATE / 8) - len(frames) - FLAC_TAGS_PADDING)
+    return b"fLaC" + _get_flac_metadata_block_header(0, False, len(streaminfo)) + streaminfo + _get_flac_filler_blocks(filler_size) + _get_flac_padding_block(FLAC_TAGS_PADDING) + frames
+
+def _get_flac_streaminfo(total_samples):
+    bits_per_sample, channels = 16, 2
+    packed = (SAMPLE_RATE << 44) | ((channels - 1) << 41) | ((bits_per_sample - 1) << 36) | total_samples
+    return struct.pack(">HH", FLAC_BLOCK_SIZE, FLAC_BLOCK_SIZE) + bytes(6) + packed.to_bytes(8, "big") + bytes(16)
+
+def _get_flac_metadata_block_header(block_type, last_flag, size):
+    return bytes(((0x80 if last_flag else 0) | block_type,)) + size.to_bytes(3, "big")
+
+# mutagen merges the padding blocks into a single one when it writes the tags, and a block can't be bigger than
+# FLAC_MAX_BLOCK_SIZE, so the filler is made of APPLICATION blocks, which are kept as they are
+def _get_flac_filler_blocks(size):
+    blocks = []
+    while size > 0:
+        block_size = min(size, FLAC_MAX_BLOCK_SIZE)
+        blocks.append(_get_flac_metadata_block_header(2, False, block_size) + FLAC_APPLICATION_ID + bytes(block_size - len(FLAC_APPLICATION_ID)))
+        size -= block_size
+    return b"".join(blocks)
+
+# The padding block is the last metadata block, it is kept when the tags are written
+def _get_flac_padding_block(size):
+    return _get_flac_metadata_block_header(1, True, size) + bytes(size)
+
+# Every frame contains a CONSTANT subframe of zero samples for both channels
+def _get_flac_silent_frame(frame_number):
+    # Fixed block size, 4096 samples, 44100 Hz, 2 independent channels, 16 bits per sample
+    header = b"\xff\xf8\xc9\x18" + _encode_flac_utf8(frame_number)
+    header += bytes((_get_crc8(header),))
+    frame = header + b"\x00\x00\x00" * 2
+    return frame + _get_crc16(frame).to_bytes(2, "big")
+
+def _encode_flac_utf8(value):
+    if value < 0x80:
+        return bytes((value,))
+    bytes_count = 2
+    while value >= 1 << (5 * bytes_count + 1):
+        bytes_count += 1
+    encoded = []
+    for _ in range(bytes_count - 1):
+        encoded.insert(0, 0x80 | (value & 0x3f))
+        value >>= 6
+    encoded.insert(0, ((0xff00 >> bytes_count) & 0xff) | value)
+    return bytes(encoded)
+
+def _get_crc8(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+    return crc
+
+def _get_crc16(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x8005) & 0xffff if crc & 0x8000 else (crc << 1) & 0xffff
+    return crc
+
+def _write_flac_song(song_path, audio, tags):
+    with open(song_path, "wb") as song_file:
+        song_file.write(audio)
+    song = mutagen.flac.FLAC(song_path)
+    song["title"] = tags["title"]
+    song["artist"] = tags["artist"]
+    song["genre"] = tags["genre"]
+    song["date"] = str(tags["year"])
+    if tags["rating"] is not None:
+        song["rating"] = str(tags["rating"] * 20)
+    song.save(padding=_keep_padding)
+
+def _keep_padding(padding_info):
+    return padding_info.padding
+
+def _write_lyrics(lyrics_path, title, duration):
+    with open(lyrics_path, "w", encoding="utf-8") as lyrics_file:
+        lyrics_file.write("[ti:{}]\n".format(title))
+        for second in range(0, int(duration), 5):
+            lyrics_file.write("[{:02d}:{:02d}.00]La la la\n".format(second // 60, second % 60))
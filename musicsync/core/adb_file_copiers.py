@@ -0,0 +1,417 @@
+import os
+import time
+import shutil
+import tarfile
+import tempfile
+import threading
+import subprocess
+import posixpath
+
+import musicsync.core.file_copiers as file_copiers
+import musicsync.core.sync_stats as sync_stats
+
+ADB_MAX_COMMAND_LENGTH = 8192 # Some adb versions don't accept longer commands
+ADB_PUSH_BATCH_SIZE = 200 # Number of files that are stored locally before pushing them all together
+PARTIAL_DIR_NAME = ".musicsync-part" # Directory where BatchADBFileCopier pushes the files before moving them all together
+TAR_BATCH_SECONDS = 10.0 # Time that the stream of a batch should take, the longer it is, the more an interrupted sync has to copy again
+TAR_MIN_BATCH_BYTES = 8 * 1024 ** 2
+TAR_MAX_BATCH_BYTES = 1024 ** 3
+TAR_BATCH_SIZE = 5000 # Number of files of a tar batch, its bytes are limited by the measured throughput
+
+
+class ADBFileCopier(file_copiers.FileCopier):
+    # The serial selects the device when several ones are connected
+    def __init__(self, serial=None):
+        self.serial = serial
+        self._adb_args = ["adb"] if serial is None else ["adb", "-s", serial]
+        self._running_processes = set() # The adb processes stopped by cancel
+        self._processes_lock = threading.Lock()
+        self._cancelled_flag = False
+        self._connect_adb_server()
+
+    def __del__(self):
+        self._disconnect_adb_server()
+
+    def prepare(self, dest_dir_path):
+        self._cancelled_flag = False
+
+    # The partial files left by the killed pushes are replaced by the next sync
+    def cancel(self):
+        with self._processes_lock:
+            self._cancelled_flag = True
+            for process in self._running_processes:
+                process.kill()
+
+    def exists(self, dest_file_path):
+        if os.name == "nt":
+            dest_file_path = self._convert_windows_path_to_unix_path(dest_file_path)
+        return self._adb_does_path_exist(dest_file_path)
+
+    def transfer(self, copy_file_function, dest_file_path):
+        if os.name == "nt":
+            dest_file_path = self._convert_windows_path_to_unix_path(dest_file_path)
+        dest_dir_path = os.path.dirname(dest_file_path)
+        self._create_directory_if_necessary(dest_dir_path)
+        with self._measure(sync_stats.TRANSFER_STAGE):
+            src_file_path = file_copiers.get_src_file_path(copy_file_function)
+            if src_file_path is not None:
+                self._push_file(src_file_path, dest_file_path)
+                self._add_transferred_bytes(os.path.getsize(src_file_path))
+            elif file_copiers.get_stream_function(copy_file_function) is not None:
+                self._stream_file(file_copiers.get_stream_function(copy_file_function), dest_file_path) # The size of the streamed song isn't known
+            else:
+                self._push_file_through_temporary_file(copy_file_function, dest_file_path)
+
+    def _push_file_through_temporary_file(self, copy_file_function, dest_file_path):
+        # See https://stackoverflow.com/questions/23212435 to understand why temporary_file is deleted manually in the following 4 lines of code
+        with tempfile.NamedTemporaryFile(delete=False) as temporary_file:
+            copy_file_function(temporary_file.name)
+        self._push_file(temporary_file.name, dest_file_path)
+        self._add_transferred_bytes(os.path.getsize(temporary_file.name))
+        os.unlink(temporary_file.name) 
+
+    # The file is written to the device while it is generated, without storing it locally. The directory is created by
+    # the same shell, so the copiers that don't create it one by one can stream the file too.
+    def _stream_file(self, stream_function, dest_file_path):
+        literal_dir_path = "${}".format(self._convert_string_to_literal(posixpath.dirname(dest_file_path)))
+        literal_path = "${}".format(self._convert_string_to_literal(dest_file_path))
+        literal_partial_path = "${}".format(self._convert_string_to_literal(dest_file_path + file_copiers.PARTIAL_FILE_SUFFIX))
+        try:
+            stream_function(self._adb_args + ["exec-in", "mkdir -p {0} && cat > {1} && mv -f {1} {2}".format(literal_dir_path, literal_partial_path, literal_path)])
+        except OSError as exc:
+            self._remove_file(literal_partial_path)
+            raise file_copiers.FileCopierError(str(exc))
+        except BaseException:
+            self._remove_file(literal_partial_path)
+            raise
+
+    def _remove_file(self, literal_path):
+        subprocess.run(self._adb_args + ["shell", "rm", "-f", literal_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def read_file(self, dest_file_path):
+        if os.name == "nt":
+            dest_file_path = self._convert_windows_path_to_unix_path(dest_file_path)
+        literal_path = "${}".format(self._convert_string_to_literal(dest_file_path))
+        data = self._get_subprocess_call_stdout(self._adb_args + ["exec-out", "test -f {0} && cat {0}".format(literal_path)])
+        if len(data) == 0:
+            return None
+        return data
+
+    def write_file(self, data, dest_file_path):
+        if os.name == "nt":
+            dest_file_path = self._convert_windows_path_to_unix_path(dest_file_path)
+        self._create_directory_if_necessary(os.path.dirname(dest_file_path))
+        with tempfile.NamedTemporaryFile(delete=False) as temporary_file:
+            temporary_file.write(data)
+        self._push_file(temporary_file.name, dest_file_path)
+        os.unlink(temporary_file.name)
+
+    def list_files(self, dest_dir_path):
+        if os.name == "nt":
+            dest_dir_path = self._convert_windows_path_to_unix_path(dest_dir_path)
+        stdout_str = self._get_subprocess_call_stdout(self._adb_args + ["shell", "find", "${}".format(self._convert_string_to_literal(dest_dir_path)), "-type", "f", "-exec", "stat", "-c", "'%s %Y %n'", "{}", "+"])
+        files_stats = {}
+        for line in stdout_str.decode("utf-8", "surrogateescape").splitlines():
+            size, _, line_rest = line.partition(" ")
+            mtime, _, file_path = line_rest.partition(" ")
+            if size.isdigit() and mtime.isdigit():
+                files_stats[file_path] = (int(size), int(mtime) * 10 ** 9) # stat prints the modification time in seconds
+        return files_stats
+
+    def remove_files(self, dest_file_paths):
+        if os.name == "nt":
+            dest_file_paths = [self._convert_windows_path_to_unix_path(dest_file_path) for dest_file_path in dest_file_paths]
+        literal_paths = ["${}".format(self._convert_string_to_literal(dest_file_path)) for dest_file_path in dest_file_paths]
+        for literal_paths_chunk in self._split_args(literal_paths, len("rm -f")):
+            self._run_adb_command(self._adb_args + ["shell", "rm", "-f"] + literal_paths_chunk)
+
+    def _convert_windows_path_to_unix_path(self, windows_path):
+        return windows_path.replace("\\","/")
+
+    def _connect_adb_server(self):
+        subprocess.run(self._adb_args + ["start-server"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _disconnect_adb_server(self):
+        subprocess.run(self._adb_args + ["kill-server"], stdout=subprocess.DEVNULL)
+
+    def _adb_does_path_exist(self, path):
+        return self._get_subprocess_call_stdout_size(self._adb_args + ["shell", "find", "${}".format(self._convert_string_to_literal(path))]) != 0
+
+    def _convert_string_to_literal(self, string):
+        return "'{}'".format(string.replace("'","\\'"))
+
+    def _get_subprocess_call_stdout_size(self, args):
+        return len(self._get_subprocess_call_stdout(args))
+
+    def _get_subprocess_call_stdout(self, args):
+        popen = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout_str, stderr_str = popen.communicate()
+        self._verify_device_connection(stderr_str)
+        return stdout_str
+
+    def _create_directory_if_necessary(self, dir_path):
+        with self._measure(sync_stats.MKDIR_STAGE):
+            subprocess.run(self._adb_args + ["shell", "mkdir", "-p", "${}".format(self._convert_string_to_literal(dir_path))], stdout=subprocess.DEVNULL)
+
+    def _push_file(self, src_file_path, dest_file_path):
+        partial_file_path = dest_file_path + file_copiers.PARTIAL_FILE_SUFFIX
+        self._run_cancellable_process(self._adb_args + ["push", src_file_path, partial_file_path])
+        subprocess.run(self._adb_args + ["shell", "mv", "-f", "${}".format(self._convert_string_to_literal(partial_file_path)), "${}".format(self._convert_string_to_literal(dest_file_path))], stdout=subprocess.DEVNULL)
+
+    def _split_args(self, args, fixed_length):
+        chunk = []
+        chunk_length = fixed_length
+        for arg in args:
+            if chunk and chunk_length + len(arg) + 1 > ADB_MAX_COMMAND_LENGTH:
+                yield chunk
+                chunk = []
+                chunk_length = fixed_length
+            chunk.append(arg)
+            chunk_length += len(arg) + 1
+        if chunk:
+            yield chunk
+
+    def _run_adb_command(self, args):
+        returncode, stderr_str = self._run_cancellable_process(args)
+        self._verify_device_connection(stderr_str)
+        if returncode != 0:
+            raise file_copiers.FileCopierError("adb failed: {}".format(stderr_str.decode("utf-8", "replace").strip()))
+
+    # It returns the exit code and the standard error of the process, which is killed by cancel
+    def _run_cancellable_process(self, args):
+        process = self._start_cancellable_process(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            _, stderr_str = process.communicate()
+        finally:
+            self._end_cancellable_process(process)
+        return (process.returncode, stderr_str)
+
+    def _start_cancellable_process(self, args, **popen_kwargs):
+        with self._processes_lock:
+            self._raise_if_cancelled()
+            process = subprocess.Popen(args, **popen_kwargs)
+            self._running_processes.add(process)
+        return process
+
+    # It is called after the process has exited
+    def _end_cancellable_process(self, process):
+        with self._processes_lock:
+            self._running_processes.discard(process)
+            self._raise_if_cancelled()
+
+    def _raise_if_cancelled(self):
+        if self._cancelled_flag:
+            raise file_copiers.FileCopierError("The transfer has been cancelled.")
+
+    def _verify_device_connection(self, stderr_str):
+        if ((b"no devices/emulators found" in stderr_str) or (b"device unauthorized" in stderr_str)):
+            raise file_copiers.FileCopierError("The device is not connected correctly.")
+
+
+# It lists the destination directory tree at most once and pushes the files in batches, so adb is called
+# only a few times for every batch instead of three times for every file. Every batch is pushed to a partial
+# directory inside every destination directory, and then moved to the destination directories all together.
+# The songs converted while they are written are streamed to the device at once instead, so they are never
+# written to the local disk.
+class BatchADBFileCopier(ADBFileCopier):
+    concurrent_transfers_flag = False
+    deferred_transfers_flag = True
+
+    def __init__(self, batch_size=ADB_PUSH_BATCH_SIZE, serial=None):
+        super().__init__(serial)
+        self._batch_size = batch_size
+        self._dest_dir_path = None
+        self._existing_paths = None
+        self._temporary_dir_path = None
+        self._local_dirs = {} # Destination directory path -> local directory containing the copies of the files to push there
+        self._pending_files = {} # Destination directory path -> local paths of the files to push there
+        self._pending_files_count = 0
+
+    def prepare(self, dest_dir_path):
+        super().prepare(dest_dir_path)
+        self._dest_dir_path = self._normalize_path(dest_dir_path)
+        self._existing_paths = None
+
+    def exists(self, dest_file_path):
+        dest_file_path = self._normalize_path(dest_file_path)
+        if self._dest_dir_path is None:
+            return self._adb_does_path_exist(dest_file_path)
+        if self._existing_paths is None: # The destination is listed only if it is necessary
+            self._existing_paths = set(posixpath.normpath(file_path) for file_path in self.list_files(self._dest_dir_path))
+        return dest_file_path in self._existing_paths
+
+    def transfer(self, copy_file_function, dest_file_path):
+        dest_file_path = self._normalize_path(dest_file_path)
+        stream_function = file_copiers.get_stream_function(copy_file_function)
+        if stream_function is not None:
+            with self._measure(sync_stats.TRANSFER_STAGE): # The size of the streamed song isn't known
+                self._stream_file(stream_function, dest_file_path)
+            if self._existing_paths is not None:
+                self._existing_paths.add(dest_file_path)
+            return
+        self._queue_file(copy_file_function, dest_file_path)
+        if self._is_batch_full():
+            self.flush()
+
+    def _is_batch_full(self):
+        return self._pending_files_count >= self._batch_size
+
+    def _normalize_path(self, path):
+        if os.name == "nt":
+            path = self._convert_windows_path_to_unix_path(path)
+        return posixpath.normpath(path)
+
+    # adb push keeps the source filename, so a source file is pushed directly only if it has the same filename of the destination
+    # one, otherwise it is copied into a local directory with the right filename
+    def _queue_file(self, copy_file_function, dest_file_path):
+        dest_dir_path, filename = posixpath.split(dest_file_path)
+        with self._measure(sync_stats.TRANSFER_STAGE, 0): # The files are counted when they are pushed
+            local_file_path = file_copiers.get_src_file_path(copy_file_function)
+            if local_file_path is None or os.path.basename(local_file_path) != filename:
+                local_file_path = os.path.join(self._get_local_dir_path(dest_dir_path), filename)
+                copy_file_function(local_file_path)
+        self._pending_files.setdefault(dest_dir_path, []).append(local_file_path)
+        self._pending_files_count += 1
+        if self._existing_paths is not None:
+            self._existing_paths.add(dest_file_path)
+
+    def _get_local_dir_path(self, dest_dir_path):
+        if self._temporary_dir_path is None:
+            self._temporary_dir_path = tempfile.mkdtemp()
+        if dest_dir_path not in self._local_dirs:
+            local_dir_path = os.path.join(self._temporary_dir_path, str(len(self._local_dirs)))
+            os.mkdir(local_dir_path)
+            self._local_dirs[dest_dir_path] = local_dir_path
+        return self._local_dirs[dest_dir_path]
+
+    def flush(self):
+        if self._pending_files_count == 0:
+            return
+        partial_dir_paths = [posixpath.join(dest_dir_path, PARTIAL_DIR_NAME) for dest_dir_path in self._pending_files]
+        try:
+            with self._measure(sync_stats.MKDIR_STAGE, len(partial_dir_paths)):
+                self._remove_directories(partial_dir_paths) # They can contain the files of an interrupted sync
+                self._create_directories(partial_dir_paths)
+            with self._measure(sync_stats.TRANSFER_STAGE, self._pending_files_count):
+                self._push_pending_files()
+                self._move_pushed_files()
+                self._remove_directories(partial_dir_paths)
+            self._add_transferred_bytes(sum(os.path.getsize(local_file_path) for local_file_paths in self._pending_files.values() for local_file_path in local_file_paths))
+        finally:
+            if self._temporary_dir_path is not None:
+                shutil.rmtree(self._temporary_dir_path, ignore_errors=True)
+            self._temporary_dir_path = None
+            self._local_dirs = {}
+            self._pending_files = {}
+            self._pending_files_count = 0
+
+    def _push_pending_files(self):
+        for dest_dir_path, local_file_paths in self._pending_files.items():
+            self._push_files(local_file_paths, posixpath.join(dest_dir_path, PARTIAL_DIR_NAME))
+
+    def _create_directories(self, dir_paths):
+        literal_paths = ["${}".format(self._convert_string_to_literal(dir_path)) for dir_path in dir_paths]
+        for literal_paths_chunk in self._split_args(literal_paths, len("mkdir -p")):
+            self._run_adb_command(self._adb_args + ["shell", "mkdir", "-p"] + literal_paths_chunk)
+
+    def _remove_directories(self, dir_paths):
+        literal_paths = ["${}".format(self._convert_string_to_literal(dir_path)) for dir_path in dir_paths]
+        for literal_paths_chunk in self._split_args(literal_paths, len("rm -rf")):
+            self._run_adb_command(self._adb_args + ["shell", "rm", "-rf"] + literal_paths_chunk)
+
+    # The mv commands of several directories are run by the same shell
+    def _move_pushed_files(self):
+        commands = []
+        for dest_dir_path, local_file_paths in self._pending_files.items():
+            partial_dir_path = posixpath.join(dest_dir_path, PARTIAL_DIR_NAME)
+            literal_dest_dir_path = "${}/".format(self._convert_string_to_literal(dest_dir_path))
+            literal_paths = ["${}".format(self._convert_string_to_literal(posixpath.join(partial_dir_path, os.path.basename(local_file_path)))) for local_file_path in local_file_paths]
+            for literal_paths_chunk in self._split_args(literal_paths, len("mv -f  && ") + len(literal_dest_dir_path)):
+                commands.append("mv -f {} {}".format(" ".join(literal_paths_chunk), literal_dest_dir_path))
+        for commands_chunk in self._split_args(commands, len(" && ")):
+            self._run_adb_command(self._adb_args + ["shell", " && ".join(commands_chunk)])
+
+    def _push_files(self, src_file_paths, dest_dir_path):
+        for src_file_paths_chunk in self._split_args(src_file_paths, len(" ".join(self._adb_args)) + len(" push ") + len(dest_dir_path)):
+            self._run_adb_command(self._adb_args + ["push"] + src_file_paths_chunk + [dest_dir_path + "/"])
+
+
+# adb push has a round trip for every file, so a batch of small files (e.g. the lyrics) uses only a fraction of the USB
+# bandwidth. This copier writes every batch as a tar stream, generated while it is sent, to the standard input of a
+# single tar extraction on the device, which writes the files to the same partial directories of BatchADBFileCopier.
+# The bytes of a batch follow the measured throughput, so every batch takes about TAR_BATCH_SECONDS. The devices
+# without tar (before Android 6) get the batches through adb push.
+class TarADBFileCopier(BatchADBFileCopier):
+    def __init__(self, batch_size=TAR_BATCH_SIZE, serial=None):
+        super().__init__(batch_size, serial)
+        self._batch_bytes = TAR_MIN_BATCH_BYTES
+        self._pending_bytes = 0
+        self._tar_supported_flag = None # The device is checked before the first batch
+
+    def _is_batch_full(self):
+        return super()._is_batch_full() or self._pending_bytes >= self._batch_bytes
+
+    def _queue_file(self, copy_file_function, dest_file_path):
+        super()._queue_file(copy_file_function, dest_file_path)
+        self._pending_bytes += os.path.getsize(self._pending_files[posixpath.dirname(dest_file_path)][-1])
+
+    def flush(self):
+        try:
+            super().flush()
+        finally:
+            self._pending_bytes = 0
+
+    def _push_pending_files(self):
+        if self._dest_dir_path is None or not self._is_tar_supported():
+            super()._push_pending_files()
+            return
+        start_time = time.perf_counter()
+        self._stream_tar()
+        elapsed_seconds = time.perf_counter() - start_time
+        if self._pending_bytes > 0 and elapsed_seconds > 0:
+            self._batch_bytes = min(max(self._pending_bytes / elapsed_seconds * TAR_BATCH_SECONDS, TAR_MIN_BATCH_BYTES), TAR_MAX_BATCH_BYTES)
+
+    def _is_tar_supported(self):
+        if self._tar_supported_flag is None:
+            self._tar_supported_flag = len(self._get_subprocess_call_stdout(self._adb_args + ["shell", "command -v tar"]).strip()) != 0
+        return self._tar_supported_flag
+
+    # The paths in the archive are relative to the destination directory, where the files are extracted. The standard
+    # error of tar goes to a temporary file, so it can't fill its pipe while the archive is being written.
+    def _stream_tar(self):
+        args = self._adb_args + ["exec-in", "tar -x -f - -C ${}".format(self._convert_string_to_literal(self._dest_dir_path))]
+        with tempfile.TemporaryFile() as stderr_file:
+            process = self._start_cancellable_process(args, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr_file)
+            try:
+                self._write_tar(process.stdin)
+            except BrokenPipeError:
+                pass # The error of tar is read below
+            finally:
+                self._close_stdin(process)
+                process.wait()
+                self._end_cancellable_process(process)
+            stderr_file.seek(0)
+            stderr_str = stderr_file.read()
+        self._verify_device_connection(stderr_str)
+        if process.returncode != 0:
+            raise file_copiers.FileCopierError("tar failed: {}".format(stderr_str.decode("utf-8", "replace").strip()))
+
+    def _close_stdin(self, process):
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def _write_tar(self, stream):
+        with tarfile.open(fileobj=stream, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+            for dest_dir_path, local_file_paths in self._pending_files.items():
+                partial_dir_path = posixpath.relpath(posixpath.join(dest_dir_path, PARTIAL_DIR_NAME), self._dest_dir_path)
+                for local_file_path in local_file_paths:
+                    tar.add(local_file_path, posixpath.join(partial_dir_path, os.path.basename(local_file_path)), recursive=False, filter=self._reset_tar_info)
+
+    # The files on the device belong to the shell user anyway
+    def _reset_tar_info(self, tar_info):
+        tar_info.uid = tar_info.gid = 0
+        tar_info.uname = tar_info.gname = ""
+        tar_info.mode = 0o644
+        return tar_info
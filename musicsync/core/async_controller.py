@@ -0,0 +1,346 @@
+import os
+import time
+import asyncio
+import concurrent.futures
+
+import musicsync.core.file_copiers as file_copiers
+import musicsync.core.format_conversion as format_conversion
+import musicsync.core.songs_metadata as songs_metadata
+import musicsync.core.sync_manifest as sync_manifest
+import musicsync.core.sync_plan as sync_plan
+import musicsync.core.sync_stats as sync_stats
+import musicsync.core.sync_progress as sync_progress
+from musicsync.core.controller import Controller, ControllerLogProxy, MusicSyncError, TooManyDeletionsError, LYRICS_FORMAT, JOURNAL_COMMIT_INTERVAL
+
+DEFAULT_METADATA_JOBS = 4 # Songs whose tags are read at the same time
+QUEUE_SIZE_PER_JOB = 4 # Items waiting for every task of the next stage, it limits the memory and the temporary files used by a sync
+CANCELLATION_POLL_INTERVAL = 0.1 # Seconds between two calls of can_i_sync
+
+
+# It runs the sync as a pipeline of asyncio stages connected by bounded queues:
+#     scan -> metadata -> transcode -> transfer
+# Every stage has its own number of tasks, so a slow transfer doesn't stop the tags reading and vice versa. The
+# blocking work runs in a thread pool for every stage, while the plan, the counters and the sync manifest are only
+# modified by the event loop thread. Unlike Controller, the files are transferred while the plan is being built, so
+# the mirror mode deletions are planned and executed only after all the other files.
+class AsyncController(Controller):
+    def __init__(self, *args, metadata_jobs=DEFAULT_METADATA_JOBS, transfer_jobs=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metadata_jobs = metadata_jobs
+        self.transfer_jobs = transfer_jobs if self.file_copier.concurrent_transfers_flag else 1
+        self._loop = None
+        self._sync_task = None
+        self._io_executor = None
+        self._metadata_executor = None
+        self._transcode_executor = None
+        self._transfer_executor = None
+
+    # It can be awaited by the callers that already run an event loop
+    async def sync_async(self, src, dest):
+        try:
+            return await self._manage_sync_async(src, dest)
+        except (FileNotFoundError, file_copiers.FileCopierError, TooManyDeletionsError) as exc:
+            raise MusicSyncError(str(exc))
+
+    # It can be called by any thread: the running conversions and transfers are stopped immediately
+    def cancel(self):
+        loop = self._loop
+        if loop is None:
+            return
+        self.file_copier.cancel()
+        try:
+            loop.call_soon_threadsafe(self._cancel_sync_task)
+        except RuntimeError:
+            pass # The sync has just ended and the loop is closed
+
+    def _cancel_sync_task(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+
+    def _manage_sync(self, src, dest, can_i_sync):
+        return asyncio.run(self._run_sync(src, dest, can_i_sync))
+
+    async def _run_sync(self, src, dest, can_i_sync):
+        self._loop = asyncio.get_running_loop()
+        self._sync_task = asyncio.ensure_future(self._manage_sync_async(src, dest))
+        watcher_task = asyncio.ensure_future(self._watch_cancellation(can_i_sync))
+        try:
+            return await self._sync_task
+        except asyncio.CancelledError:
+            return self._get_songs_counts()
+        finally:
+            watcher_task.cancel()
+            self._sync_task = None
+            self._loop = None
+
+    async def _watch_cancellation(self, can_i_sync):
+        while can_i_sync():
+            await asyncio.sleep(CANCELLATION_POLL_INTERVAL)
+        self._cancel_sync_task()
+
+    async def _manage_sync_async(self, src, dest):
+        self._start_stats()
+        self._set_progress_stage(sync_progress.PLANNING_STAGE)
+        self._start_executors()
+        try:
+            resumed_plan = await self._run_in_thread(self._io_executor, self._prepare_sync, src, dest)
+            self._start_progress(self.sync_plan)
+            self._set_progress_stage(sync_progress.TRANSFERRING_STAGE) # The songs are planned and transferred at the same time
+            await self._run_pipeline(src, dest, resumed_plan)
+            await self._run_in_thread(self._io_executor, self.file_copier.flush)
+            if self.mirror:
+                await self._delete_files_async(resumed_plan[1] if resumed_plan is not None else [])
+            self._set_progress_stage(sync_progress.FINISHING_STAGE)
+            await self._run_in_thread(self._io_executor, self._complete_sync, src, dest) # The manifest is saved only if the sync ended
+        finally:
+            self._stop_executors()
+            self._close_journal()
+            self._evict_transcode_cache()
+            self.sync_stats.stop()
+            self._report_progress(force_flag=True)
+        return self._get_songs_counts()
+
+    def _prepare_sync(self, src, dest):
+        self.file_copier.prepare(dest)
+        resumed_plan = self._resume_plan(src, dest)
+        if resumed_plan is None:
+            self._prepare_plan(src, dest)
+            self._start_journal(src, dest)
+        self.sync_plan = sync_plan.SyncPlan()
+        if self.sync_manifest is None or self.mirror:
+            self._get_dest_files() # The listing is needed for sure, so it isn't made by the event loop thread
+        return resumed_plan
+
+    def _complete_sync(self, src, dest):
+        self._commit_journal(self._pop_done_plan_items())
+        self._save_sync_manifest()
+        self._finish_journal(src, dest)
+
+    def _start_executors(self):
+        self._io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) # The scanner and the file copier calls are made one at a time
+        self._metadata_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.metadata_jobs)
+        self._transcode_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        self._transfer_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.transfer_jobs)
+
+    # The running transfers are completed, so no file is written after the end of the sync
+    def _stop_executors(self):
+        for executor in (self._io_executor, self._metadata_executor, self._transcode_executor, self._transfer_executor):
+            executor.shutdown(wait=True, cancel_futures=True)
+        self._io_executor = None
+        self._metadata_executor = None
+        self._transcode_executor = None
+        self._transfer_executor = None
+
+    async def _run_in_thread(self, executor, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    # A resumed sync replaces the scan and metadata stages with the remaining items of the interrupted sync
+    async def _run_pipeline(self, src, dest, resumed_plan):
+        metadata_queue = asyncio.Queue(self.metadata_jobs * QUEUE_SIZE_PER_JOB)
+        transcode_queue = asyncio.Queue(self.jobs * QUEUE_SIZE_PER_JOB)
+        transfer_queue = asyncio.Queue(self.transfer_jobs * QUEUE_SIZE_PER_JOB)
+        if resumed_plan is None:
+            stage_tasks = [
+                asyncio.ensure_future(self._scan_stage(src, metadata_queue)),
+                asyncio.ensure_future(self._plan_stage(metadata_queue, transcode_queue, transfer_queue)),
+            ]
+        else:
+            stage_tasks = [asyncio.ensure_future(self._resume_stage(resumed_plan[0], transcode_queue, transfer_queue))]
+        stage_tasks += [
+            asyncio.ensure_future(self._run_stage(lambda: self._convert_songs(transcode_queue, transfer_queue), self.jobs, transfer_queue, self.transfer_jobs)),
+            asyncio.ensure_future(self._run_stage(lambda: self._transfer_files(transfer_queue), self.transfer_jobs)),
+        ]
+        try:
+            done_tasks, _ = await asyncio.wait(stage_tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for done_task in done_tasks:
+                done_task.result() # It raises the exception of the failed stage
+        finally:
+            for stage_task in stage_tasks:
+                stage_task.cancel()
+            await asyncio.gather(*stage_tasks, return_exceptions=True)
+
+    # When all the tasks of a stage end, a None item is queued for every task of the next stage to stop it
+    async def _run_stage(self, create_task_coroutine, jobs, next_queue=None, next_jobs=0):
+        await asyncio.gather(*(create_task_coroutine() for _ in range(jobs)))
+        for _ in range(next_jobs):
+            await next_queue.put(None)
+
+    async def _scan_stage(self, src, metadata_queue):
+        scanned_directories = self._scan_source_dir(src)
+        try:
+            while True:
+                scanned_files = await self._run_in_thread(self._io_executor, next, scanned_directories, None)
+                if scanned_files is None:
+                    break
+                lyrics_files = {scanned_file.path: scanned_file for scanned_file in scanned_files if scanned_file.path.lower().endswith(LYRICS_FORMAT)}
+                for scanned_file in scanned_files:
+                    if self._is_file_supported(scanned_file.path):
+                        await metadata_queue.put((scanned_file, lyrics_files))
+        finally:
+            # The executor has only one thread, so the generator is closed after the end of the last next call
+            await asyncio.shield(self._run_in_thread(self._io_executor, scanned_directories.close))
+        for _ in range(self.metadata_jobs):
+            await metadata_queue.put(None)
+
+    async def _plan_stage(self, metadata_queue, transcode_queue, transfer_queue):
+        await self._run_stage(lambda: self._plan_songs(metadata_queue, transcode_queue, transfer_queue), self.metadata_jobs, transcode_queue, self.jobs)
+        self._complete_journal_planning()
+
+    # The deletions are planned again at the end of the resumed sync
+    async def _resume_stage(self, plan, transcode_queue, transfer_queue):
+        for plan_item in plan.items:
+            if plan_item.action != sync_plan.DELETE_ACTION:
+                await self._dispatch_plan_item(plan_item, transcode_queue, transfer_queue)
+        for _ in range(self.jobs):
+            await transcode_queue.put(None)
+
+    async def _plan_songs(self, metadata_queue, transcode_queue, transfer_queue):
+        while True:
+            queued_item = await metadata_queue.get()
+            if queued_item is None:
+                return
+            scanned_song, lyrics_files = queued_item
+            for plan_item in await self._plan_song_and_related_files_async(scanned_song, lyrics_files):
+                await self._queue_plan_item(plan_item, transcode_queue, transfer_queue)
+
+    async def _plan_song_and_related_files_async(self, scanned_song, lyrics_files):
+        song_metadata = None
+        file_filters_result = self._check_file_filters(scanned_song)
+        if file_filters_result is False:
+            return []
+        if file_filters_result is None:
+            song_metadata = await self._get_song_metadata_async(scanned_song)
+            if song_metadata is None or not self._check_filters(song_metadata):
+                return []
+        if song_metadata is None and self.conversion_policy.is_metadata_needed(scanned_song.path):
+            song_metadata = await self._get_song_metadata_async(scanned_song) or songs_metadata.SongMetadata(scanned_song.path)
+        conversion_needed_flag = self.conversion_policy.is_conversion_needed(scanned_song.path, song_metadata)
+        song_roots = self._get_song_plan_roots(conversion_needed_flag)
+        relative_path = os.path.relpath(scanned_song.path, song_roots.src)
+        file_state = self._get_file_state(scanned_song, song_roots.get_path_dest(relative_path), not conversion_needed_flag, self.output_format, self.output_bitrate)
+        if song_metadata is None and conversion_needed_flag and file_state != sync_manifest.SYNCED_STATE:
+            # The duration of the song is used to estimate the converted size, an empty metadata prevents reading it again
+            song_metadata = await self._get_song_metadata_async(scanned_song) or songs_metadata.SongMetadata(scanned_song.path)
+        plan_items = [self._create_song_plan_item(scanned_song, relative_path, song_roots, song_metadata, conversion_needed_flag, file_state)]
+        lyrics_path_src = self._get_lyrics_path(scanned_song.path)
+        if lyrics_path_src in lyrics_files:
+            plan_items.append(self._plan_related_file(lyrics_files[lyrics_path_src], self._get_lyrics_path(relative_path)))
+        return plan_items
+
+    async def _get_song_metadata_async(self, scanned_song):
+        try:
+            return await self._run_in_thread(self._metadata_executor, self._read_song_metadata, scanned_song.path, scanned_song.size, scanned_song.mtime_ns)
+        except songs_metadata.NoGettableMetadata:
+            self._count_no_inspectable_song(scanned_song.path)
+            return None
+
+    async def _queue_plan_item(self, plan_item, transcode_queue, transfer_queue):
+        self._add_items_to_journal([plan_item])
+        await self._dispatch_plan_item(plan_item, transcode_queue, transfer_queue)
+
+    async def _dispatch_plan_item(self, plan_item, transcode_queue, transfer_queue):
+        self.sync_plan.add_item(plan_item)
+        if plan_item.action == sync_plan.SKIP_ACTION:
+            self._execute_plan_item(plan_item)
+            return
+        self._add_planned_item(plan_item)
+        if plan_item.action == sync_plan.CONVERT_ACTION:
+            await transcode_queue.put(plan_item)
+        else:
+            await transfer_queue.put((file_copiers.get_copy_file_function(plan_item.path_src), plan_item, None))
+
+    def _add_planned_item(self, plan_item):
+        self.planned_bytes += plan_item.estimated_size
+        self.planned_items_count += 1
+        self._report_progress()
+
+    async def _convert_songs(self, transcode_queue, transfer_queue):
+        while True:
+            plan_item = await transcode_queue.get()
+            if plan_item is None:
+                return
+            converted_song = await self._convert_song(plan_item)
+            if converted_song is not None:
+                await transfer_queue.put(converted_song)
+
+    # The conversions run in several tasks of the event loop thread, so their time is added to the stats directly,
+    # except the ones made by the transcode cache, which measures them by itself
+    async def _convert_song(self, plan_item):
+        if self.transcode_cache is not None:
+            return await self._convert_song_to_file(plan_item)
+        start_time = time.perf_counter()
+        try:
+            return await self._convert_song_to_file(plan_item)
+        finally:
+            self.sync_stats.add(sync_stats.CONVERT_STAGE, time.perf_counter() - start_time, 1)
+
+    # It returns None if the conversion fails
+    async def _convert_song_to_file(self, plan_item):
+        output_format = self.output_format.lower()
+        if self.transcode_cache is not None:
+            try:
+                cached_file_path = await self._run_in_thread(self._transcode_executor, self.transcode_cache.get_converted_song, plan_item.path_src, output_format, self.output_bitrate)
+            except format_conversion.FormatConvertersionError:
+                self._complete_failed_conversion(plan_item)
+                return None
+            return (file_copiers.get_copy_file_function(cached_file_path), plan_item, None)
+        temporary_file_path = self._create_temporary_file(output_format)
+        try:
+            await format_conversion.convert_song_async(plan_item.path_src, temporary_file_path, output_format, self.output_bitrate)
+        except format_conversion.FormatConvertersionError:
+            self._remove_file_if_exists(temporary_file_path)
+            self._complete_failed_conversion(plan_item)
+            return None
+        except BaseException:
+            self._remove_file_if_exists(temporary_file_path)
+            raise
+        return (file_copiers.get_move_file_function(temporary_file_path), plan_item, temporary_file_path)
+
+    def _complete_failed_conversion(self, plan_item):
+        self._update_progress(plan_item)
+        self._report_song_conversion_failed(plan_item.path_src)
+
+    async def _transfer_files(self, transfer_queue):
+        while True:
+            queued_item = await transfer_queue.get()
+            if queued_item is None:
+                return
+            copy_file_function, plan_item, temporary_file_path = queued_item
+            try:
+                await self._run_in_thread(self._transfer_executor, self.file_copier.transfer, copy_file_function, plan_item.path_dest)
+            finally:
+                if temporary_file_path is not None:
+                    self._remove_file_if_exists(temporary_file_path)
+            self._complete_transfer(plan_item)
+            if not self.file_copier.deferred_transfers_flag or len(self._done_plan_items) >= JOURNAL_COMMIT_INTERVAL:
+                # The copiers that write the files later have only one transfer thread, so they are flushed by it
+                await self._run_in_thread(self._transfer_executor, self._commit_journal, self._pop_done_plan_items())
+
+    # The completed items are recorded by the transfer tasks, see _transfer_files
+    def _add_done_plan_item(self, plan_item):
+        if self.sync_journal is not None:
+            self._done_plan_items.append(plan_item)
+
+    def _complete_transfer(self, plan_item):
+        if plan_item.song_flag:
+            self._record_synced_file(plan_item.path_src, plan_item.path_dest, self.output_format, self.output_bitrate)
+            self._complete_song_transfer(plan_item)
+        else:
+            self._record_synced_file(plan_item.path_src, plan_item.path_dest)
+            self._update_progress(plan_item)
+            self._add_done_plan_item(plan_item)
+
+    async def _delete_files_async(self, done_plan_items):
+        planned_items_count = len(self.sync_plan.items)
+        self._plan_deletions(self.sync_plan, done_plan_items)
+        delete_plan_items = self.sync_plan.items[planned_items_count:]
+        self._verify_deletions_count(self.sync_plan)
+        self._add_items_to_journal(delete_plan_items)
+        for plan_item in delete_plan_items:
+            self._add_planned_item(plan_item)
+        await self._run_in_thread(self._io_executor, self._delete_files, delete_plan_items)
+
+
+# The log proxy reports the events of the asyncio sync engine too
+class AsyncControllerLogProxy(AsyncController, ControllerLogProxy):
+    pass
@@ -1,96 +1,623 @@
 import os
+import json
 import logging
+import tempfile
+import collections
+import posixpath
+import time
+import concurrent.futures
 import musicsync.core.file_copiers as file_copiers
 import musicsync.core.format_conversion as format_conversion
+import musicsync.core.songs_metadata as songs_metadata
+import musicsync.core.sync_manifest as sync_manifest
+import musicsync.core.scanner as scanner
+import musicsync.core.sync_plan as sync_plan
+import musicsync.core.sync_stats as sync_stats
+import musicsync.core.sync_progress as sync_progress
+from musicsync.core.conversion_policy import ConversionPolicy, parse_bitrate
 
 SUPPORTED_FORMATS = (".mp3", ".flac") # Make sure to modify songs_metadata.py implementation before changing this value
+LYRICS_FORMAT = ".lrc"
+ESTIMATED_TRANSCODE_SPEED = 50.0 # Seconds of audio converted in a second by a single job, used only to estimate the transcoding time
+DEFAULT_MAX_DELETIONS = 100 # Maximum number of files that the mirror mode can delete without an explicit confirmation
+JOURNAL_COMMIT_INTERVAL = 200 # Completed items after which the file copiers that write the files later are flushed to record the items in the journal
+DEST_MTIME_TOLERANCE_NS = 2 * 10 ** 9 # FAT stores the modification times with a 2 seconds resolution, and adb lists them in seconds
+PENDING_CONVERSIONS_PER_JOB = 2 # Conversions queued for every conversion job, it limits the space taken by the converted files waiting to be copied
 
 class Controller():
-    def __init__(self, file_copier, filters=[], output_format=None, output_bitrate=None):
+    def __init__(self, file_copier, filters=[], output_format=None, output_bitrate=None, metadata_index=None, use_sync_manifest=False, verify_sync_manifest=False, jobs=1, transcode_cache=None, scan_threads=scanner.DEFAULT_SCAN_THREADS, mirror=False, max_deletions=DEFAULT_MAX_DELETIONS, sync_journal=None, conversion_policy=None):
         self.file_copier = file_copier
         self.filters = filters
         self.output_format = output_format
         self.output_bitrate = output_bitrate
+        self.metadata_index = metadata_index
+        self.use_sync_manifest = use_sync_manifest or verify_sync_manifest
+        self.verify_sync_manifest = verify_sync_manifest
+        self.sync_manifest = None
+        self.jobs = jobs
+        self.transcode_cache = transcode_cache
+        self.scan_threads = scan_threads
+        self.mirror = mirror
+        self.max_deletions = max_deletions
+        self.sync_journal = sync_journal
+        self.conversion_policy = conversion_policy if conversion_policy is not None else ConversionPolicy(output_format, output_bitrate)
+        self._done_plan_items = [] # Completed plan items not recorded in the journal yet
+        self.sync_plan = None
+        self._dest = None
+        self._dest_files = None
+        self._plan_roots = None
+        self._converted_plan_roots = None
+        self._conversion_executor = None
+        self._pending_conversions = collections.deque()
         self.copied_songs_count = 0
-        self.no_inspectable_songs_count = 0 # TODO: count corrupted files in self.no_inspectable_songs_count and display filenames in ControllerLogProxy log
+        self.updated_songs_count = 0
+        self.unchanged_songs_count = 0
+        self.deleted_files_count = 0
+        self.no_inspectable_songs_count = 0
+        self.sync_stats = sync_stats.SyncStats()
+        self._progress_stage = None
+        self._progress_throttle = None
+        self._start_progress(sync_plan.SyncPlan())
 
     def sync(self, src, dest, can_i_sync=lambda: True):
         try:
             return self._manage_sync(src, dest, can_i_sync)
-        except (FileNotFoundError, file_copiers.FileCopierError) as exc:
+        except (FileNotFoundError, file_copiers.FileCopierError, TooManyDeletionsError) as exc:
+            raise MusicSyncError(str(exc))
+
+    # It computes what sync would do without modifying the destination
+    def plan(self, src, dest, can_i_sync=lambda: True):
+        self._start_stats()
+        try:
+            return self._manage_plan(src, dest, can_i_sync)
+        except (FileNotFoundError, file_copiers.FileCopierError, TooManyDeletionsError) as exc:
             raise MusicSyncError(str(exc))
+        finally:
+            self.sync_stats.stop()
+
+    # The listener receives a SyncProgress from the thread that runs the sync, at most once every interval and every
+    # time the stage changes, see ProgressThrottle. None removes the listener.
+    def set_progress_listener(self, listener, interval=sync_progress.DEFAULT_PROGRESS_INTERVAL):
+        self._progress_throttle = sync_progress.ProgressThrottle(listener, interval) if listener is not None else None
 
     def _manage_sync(self, src, dest, can_i_sync):
+        self._start_stats()
+        self._set_progress_stage(sync_progress.PLANNING_STAGE)
+        self.file_copier.prepare(dest)
+        try:
+            self.sync_plan = self._resume_or_manage_plan(src, dest, can_i_sync)
+            self._run_sync_plan(self.sync_plan, can_i_sync)
+            if can_i_sync():
+                self._finish_journal(src, dest)
+        finally:
+            self._close_journal()
+            self._evict_transcode_cache()
+            self.sync_stats.stop()
+            self._report_progress(force_flag=True)
+        return self._get_songs_counts()
+
+    def _run_sync_plan(self, plan, can_i_sync):
+        self._verify_deletions_count(plan)
+        self._start_conversion_executor()
+        try:
+            self._execute_plan(plan, can_i_sync)
+            self._complete_pending_conversions(can_i_sync)
+            self.file_copier.flush()
+            self._set_progress_stage(sync_progress.FINISHING_STAGE)
+            self._commit_journal(self._pop_done_plan_items())
+        finally:
+            self._stop_conversion_executor()
+        self._save_sync_manifest() # The manifest is saved only if all the queued files have been copied
+
+    # The cached songs aren't evicted during the sync, because the file copiers can still be reading them
+    def _evict_transcode_cache(self):
+        if self.transcode_cache is not None:
+            self.transcode_cache.evict()
+
+    # The file copier measures its own stages in the same SyncStats
+    def _start_stats(self):
+        self.sync_stats = sync_stats.SyncStats()
+        self.file_copier.sync_stats = self.sync_stats
+        if self.transcode_cache is not None:
+            self.transcode_cache.sync_stats = self.sync_stats
+
+    def _resume_or_manage_plan(self, src, dest, can_i_sync):
+        resumed_plan = self._resume_plan(src, dest)
+        if resumed_plan is not None:
+            return resumed_plan[0]
+        plan = self._manage_plan(src, dest, can_i_sync)
+        if can_i_sync(): # Only a complete plan can be resumed
+            self._start_journal(src, dest)
+            self._add_items_to_journal(plan.items)
+            self._complete_journal_planning()
+        return plan
+
+    def _get_songs_counts(self):
+        return (self.copied_songs_count, self.updated_songs_count, self.unchanged_songs_count, self.no_inspectable_songs_count)
+
+    def _manage_plan(self, src, dest, can_i_sync):
+        self._prepare_plan(src, dest)
+        try:
+            return self._plan_songs(src, dest, can_i_sync)
+        finally:
+            self._commit_metadata_index()
+
+    def _prepare_plan(self, src, dest):
         self._verify_source_dir(src)
-        self._sync_songs(src, dest, can_i_sync)
-        return (self.copied_songs_count, self.no_inspectable_songs_count)
+        self._load_sync_manifest(dest)
+        self._dest = dest
+        self._dest_files = None
+        self._plan_roots = sync_plan.PlanRoots(src, dest)
+        if self.output_format is not None:
+            self._converted_plan_roots = sync_plan.PlanRoots(src, dest, "." + self.output_format.lower())
+
+    # It returns the remaining plan items and the completed ones of the interrupted sync, or None if there isn't one
+    def _resume_plan(self, src, dest):
+        if self.sync_journal is None:
+            return None
+        resumed_plan = self.sync_journal.load(src, dest, self._get_journal_settings())
+        if resumed_plan is None:
+            return None
+        self._prepare_plan(src, dest)
+        plan, done_plan_items = resumed_plan
+        for plan_item in done_plan_items:
+            self._record_done_plan_item(plan_item)
+        self._report_sync_resumed(len(done_plan_items))
+        return resumed_plan
+
+    # The sync manifest of an interrupted sync isn't saved, so it gets the completed items again
+    def _record_done_plan_item(self, plan_item):
+        if plan_item.action == sync_plan.DELETE_ACTION and self.sync_manifest is not None:
+            self.sync_manifest.remove_entry(plan_item.path_dest)
+        elif plan_item.action != sync_plan.DELETE_ACTION and os.path.isfile(plan_item.path_src):
+            if plan_item.song_flag:
+                self._record_synced_file(plan_item.path_src, plan_item.path_dest, self.output_format, self.output_bitrate)
+            else:
+                self._record_synced_file(plan_item.path_src, plan_item.path_dest)
+
+    # A plan built with other filters would copy songs that don't pass them anymore and, with the mirror mode, delete
+    # the songs that pass them now. The filters are sorted, so their order doesn't matter.
+    def _get_journal_settings(self):
+        return {"output_format": self.output_format, "output_bitrate": self.output_bitrate, "mirror": self.mirror,
+            "accepted_codecs": list(self.conversion_policy.accepted_codecs), "skip_low_bitrates": self.conversion_policy.skip_low_bitrates_flag,
+            "filters": sorted((current_filter.get_settings() for current_filter in self.filters), key=lambda filter_settings: json.dumps(filter_settings, sort_keys=True))}
+
+    def _start_journal(self, src, dest):
+        if self.sync_journal is not None:
+            self.sync_journal.start(src, dest, self._get_journal_settings())
+
+    def _add_items_to_journal(self, plan_items):
+        if self.sync_journal is not None:
+            self.sync_journal.add_items(plan_items)
+
+    def _complete_journal_planning(self):
+        if self.sync_journal is not None:
+            self.sync_journal.complete_planning()
+
+    def _add_done_plan_item(self, plan_item):
+        if self.sync_journal is None:
+            return
+        self._done_plan_items.append(plan_item)
+        if not self.file_copier.deferred_transfers_flag or len(self._done_plan_items) >= JOURNAL_COMMIT_INTERVAL:
+            self._commit_journal(self._pop_done_plan_items())
+
+    def _pop_done_plan_items(self):
+        done_plan_items = self._done_plan_items
+        self._done_plan_items = []
+        return done_plan_items
+
+    # The files transferred by the copiers that write them later are really completed only after a flush
+    def _commit_journal(self, done_plan_items):
+        if self.sync_journal is None or not done_plan_items:
+            return
+        if self.file_copier.deferred_transfers_flag:
+            self.file_copier.flush()
+        self.sync_journal.add_done_items(done_plan_items)
+
+    def _finish_journal(self, src, dest):
+        if self.sync_journal is not None:
+            self.sync_journal.finish(src, dest)
+
+    def _close_journal(self):
+        if self.sync_journal is not None:
+            self.sync_journal.close()
 
     def _verify_source_dir(self, src):
         if not os.path.isdir(src):
             raise FileNotFoundError("The source directory is not valid.")
 
-    def _sync_songs(self, src, dest, can_i_sync):
-        for root, _, files in os.walk(src):
-            for filename in files:
+    def _load_sync_manifest(self, dest):
+        if not self.use_sync_manifest:
+            return
+        self.sync_manifest = sync_manifest.load_sync_manifest(self.file_copier, dest)
+        if self.verify_sync_manifest:
+            self.sync_manifest.rebuild()
+
+    def _save_sync_manifest(self):
+        if self.sync_manifest is not None:
+            self.sync_manifest.save()
+
+    def _plan_songs(self, src, dest, can_i_sync):
+        plan = sync_plan.SyncPlan()
+        for scanned_song, lyrics_files, song_metadata in self._select_songs(src, can_i_sync):
+            self._add_song_plan_items(plan, scanned_song, lyrics_files, song_metadata)
+        if self.mirror and can_i_sync(): # The deletions are never planned after an incomplete scan
+            self._plan_deletions(plan)
+        return plan
+
+    # It yields the songs that pass the filters, with the lyrics files of their directory and their metadata, which
+    # is None if the filters didn't need it
+    def _select_songs(self, src, can_i_sync):
+        for scanned_files in self._scan_source_dir(src):
+            lyrics_files = {scanned_file.path: scanned_file for scanned_file in scanned_files if scanned_file.path.lower().endswith(LYRICS_FORMAT)}
+            for scanned_file in scanned_files:
                 if not can_i_sync():
                     return
-                if self._is_file_supported(filename):
-                    song_path_src = os.path.join(root, filename)
-                    song_path_dest = self._get_song_path_dest(src, dest, song_path_src)
-                    if not self.filters or self._check_filters(song_path_src):
-                        self._copy_song_and_related_files(song_path_src, song_path_dest)
+                if self._is_file_supported(scanned_file.path):
+                    selected_flag, song_metadata = self._select_song(scanned_file)
+                    if selected_flag:
+                        yield scanned_file, lyrics_files, song_metadata
+
+    # The scan time is the time waited for the next directory, while the other directories are listed by the scanner threads
+    def _scan_source_dir(self, src):
+        scanned_directories = scanner.scan_directories(src, SUPPORTED_FORMATS + (LYRICS_FORMAT,), self.scan_threads)
+        try:
+            while True:
+                with self.sync_stats.measure(sync_stats.SCAN_STAGE, 0):
+                    scanned_files = next(scanned_directories, None)
+                if scanned_files is None:
+                    return
+                self.sync_stats.add(sync_stats.SCAN_STAGE, count=len(scanned_files))
+                yield scanned_files
+        finally:
+            scanned_directories.close()
+
+    # The completed items of a resumed sync aren't in the plan, but their files must be kept too
+    def _plan_deletions(self, plan, done_plan_items=[]):
+        planned_files_paths = set(_normalize_dest_path(plan_item.path_dest) for plan_item in plan.items + done_plan_items if plan_item.action != sync_plan.DELETE_ACTION)
+        for file_path, (size, _) in self._get_dest_files().items():
+            if file_path not in planned_files_paths and self._is_file_mirrored(file_path):
+                plan.add_item(sync_plan.PlanItem(sync_plan.DELETE_ACTION, None, file_path, size, 0, song_flag=not file_path.lower().endswith(LYRICS_FORMAT)))
+
+    # Only songs and lyrics are deleted, the other files in the destination are never touched by the mirror mode
+    def _is_file_mirrored(self, file_path):
+        mirrored_formats = SUPPORTED_FORMATS + (LYRICS_FORMAT,)
+        if self.output_format is not None:
+            mirrored_formats += ("." + self.output_format.lower(),)
+        return file_path.lower().endswith(mirrored_formats)
+
+    def _verify_deletions_count(self, plan):
+        deletions_count = len(plan.get_items(sync_plan.DELETE_ACTION))
+        if deletions_count > self.max_deletions:
+            raise TooManyDeletionsError("The mirror mode would delete {} files, but the maximum is {}.".format(deletions_count, self.max_deletions))
+
+    def _select_song(self, scanned_song):
+        file_filters_result = self._check_file_filters(scanned_song)
+        if file_filters_result is not None:
+            return file_filters_result, None
+        song_metadata = self._get_song_metadata(scanned_song.path, scanned_song.size, scanned_song.mtime_ns) # The metadata is read only if the filters need it
+        return song_metadata is not None and self._check_filters(song_metadata), song_metadata
+
+    def _add_song_plan_items(self, plan, scanned_song, lyrics_files, song_metadata):
+        if song_metadata is None and self.conversion_policy.is_metadata_needed(scanned_song.path):
+            # An empty metadata prevents reading again a song that can't be inspected
+            song_metadata = self._get_song_metadata(scanned_song.path, scanned_song.size, scanned_song.mtime_ns) or songs_metadata.SongMetadata(scanned_song.path)
+        conversion_needed_flag = self.conversion_policy.is_conversion_needed(scanned_song.path, song_metadata)
+        song_roots = self._get_song_plan_roots(conversion_needed_flag)
+        relative_path = os.path.relpath(scanned_song.path, song_roots.src)
+        plan.add_item(self._plan_song(scanned_song, relative_path, song_roots, song_metadata, conversion_needed_flag))
+        lyrics_path_src = self._get_lyrics_path(scanned_song.path)
+        if lyrics_path_src in lyrics_files:
+            plan.add_item(self._plan_related_file(lyrics_files[lyrics_path_src], self._get_lyrics_path(relative_path)))
+
+    def _plan_song(self, scanned_song, relative_path, song_roots, song_metadata, conversion_needed_flag):
+        file_state = self._get_file_state(scanned_song, song_roots.get_path_dest(relative_path), not conversion_needed_flag, self.output_format, self.output_bitrate)
+        return self._create_song_plan_item(scanned_song, relative_path, song_roots, song_metadata, conversion_needed_flag, file_state)
+
+    # The metadata is read here only if the song must be converted and the caller didn't read it yet
+    def _create_song_plan_item(self, scanned_song, relative_path, song_roots, song_metadata, conversion_needed_flag, file_state):
+        if file_state == sync_manifest.SYNCED_STATE:
+            return sync_plan.PlanItem(sync_plan.SKIP_ACTION, relative_path, None, scanned_song.size, roots=song_roots)
+        update_flag = file_state == sync_manifest.CHANGED_STATE
+        if conversion_needed_flag:
+            if song_metadata is None:
+                song_metadata = self._get_song_metadata(scanned_song.path, scanned_song.size, scanned_song.mtime_ns)
+            duration = song_metadata.duration if song_metadata is not None and song_metadata.duration is not None else 0.0
+            return sync_plan.PlanItem(sync_plan.CONVERT_ACTION, relative_path, None, scanned_song.size, self._estimate_converted_size(scanned_song.size, duration), duration / ESTIMATED_TRANSCODE_SPEED, update_flag=update_flag, roots=song_roots)
+        return sync_plan.PlanItem(sync_plan.COPY_ACTION, relative_path, None, scanned_song.size, update_flag=update_flag, roots=song_roots)
+
+    # The related files keep their format, and their path relative to the roots is the same in the source and in the destination
+    def _plan_related_file(self, scanned_file, relative_path):
+        file_state = self._get_file_state(scanned_file, self._plan_roots.get_path_dest(relative_path), True)
+        if file_state == sync_manifest.SYNCED_STATE:
+            return sync_plan.PlanItem(sync_plan.SKIP_ACTION, relative_path, None, scanned_file.size, song_flag=False, roots=self._plan_roots)
+        return sync_plan.PlanItem(sync_plan.COPY_ACTION, relative_path, None, scanned_file.size, song_flag=False, update_flag=file_state == sync_manifest.CHANGED_STATE, roots=self._plan_roots)
+
+    def _estimate_converted_size(self, size, duration):
+        bitrate = parse_bitrate(self.output_bitrate)
+        if bitrate is None or duration == 0.0:
+            return size
+        return int(duration * bitrate / 8)
+
+    # The sync manifest knows the source file of the last sync, otherwise the destination listing is used: a file is
+    # changed if the source one was modified after it (e.g. a retag that fits in the padding of the tags keeps the size),
+    # or if it was copied and its size is different from the source one. The copies keep the modification time of their
+    # source or get the time of the sync, like the converted files, so both are older than a later change of the source.
+    def _get_file_state(self, scanned_file, file_path_dest, same_size_flag, output_format=None, output_bitrate=None):
+        with self.sync_stats.measure(sync_stats.EXISTS_STAGE):
+            return self._check_file_state(scanned_file, file_path_dest, same_size_flag, output_format, output_bitrate)
+
+    def _check_file_state(self, scanned_file, file_path_dest, same_size_flag, output_format, output_bitrate):
+        if self.sync_manifest is not None:
+            file_state = self.sync_manifest.get_state(file_path_dest, scanned_file.size, scanned_file.mtime_ns, output_format, output_bitrate)
+            if file_state == sync_manifest.SYNCED_STATE:
+                self.sync_manifest.add_entry_if_missing(scanned_file.path, file_path_dest, output_format, output_bitrate)
+            if file_state != sync_manifest.UNKNOWN_STATE:
+                return file_state
+        dest_file_stat = self._get_dest_files().get(_normalize_dest_path(file_path_dest))
+        if dest_file_stat is None:
+            return sync_manifest.UNKNOWN_STATE
+        dest_file_size, dest_file_mtime_ns = dest_file_stat
+        if same_size_flag and dest_file_size != scanned_file.size:
+            return sync_manifest.CHANGED_STATE
+        if scanned_file.mtime_ns > dest_file_mtime_ns + DEST_MTIME_TOLERANCE_NS:
+            return sync_manifest.CHANGED_STATE
+        self._record_synced_file(scanned_file.path, file_path_dest, output_format, output_bitrate)
+        return sync_manifest.SYNCED_STATE
+
+    # The destination is listed only once, and only if the sync manifest doesn't know every file or the mirror mode is used
+    def _get_dest_files(self):
+        if self._dest_files is None:
+            with self.sync_stats.measure(sync_stats.EXISTS_STAGE, 0):
+                self._dest_files = {_normalize_dest_path(file_path): file_stat for file_path, file_stat in self.file_copier.list_files(self._dest).items()}
+        return self._dest_files
+
+    def _execute_plan(self, plan, can_i_sync):
+        self._start_progress(plan)
+        self._delete_files(plan.get_items(sync_plan.DELETE_ACTION)) # Deleting first frees space for the new files
+        self._set_progress_stage(sync_progress.TRANSFERRING_STAGE)
+        for plan_item in plan.items:
+            if not can_i_sync():
+                return
+            self._execute_plan_item(plan_item)
+
+    def _delete_files(self, plan_items):
+        if not plan_items:
+            return
+        self._set_progress_stage(sync_progress.DELETING_STAGE)
+        self.file_copier.remove_files([plan_item.path_dest for plan_item in plan_items])
+        for plan_item in plan_items:
+            if self.sync_manifest is not None:
+                self.sync_manifest.remove_entry(plan_item.path_dest)
+            self.deleted_files_count += 1
+            self._update_progress(plan_item)
+            self._add_done_plan_item(plan_item)
+            self._report_file_deleted(plan_item.path_dest)
+
+    def _execute_plan_item(self, plan_item):
+        if plan_item.action == sync_plan.DELETE_ACTION:
+            pass # Already deleted all together
+        elif plan_item.action == sync_plan.SKIP_ACTION:
+            if plan_item.song_flag:
+                self.unchanged_songs_count += 1
+                self._report_song_already_exists(plan_item.path_src)
+        elif plan_item.action == sync_plan.CONVERT_ACTION and self._conversion_executor is not None:
+            self._queue_conversion(plan_item)
+        elif plan_item.song_flag:
+            self._transfer_song(self._get_copy_file_function(plan_item), plan_item)
+        else:
+            self._transfer_file(file_copiers.get_copy_file_function(plan_item.path_src), plan_item.path_src, plan_item.path_dest)
+            self._update_progress(plan_item)
+            self._add_done_plan_item(plan_item)
+
+    # The conversions run in the executor threads, while the copies are always made by the thread that calls sync, so
+    # the counters and the file copier don't need to be thread-safe
+    def _start_conversion_executor(self):
+        if self.jobs > 1 and self.output_format is not None:
+            self._conversion_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
 
-    def _copy_song_and_related_files(self, song_path_src, song_path_dest):
-        self._copy_song(song_path_src, song_path_dest)
-        self._copy_song_lyrics_if_exists(song_path_src, song_path_dest)
+    def _stop_conversion_executor(self):
+        if self._conversion_executor is None:
+            return
+        while self._pending_conversions:
+            self._discard_pending_conversion(self._pending_conversions.popleft())
+        self._conversion_executor.shutdown(wait=True)
+        self._conversion_executor = None
 
-    def _copy_song(self, song_path_src, song_path_dest):
+    def _transfer_song(self, copy_file_function, plan_item):
         try:
-            self._copy_song_helper(song_path_src, song_path_dest)
+            self._transfer_file(copy_file_function, plan_item.path_src, plan_item.path_dest, self.output_format, self.output_bitrate)
         except format_conversion.FormatConvertersionError:
-            pass
+            self._update_progress(plan_item)
+            self._report_song_conversion_failed(plan_item.path_src)
+            return
+        self._complete_song_transfer(plan_item)
 
-    def _copy_song_helper(self, song_path_src, song_path_dest):
-        copied_flag = self.file_copier.copy(self._get_copy_file_function(song_path_src), song_path_dest)
-        if copied_flag:
+    def _complete_song_transfer(self, plan_item):
+        self._update_progress(plan_item)
+        self._add_done_plan_item(plan_item)
+        if plan_item.update_flag:
+            self.updated_songs_count += 1
+            self._report_song_updated(plan_item.path_src)
+        else:
             self.copied_songs_count += 1
-        return copied_flag
+            self._report_song_copied(plan_item.path_src)
 
-    def _get_copy_file_function(self, song_path_src):
-        if self.output_format is not None and os.path.splitext(song_path_src)[1] != self.output_format.lower(): # A custom output format is selected and the source file format is different from the chosen one
-            return format_conversion.get_convert_song_function(song_path_src, self.output_format.lower(), self.output_bitrate)
-        return file_copiers.get_copy_file_function(song_path_src)
+    def _queue_conversion(self, plan_item):
+        self._complete_done_conversions()
+        while len(self._pending_conversions) >= self.jobs * PENDING_CONVERSIONS_PER_JOB:
+            self._complete_conversion(self._pending_conversions.popleft())
+        temporary_file_path = self._create_temporary_file(self.output_format)
+        future = self._conversion_executor.submit(self._get_copy_file_function(plan_item), temporary_file_path)
+        self._pending_conversions.append((future, plan_item, temporary_file_path))
 
-    def _get_song_path_dest(self, src, dest, song_path_src):
-        song_path_dest_with_same_format = os.path.join(dest, os.path.relpath(song_path_src, src))
-        if self.output_format is not None:
-            return os.path.splitext(song_path_dest_with_same_format)[0] + "." + self.output_format.lower()
-        return song_path_dest_with_same_format
+    def _create_temporary_file(self, extension):
+        file_descriptor, file_path = tempfile.mkstemp(suffix="." + extension.lower())
+        os.close(file_descriptor)
+        return file_path
+
+    def _complete_done_conversions(self):
+        while self._pending_conversions and self._pending_conversions[0][0].done():
+            self._complete_conversion(self._pending_conversions.popleft())
+
+    def _complete_pending_conversions(self, can_i_sync):
+        while self._pending_conversions and can_i_sync():
+            self._complete_conversion(self._pending_conversions.popleft())
+
+    def _complete_conversion(self, pending_conversion):
+        future, plan_item, temporary_file_path = pending_conversion
+        try:
+            self._transfer_converted_song(future, plan_item, temporary_file_path)
+        finally:
+            self._remove_file_if_exists(temporary_file_path)
+
+    def _transfer_converted_song(self, future, plan_item, temporary_file_path):
+        try:
+            future.result()
+        except format_conversion.FormatConvertersionError:
+            self._update_progress(plan_item)
+            self._report_song_conversion_failed(plan_item.path_src)
+            return
+        self._transfer_song(file_copiers.get_move_file_function(temporary_file_path), plan_item)
+
+    def _discard_pending_conversion(self, pending_conversion):
+        future, _, temporary_file_path = pending_conversion
+        future.cancel()
+        concurrent.futures.wait([future])
+        self._remove_file_if_exists(temporary_file_path)
+
+    def _remove_file_if_exists(self, file_path):
+        if os.path.isfile(file_path):
+            os.unlink(file_path)
+
+    def _transfer_file(self, copy_file_function, file_path_src, file_path_dest, output_format=None, output_bitrate=None):
+        self.file_copier.transfer(copy_file_function, file_path_dest)
+        self._record_synced_file(file_path_src, file_path_dest, output_format, output_bitrate)
+
+    def _record_synced_file(self, file_path_src, file_path_dest, output_format=None, output_bitrate=None):
+        if self.sync_manifest is not None:
+            self.sync_manifest.add_entry(file_path_src, file_path_dest, output_format, output_bitrate)
+
+    def _start_progress(self, plan):
+        self.planned_bytes = plan.get_estimated_bytes()
+        self.done_bytes = 0
+        self.planned_items_count = len(plan.get_work_items())
+        self.done_items_count = 0
+        self._progress_start_time = time.monotonic()
+
+    def _update_progress(self, plan_item):
+        self.done_bytes += plan_item.estimated_size
+        self.done_items_count += 1
+        self._report_progress(plan_item.path_dest)
+
+    def _set_progress_stage(self, stage):
+        self._progress_stage = stage
+        self._report_progress(force_flag=True)
+
+    def _report_progress(self, done_path=None, force_flag=False):
+        if self._progress_throttle is not None:
+            self._progress_throttle.update(self.get_progress, done_path, force_flag)
+
+    def get_progress(self, done_paths=()):
+        return sync_progress.SyncProgress(self._progress_stage, self.planned_items_count, self.done_items_count, self.planned_bytes, self.done_bytes, time.monotonic() - self._progress_start_time, done_paths)
+
+    # It returns None until the ETA can be estimated
+    def get_eta_seconds(self):
+        return self.get_progress().get_eta_seconds()
+
+    def _report_song_copied(self, song_path_src):
+        pass
+
+    def _report_song_updated(self, song_path_src):
+        pass
+
+    def _report_song_already_exists(self, song_path_src):
+        pass
+
+    def _report_song_conversion_failed(self, song_path_src):
+        pass
+
+    def _report_file_deleted(self, file_path_dest):
+        pass
+
+    def _report_song_not_inspectable(self, song_path):
+        pass
+
+    def _report_sync_resumed(self, done_items_count):
+        pass
+
+    # The conversion policy has already decided the action of the song in the plan
+    def _get_copy_file_function(self, plan_item):
+        if plan_item.action == sync_plan.CONVERT_ACTION and self.transcode_cache is not None:
+            return self.transcode_cache.get_convert_song_function(plan_item.path_src, self.output_format.lower(), self.output_bitrate) # The cache measures its own conversions
+        if plan_item.action == sync_plan.CONVERT_ACTION:
+            return sync_stats.MeasuredCopyFileFunction(format_conversion.get_convert_song_function(plan_item.path_src, self.output_format.lower(), self.output_bitrate), self.sync_stats, sync_stats.CONVERT_STAGE)
+        return file_copiers.get_copy_file_function(plan_item.path_src)
 
-    def _copy_song_lyrics_if_exists(self, song_path_src, song_path_dest):
-        lyrics_path_src = self._get_lyrics_path(song_path_src)
-        lyrics_path_dest = self._get_lyrics_path(song_path_dest)
-        if os.path.isfile(lyrics_path_src):
-            self.file_copier.copy(file_copiers.get_copy_file_function(lyrics_path_src), lyrics_path_dest)
+    # The songs copied as they are keep their format
+    def _get_song_plan_roots(self, conversion_needed_flag):
+        return self._converted_plan_roots if conversion_needed_flag else self._plan_roots
 
     def _get_lyrics_path(self, song_path):
         # Same filename, different extension
-        return os.path.splitext(song_path)[0] + ".lrc"
+        return os.path.splitext(song_path)[0] + LYRICS_FORMAT
 
     def _is_file_supported(self, filename):
         return filename.lower().endswith(SUPPORTED_FORMATS)
 
-    def _check_filters(self, song_path):
+    def _check_file_filters(self, scanned_file):
+        with self.sync_stats.measure(sync_stats.FILTER_STAGE):
+            return self._get_file_filters_result(scanned_file)
+
+    def _get_file_filters_result(self, scanned_file):
+        result = True
         for current_filter in self.filters:
-            if not current_filter.check(song_path):
+            current_result = current_filter.check_file(scanned_file.path, scanned_file.size)
+            if current_result is False:
                 return False
-        return True
+            if current_result is None:
+                result = None
+        return result
+
+    # The song has already been counted by _check_file_filters
+    def _check_filters(self, song_metadata):
+        with self.sync_stats.measure(sync_stats.FILTER_STAGE, 0):
+            for current_filter in self.filters:
+                if not current_filter.check_metadata(song_metadata):
+                    return False
+            return True
+
+    def _get_song_metadata(self, song_path, size=None, mtime_ns=None):
+        try:
+            return self._read_song_metadata(song_path, size, mtime_ns)
+        except songs_metadata.NoGettableMetadata:
+            self._count_no_inspectable_song(song_path)
+            return None
+
+    # It raises NoGettableMetadata and it can be called by several threads at the same time
+    def _read_song_metadata(self, song_path, size=None, mtime_ns=None):
+        with self.sync_stats.measure(sync_stats.METADATA_STAGE):
+            if self.metadata_index is not None:
+                return self.metadata_index.get_song_metadata(song_path, size, mtime_ns)
+            return songs_metadata.get_song_metadata(song_path)
+
+    def _count_no_inspectable_song(self, song_path):
+        self.no_inspectable_songs_count += 1
+        self._report_song_not_inspectable(song_path)
+
+    def _commit_metadata_index(self):
+        if self.metadata_index is not None:
+            self.metadata_index.commit()
+
+
+def _normalize_dest_path(path):
+    return posixpath.normpath(path.replace("\\", "/"))
 
 
 # This class does not implement the proxy pattern, so technically it is not a proxy, but the "Proxy" suffix in its name gives a good idea of what it does
 class ControllerLogProxy(Controller):
-    def __init__(self, file_copier, filters=[], output_format=None, output_bitrate=None, file_log=False):
-        super().__init__(file_copier, filters, output_format, output_bitrate)
+    def __init__(self, file_copier, filters=[], output_format=None, output_bitrate=None, file_log=False, metadata_index=None, use_sync_manifest=False, verify_sync_manifest=False, jobs=1, transcode_cache=None, scan_threads=scanner.DEFAULT_SCAN_THREADS, mirror=False, max_deletions=DEFAULT_MAX_DELETIONS, sync_journal=None, conversion_policy=None):
+        super().__init__(file_copier, filters, output_format, output_bitrate, metadata_index, use_sync_manifest, verify_sync_manifest, jobs, transcode_cache, scan_threads, mirror, max_deletions, sync_journal, conversion_policy)
         self._init_logger()
         self._init_console_log()
         if file_log:
@@ -117,19 +644,56 @@ class ControllerLogProxy(Controller):
     def sync(self, src, dest, can_i_sync=lambda: True):
         try:
             self._manage_sync(src, dest, can_i_sync)
-        except (FileNotFoundError, file_copiers.FileCopierError, format_conversion.FormatConverterNotFound) as exc:
+            self.logger.info("Copied songs: {}, updated songs: {}, unchanged songs: {}.".format(self.copied_songs_count, self.updated_songs_count, self.unchanged_songs_count))
+            self.logger.info(self.sync_stats.get_summary())
+        except (FileNotFoundError, file_copiers.FileCopierError, format_conversion.FormatConverterNotFound, TooManyDeletionsError) as exc:
             self.logger.error(str(exc))
             raise MusicSyncError(str(exc))
 
-    def _copy_song(self, song_path_src, song_path_dest):
+    def plan(self, src, dest, can_i_sync=lambda: True):
+        self._start_stats()
         try:
-            if self._copy_song_helper(song_path_src, song_path_dest):
-                self.logger.info("{} copied.".format(song_path_src))
-            else:
-                self.logger.info("{} already exists.".format(song_path_src))
-        except format_conversion.FormatConvertersionError as exc:
-            self.logger.warning("{} can't be converted to {}.".format(song_path_src, self.output_format))
+            return self._manage_plan(src, dest, can_i_sync)
+        except (FileNotFoundError, file_copiers.FileCopierError) as exc:
+            self.logger.error(str(exc))
+            raise MusicSyncError(str(exc))
+        finally:
+            self.sync_stats.stop()
+
+    def _execute_plan(self, plan, can_i_sync):
+        self.logger.info(plan.get_summary())
+        super()._execute_plan(plan, can_i_sync)
+
+    def _report_song_copied(self, song_path_src):
+        self.logger.info("{} {} copied.".format(self._get_progress_text(), song_path_src))
+
+    def _report_song_updated(self, song_path_src):
+        self.logger.info("{} {} updated.".format(self._get_progress_text(), song_path_src))
+
+    def _report_song_already_exists(self, song_path_src):
+        self.logger.info("{} already exists.".format(song_path_src))
+
+    def _report_song_conversion_failed(self, song_path_src):
+        self.logger.warning("{} {} can't be converted to {}.".format(self._get_progress_text(), song_path_src, self.output_format))
+
+    def _report_file_deleted(self, file_path_dest):
+        self.logger.info("{} {} deleted.".format(self._get_progress_text(), file_path_dest))
+
+    def _get_progress_text(self):
+        eta_seconds = self.get_eta_seconds()
+        eta_text = time.strftime("%H:%M:%S", time.gmtime(eta_seconds)) if eta_seconds is not None else "--:--:--"
+        return "[{}/{}, ETA {}]".format(self.done_items_count, self.planned_items_count, eta_text)
+
+    def _report_song_not_inspectable(self, song_path):
+        self.logger.warning("{} can't be inspected.".format(song_path))
+
+    def _report_sync_resumed(self, done_items_count):
+        self.logger.info("Resuming the interrupted sync, {} files were already completed.".format(done_items_count))
 
 
 class MusicSyncError(RuntimeError):
     pass
+
+
+class TooManyDeletionsError(RuntimeError):
+    pass
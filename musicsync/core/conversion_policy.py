@@ -0,0 +1,48 @@
+import os
+
+LOSSLESS_CODECS = ("flac", "alac", "wav", "aiff", "ape", "wavpack") # Their bitrate doesn't tell how the song sounds
+
+def parse_bitrate(bitrate):
+    if bitrate is None:
+        return None
+    multipliers = {"k": 1000, "m": 1000000}
+    try:
+        if bitrate[-1].lower() in multipliers:
+            return float(bitrate[:-1]) * multipliers[bitrate[-1].lower()]
+        return float(bitrate)
+    except ValueError:
+        return None
+
+
+# It decides which songs are converted to the output format and which ones are copied as they are. Converting a song
+# that is already in the output format, in one of the accepted codecs, or in a lossy codec whose bitrate isn't greater
+# than the output one only costs time and gives a bigger song that sounds worse. Lossless songs are always converted.
+# The codec and the bitrate come from the header parse that reads the metadata of the song.
+class ConversionPolicy():
+    def __init__(self, output_format=None, output_bitrate=None, accepted_codecs=(), skip_low_bitrates_flag=True):
+        self.output_format = output_format.lower() if output_format is not None else None
+        self.output_bitrate = parse_bitrate(output_bitrate) # Bits per second
+        self.accepted_codecs = tuple(codec.lower() for codec in accepted_codecs)
+        self.skip_low_bitrates_flag = skip_low_bitrates_flag
+
+    # The metadata is read only if the codec or the bitrate of the song can avoid the conversion
+    def is_metadata_needed(self, song_path):
+        return self._is_format_different(song_path) and (len(self.accepted_codecs) > 0 or (self.skip_low_bitrates_flag and self.output_bitrate is not None))
+
+    # The songs whose codec or bitrate can't be read are always converted
+    def is_conversion_needed(self, song_path, song_metadata=None):
+        if not self._is_format_different(song_path):
+            return False
+        if song_metadata is None:
+            return True
+        if song_metadata.codec is not None and song_metadata.codec in self.accepted_codecs:
+            return False
+        return not self._is_bitrate_low(song_metadata)
+
+    def _is_bitrate_low(self, song_metadata):
+        if not self.skip_low_bitrates_flag or self.output_bitrate is None or song_metadata.bitrate is None:
+            return False
+        return song_metadata.codec not in LOSSLESS_CODECS and song_metadata.bitrate <= self.output_bitrate
+
+    def _is_format_different(self, song_path):
+        return self.output_format is not None and os.path.splitext(song_path)[1].lower() != "." + self.output_format
@@ -0,0 +1,229 @@
+import logging
+import shutil
+import tempfile
+import concurrent.futures
+
+import musicsync.core.file_copiers as file_copiers
+import musicsync.core.format_conversion as format_conversion
+import musicsync.core.scanner as scanner
+import musicsync.core.sync_plan as sync_plan
+import musicsync.core.sync_stats as sync_stats
+from musicsync.core.controller import Controller, ControllerLogProxy, MusicSyncError, TooManyDeletionsError, DEFAULT_MAX_DELETIONS
+from musicsync.core.transcode_cache import TranscodeCache
+
+DESTINATION_ERRORS = (file_copiers.FileCopierError, format_conversion.FormatConverterNotFound, TooManyDeletionsError, OSError) # Errors that stop only the destination that raised them, e.g. a full or unmounted card
+
+
+# It syncs the same selection of songs to several destinations, each with its own file copier. The source is scanned and
+# the filters are checked only once, then every destination is prepared, synced and flushed by its own thread, so a
+# slow device doesn't stop the faster ones. The converted songs are shared through the transcode cache (a temporary
+# one, removed at the end of the sync, if it isn't set), so every song is converted once for all the destinations.
+# The sync journal isn't supported: an interrupted sync is planned again.
+class FanOutController(Controller):
+    def __init__(self, file_copiers, filters=[], output_format=None, output_bitrate=None, metadata_index=None, use_sync_manifest=False, verify_sync_manifest=False, jobs=1, transcode_cache=None, scan_threads=scanner.DEFAULT_SCAN_THREADS, mirror=False, max_deletions=DEFAULT_MAX_DELETIONS, conversion_policy=None):
+        Controller.__init__(self, None, filters, output_format, output_bitrate, metadata_index, use_sync_manifest, verify_sync_manifest, jobs, transcode_cache, scan_threads, mirror, max_deletions, None, conversion_policy)
+        self.file_copiers = file_copiers
+        self.destination_controllers = []
+        self.sync_plans = []
+        self.failed_dests = {} # Destination -> error that stopped its sync
+        self._shared_transcode_cache = None
+        self._temporary_cache_dir_path = None
+        self._shared_song_metadata = (None, None) # Path and metadata of the song being planned
+
+    def sync(self, src, dests, can_i_sync=lambda: True):
+        try:
+            return self._manage_fan_out_sync(src, dests, can_i_sync)
+        except (FileNotFoundError, file_copiers.FileCopierError) as exc:
+            raise MusicSyncError(str(exc))
+
+    # It computes what sync would do for every destination without modifying them
+    def plan(self, src, dests, can_i_sync=lambda: True):
+        self._start_stats()
+        try:
+            self._prepare_fan_out(src, dests)
+            self._plan_destinations(src, can_i_sync)
+            self._raise_destinations_errors()
+            return self.sync_plans
+        except (FileNotFoundError, file_copiers.FileCopierError) as exc:
+            raise MusicSyncError(str(exc))
+        finally:
+            self.sync_stats.stop()
+
+    def _manage_fan_out_sync(self, src, dests, can_i_sync):
+        self._start_stats()
+        self._start_shared_transcode_cache()
+        try:
+            self._prepare_fan_out(src, dests)
+            self._plan_destinations(src, can_i_sync)
+            self._run_on_destinations(lambda destination_controller: destination_controller.run(can_i_sync))
+        finally:
+            self._evict_transcode_cache()
+            self._stop_shared_transcode_cache()
+            self.sync_stats.stop()
+            self._count_destinations_songs()
+        self._raise_destinations_errors()
+        return self._get_songs_counts()
+
+    # The destinations share the SyncStats, which can be updated by several threads
+    def _start_stats(self):
+        self.sync_stats = sync_stats.SyncStats()
+        if self.transcode_cache is not None:
+            self.transcode_cache.sync_stats = self.sync_stats
+
+    def _prepare_fan_out(self, src, dests):
+        if len(dests) != len(self.file_copiers):
+            raise ValueError("Every destination needs its own file copier.")
+        self._verify_source_dir(src)
+        self.failed_dests = {}
+        self.destination_controllers = [self._create_destination_controller(file_copier, dest) for file_copier, dest in zip(self.file_copiers, dests)]
+        self._run_on_destinations(lambda destination_controller: destination_controller.prepare(src))
+
+    def _create_destination_controller(self, file_copier, dest):
+        return DestinationController(self, file_copier, dest)
+
+    def _start_shared_transcode_cache(self):
+        if self.output_format is None:
+            self._shared_transcode_cache = None
+        elif self.transcode_cache is not None:
+            self._shared_transcode_cache = self.transcode_cache
+        else:
+            self._temporary_cache_dir_path = tempfile.mkdtemp()
+            self._shared_transcode_cache = TranscodeCache(self._temporary_cache_dir_path, float("inf")) # The songs must stay there until every destination has them
+            self._shared_transcode_cache.sync_stats = self.sync_stats
+
+    def _stop_shared_transcode_cache(self):
+        if self._temporary_cache_dir_path is not None:
+            shutil.rmtree(self._temporary_cache_dir_path, ignore_errors=True)
+        self._temporary_cache_dir_path = None
+        self._shared_transcode_cache = None
+
+    # Every selected song is planned for every destination before the next one is selected
+    def _plan_destinations(self, src, can_i_sync):
+        self.sync_plans = [destination_controller.sync_plan for destination_controller in self.destination_controllers]
+        if not self._get_running_destination_controllers():
+            return self.sync_plans
+        try:
+            for scanned_song, lyrics_files, song_metadata in self._select_songs(src, can_i_sync):
+                self._shared_song_metadata = (scanned_song.path, song_metadata) if song_metadata is not None else (None, None)
+                for destination_controller in self._get_running_destination_controllers():
+                    destination_controller.plan_song(scanned_song, lyrics_files)
+            if self.mirror and can_i_sync(): # The deletions are never planned after an incomplete scan
+                for destination_controller in self._get_running_destination_controllers():
+                    destination_controller.plan_deletions()
+        finally:
+            self._shared_song_metadata = (None, None)
+            self._commit_metadata_index()
+        return self.sync_plans
+
+    # The destinations that convert the same song read its metadata only once
+    def _get_shared_song_metadata(self, song_path, size, mtime_ns):
+        if self._shared_song_metadata[0] != song_path:
+            self._shared_song_metadata = (song_path, self._get_song_metadata(song_path, size, mtime_ns))
+        return self._shared_song_metadata[1]
+
+    def _get_running_destination_controllers(self):
+        return [destination_controller for destination_controller in self.destination_controllers if destination_controller.dest not in self.failed_dests]
+
+    # The function is called by a thread for every destination, and a destination that fails doesn't stop the others
+    def _run_on_destinations(self, function):
+        destination_controllers = self._get_running_destination_controllers()
+        if not destination_controllers:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(destination_controllers)) as executor:
+            futures = {executor.submit(function, destination_controller): destination_controller for destination_controller in destination_controllers}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except DESTINATION_ERRORS as exc:
+                    self.failed_dests[futures[future].dest] = exc
+                    self._report_destination_failed(futures[future].dest, exc)
+
+    def _count_destinations_songs(self):
+        self.copied_songs_count = sum(destination_controller.copied_songs_count for destination_controller in self.destination_controllers)
+        self.updated_songs_count = sum(destination_controller.updated_songs_count for destination_controller in self.destination_controllers)
+        self.unchanged_songs_count = sum(destination_controller.unchanged_songs_count for destination_controller in self.destination_controllers)
+        self.deleted_files_count = sum(destination_controller.deleted_files_count for destination_controller in self.destination_controllers)
+
+    def _raise_destinations_errors(self):
+        if self.failed_dests:
+            raise MusicSyncError("The sync failed for {} of {} destinations: {}".format(len(self.failed_dests), len(self.destination_controllers),
+                "; ".join("{}: {}".format(dest, exc) for dest, exc in self.failed_dests.items())))
+
+    def _report_destination_failed(self, dest, exc):
+        pass
+
+
+# It syncs a single destination of FanOutController with the plan built by it
+class DestinationController(Controller):
+    def __init__(self, fan_out_controller, file_copier, dest):
+        Controller.__init__(self, file_copier, [], fan_out_controller.output_format, fan_out_controller.output_bitrate, None, fan_out_controller.use_sync_manifest, fan_out_controller.verify_sync_manifest,
+            fan_out_controller.jobs, fan_out_controller._shared_transcode_cache, fan_out_controller.scan_threads, fan_out_controller.mirror, fan_out_controller.max_deletions, None, fan_out_controller.conversion_policy)
+        self.dest = dest
+        self.sync_plan = sync_plan.SyncPlan()
+        self._fan_out_controller = fan_out_controller
+        self.sync_stats = fan_out_controller.sync_stats
+        self.file_copier.sync_stats = self.sync_stats
+
+    # The destination listing is needed for sure, so it is made here by the thread of the destination
+    def prepare(self, src):
+        self.file_copier.prepare(self.dest)
+        self._prepare_plan(src, self.dest)
+        if self.sync_manifest is None or self.mirror:
+            self._get_dest_files()
+
+    def plan_song(self, scanned_song, lyrics_files):
+        self._add_song_plan_items(self.sync_plan, scanned_song, lyrics_files, None)
+
+    def plan_deletions(self):
+        self._plan_deletions(self.sync_plan)
+
+    def run(self, can_i_sync):
+        self._run_sync_plan(self.sync_plan, can_i_sync)
+
+    def _get_song_metadata(self, song_path, size=None, mtime_ns=None):
+        return self._fan_out_controller._get_shared_song_metadata(song_path, size, mtime_ns)
+
+
+class FanOutControllerLogProxy(FanOutController, ControllerLogProxy):
+    def __init__(self, file_copiers, filters=[], output_format=None, output_bitrate=None, file_log=False, metadata_index=None, use_sync_manifest=False, verify_sync_manifest=False, jobs=1, transcode_cache=None, scan_threads=scanner.DEFAULT_SCAN_THREADS, mirror=False, max_deletions=DEFAULT_MAX_DELETIONS, conversion_policy=None):
+        FanOutController.__init__(self, file_copiers, filters, output_format, output_bitrate, metadata_index, use_sync_manifest, verify_sync_manifest, jobs, transcode_cache, scan_threads, mirror, max_deletions, conversion_policy)
+        self._init_logger()
+        self._init_console_log()
+        if file_log:
+            self._init_file_log()
+
+    def sync(self, src, dests, can_i_sync=lambda: True):
+        try:
+            self._manage_fan_out_sync(src, dests, can_i_sync)
+        except (FileNotFoundError, file_copiers.FileCopierError) as exc:
+            self.logger.error(str(exc))
+            raise MusicSyncError(str(exc))
+        finally:
+            for destination_controller in self.destination_controllers:
+                destination_controller.logger.info("Copied songs: {}, updated songs: {}, unchanged songs: {}.".format(destination_controller.copied_songs_count, destination_controller.updated_songs_count, destination_controller.unchanged_songs_count))
+        self.logger.info(self.sync_stats.get_summary())
+
+    def plan(self, src, dests, can_i_sync=lambda: True):
+        try:
+            return super().plan(src, dests, can_i_sync)
+        except MusicSyncError as exc:
+            self.logger.error(str(exc))
+            raise
+
+    def _create_destination_controller(self, file_copier, dest):
+        return DestinationControllerLogProxy(self, file_copier, dest)
+
+    def _report_destination_failed(self, dest, exc):
+        self.logger.error("{}: {}".format(dest, exc))
+
+
+# Its messages are written by the logger of FanOutControllerLogProxy with the destination as prefix
+class DestinationControllerLogProxy(DestinationController, ControllerLogProxy):
+    def __init__(self, fan_out_controller, file_copier, dest):
+        DestinationController.__init__(self, fan_out_controller, file_copier, dest)
+        self.logger = DestinationLoggerAdapter(fan_out_controller.logger, {"dest": dest})
+
+
+class DestinationLoggerAdapter(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        return "{}: {}".format(self.extra["dest"], msg), kwargs
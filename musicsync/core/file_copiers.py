@@ -1,84 +1,280 @@
 import os
 import shutil
-import tempfile
-import subprocess
 import abc
+import errno
+import contextlib
+import threading
+import concurrent.futures
+
+import musicsync.core.sync_stats as sync_stats
+
+COPY_BUFFER_SIZE = 1024 * 1024 # Bytes
+PENDING_COPIES_PER_THREAD = 4
+PARTIAL_FILE_SUFFIX = ".musicsync-part" # The files are written with this suffix and renamed only when they are complete
 
 def get_copy_file_function(src_file_path):
-    return lambda dest_dir_path : shutil.copy2(src_file_path, dest_dir_path)
+    return CopyFileFunction(src_file_path)
+
+# It is used for temporary files, which aren't needed anymore after the copy
+def get_move_file_function(src_file_path):
+    return MoveFileFunction(src_file_path)
+
+
+# A copy file function is any callable that writes the file to the path it receives, the following classes
+# also let the copiers read the source file directly when they don't need a local copy of it
+class CopyFileFunction():
+    def __init__(self, src_file_path):
+        self.src_file_path = src_file_path
+
+    def __call__(self, dest_file_path):
+        shutil.copy2(self.src_file_path, dest_file_path)
+
+    # It returns the path of a local file with the same content of the copied one, which exists at least until the end of the sync
+    def get_src_file_path(self):
+        return self.src_file_path
 
 
+class MoveFileFunction(CopyFileFunction):
+    def __call__(self, dest_file_path):
+        shutil.move(self.src_file_path, dest_file_path)
+
+    def get_src_file_path(self):
+        return None # The source file is removed after the copy
+
+
+# The copiers write every file with a temporary name and rename it when it is complete, so an interrupted sync never
+# leaves a truncated file at the destination path
 class FileCopier():
-    @abc.abstractmethod
-    def copy(self, copy_file_function, dest_file_path):
+    concurrent_transfers_flag = True # False if transfer can't be called by several threads at the same time
+    deferred_transfers_flag = False # True if the transferred files can be written only by the next flush call
+    sync_stats = None # SyncStats of the running sync, set by the controller
+
+    def _measure(self, stage, count=1):
+        if self.sync_stats is None:
+            return contextlib.nullcontext()
+        return self.sync_stats.measure(stage, count)
+
+    def _add_transferred_bytes(self, bytes_count):
+        if self.sync_stats is not None:
+            self.sync_stats.add(sync_stats.TRANSFER_STAGE, bytes_count=bytes_count)
+
+    # It is called once before the files are copied to the destination directory
+    def prepare(self, dest_dir_path):
         pass
 
+    # It can be called by any thread to stop the running and the queued transfers, which raise FileCopierError. The
+    # copier can be used again after the next prepare call.
+    def cancel(self):
+        pass
 
-class MSCFileCopier():
+    # The return value is True if the file has been copied (or queued to be copied) and False if it already exists
     def copy(self, copy_file_function, dest_file_path):
-        if os.path.isfile(dest_file_path):
+        if self.exists(dest_file_path):
             return False
+        self.transfer(copy_file_function, dest_file_path)
+        return True
+
+    @abc.abstractmethod
+    def exists(self, dest_file_path):
+        pass
+
+    # It copies the file without checking if it already exists
+    @abc.abstractmethod
+    def transfer(self, copy_file_function, dest_file_path):
+        pass
+
+    # It is called once after the last file has been copied, the copier must complete the queued copies
+    def flush(self):
+        pass
+
+    # It returns None if the file doesn't exist
+    @abc.abstractmethod
+    def read_file(self, dest_file_path):
+        pass
+
+    @abc.abstractmethod
+    def write_file(self, data, dest_file_path):
+        pass
+
+    # It returns a dictionary containing the size and the modification time in nanoseconds of every file in the
+    # directory tree indexed by path
+    @abc.abstractmethod
+    def list_files(self, dest_dir_path):
+        pass
+
+    # The files are removed all together, the ones that don't exist are ignored
+    @abc.abstractmethod
+    def remove_files(self, dest_file_paths):
+        pass
+
+
+class MSCFileCopier(FileCopier):
+    def exists(self, dest_file_path):
+        return os.path.isfile(dest_file_path)
+
+    def transfer(self, copy_file_function, dest_file_path):
         dest_dir_path = os.path.dirname(dest_file_path)
         self._create_directory_if_necessary(dest_dir_path)
-        copy_file_function(dest_file_path)
-        return True
+        with self._measure(sync_stats.TRANSFER_STAGE):
+            self._write_atomically(copy_file_function, dest_file_path)
+        self._add_transferred_bytes(os.path.getsize(dest_file_path))
+
+    def _write_atomically(self, write_function, dest_file_path):
+        partial_file_path = dest_file_path + PARTIAL_FILE_SUFFIX
+        try:
+            write_function(partial_file_path)
+            os.replace(partial_file_path, dest_file_path)
+        except BaseException:
+            if os.path.isfile(partial_file_path):
+                os.unlink(partial_file_path)
+            raise
+
+    def read_file(self, dest_file_path):
+        if not os.path.isfile(dest_file_path):
+            return None
+        with open(dest_file_path, "rb") as dest_file:
+            return dest_file.read()
+
+    def write_file(self, data, dest_file_path):
+        self._create_directory_if_necessary(os.path.dirname(dest_file_path))
+        self._write_atomically(lambda file_path: self._write_data(data, file_path), dest_file_path)
+
+    def _write_data(self, data, file_path):
+        with open(file_path, "wb") as dest_file:
+            dest_file.write(data)
+
+    def list_files(self, dest_dir_path):
+        files_stats = {}
+        for root, _, files in os.walk(dest_dir_path):
+            for filename in files:
+                file_path = os.path.join(root, filename)
+                stat_result = os.stat(file_path)
+                files_stats[file_path] = (stat_result.st_size, stat_result.st_mtime_ns)
+        return files_stats
+
+    def remove_files(self, dest_file_paths):
+        for dest_file_path in dest_file_paths:
+            try:
+                os.unlink(dest_file_path)
+            except FileNotFoundError:
+                pass
 
     def _create_directory_if_necessary(self, dir_path):
         if not os.path.isdir(dir_path):
-            os.makedirs(dir_path)
+            with self._measure(sync_stats.MKDIR_STAGE):
+                os.makedirs(dir_path, exist_ok=True) # Another thread could create it in the meantime
 
 
-class ADBFileCopier():
-    def __init__(self):
-        self._connect_adb_server()
+# It copies several files at the same time, which hides the latency of every single copy on USB drives and network shares.
+# Only the files whose source is available until the end of the sync (see CopyFileFunction.get_src_file_path) are copied by the
+# threads, the others are copied immediately by the calling thread.
+class ParallelMSCFileCopier(MSCFileCopier):
+    concurrent_transfers_flag = False
+    deferred_transfers_flag = True
 
-    def __del__(self):
-        self._disconnect_adb_server()
+    def __init__(self, threads=1):
+        self._threads = threads
+        self._executor = None
+        self._pending_copies = set()
+        self._queued_paths = set()
+        self._created_dir_paths = set()
+        self._lock = threading.Lock()
 
-    def copy(self, copy_file_function, dest_file_path):
-        if os.name == "nt":
-            dest_file_path = self._convert_windows_path_to_unix_path(dest_file_path)
-        if self._adb_does_path_exist(dest_file_path):
-            return False
-        dest_dir_path = os.path.dirname(dest_file_path)
-        self._create_directory_if_necessary(dest_dir_path)
-        # See https://stackoverflow.com/questions/23212435 to understand why temporary_file is deleted manually in the following 4 lines of code
-        with tempfile.NamedTemporaryFile(delete=False) as temporary_file:
-            copy_file_function(temporary_file.name)
-        self._push_file(temporary_file.name, dest_file_path)
-        os.unlink(temporary_file.name) 
-        return True
+    def exists(self, dest_file_path):
+        return dest_file_path in self._queued_paths or super().exists(dest_file_path)
+
+    def transfer(self, copy_file_function, dest_file_path):
+        src_file_path = get_src_file_path(copy_file_function)
+        if src_file_path is None:
+            super().transfer(copy_file_function, dest_file_path)
+        elif self._threads <= 1:
+            self._copy_file(src_file_path, dest_file_path)
+        else:
+            self._queue_copy(src_file_path, dest_file_path)
 
-    def _convert_windows_path_to_unix_path(self, windows_path):
-        return windows_path.replace("\\","/")
+    def _queue_copy(self, src_file_path, dest_file_path):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._threads)
+        if len(self._pending_copies) >= self._threads * PENDING_COPIES_PER_THREAD:
+            done_copies, self._pending_copies = concurrent.futures.wait(self._pending_copies, return_when=concurrent.futures.FIRST_COMPLETED)
+            self._raise_copies_exceptions(done_copies)
+        self._pending_copies.add(self._executor.submit(self._copy_file, src_file_path, dest_file_path))
+        self._queued_paths.add(dest_file_path)
 
-    def _connect_adb_server(self):
-        subprocess.run(["adb", "start-server"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # The queued copies are discarded, while the running ones are completed because every file is copied in a few seconds
+    def cancel(self):
+        for copy in list(self._pending_copies):
+            copy.cancel()
 
-    def _disconnect_adb_server(self):
-        subprocess.run(["adb", "kill-server"], stdout=subprocess.DEVNULL)
+    def flush(self):
+        if self._executor is None:
+            return
+        try:
+            done_copies, _ = concurrent.futures.wait(self._pending_copies)
+            self._raise_copies_exceptions(done_copies)
+        finally:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._pending_copies = set()
+            self._queued_paths = set()
 
-    def _adb_does_path_exist(self, path):
-        return self._get_subprocess_call_stdout_size(["adb", "shell", "find", "${}".format(self._convert_string_to_literal(path))]) != 0
+    def _raise_copies_exceptions(self, done_copies):
+        for copy in done_copies:
+            if copy.cancelled():
+                raise FileCopierError("The copy has been cancelled.")
+            copy.result()
 
-    def _convert_string_to_literal(self, string):
-        return "'{}'".format(string.replace("'","\\'"))
+    def _copy_file(self, src_file_path, dest_file_path):
+        self._create_directory_if_necessary(os.path.dirname(dest_file_path))
+        with self._measure(sync_stats.TRANSFER_STAGE):
+            self._write_atomically(lambda file_path: self._copy_file_with_stat(src_file_path, file_path), dest_file_path)
+        self._add_transferred_bytes(os.path.getsize(dest_file_path))
 
-    def _get_subprocess_call_stdout_size(self, args):
-        popen = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout_str, stderr_str = popen.communicate()
-        self._verify_device_connection(stderr_str)
-        return len(stdout_str)
+    def _copy_file_with_stat(self, src_file_path, dest_file_path):
+        with open(src_file_path, "rb") as src_file, open(dest_file_path, "wb") as dest_file:
+            self._copy_file_content(src_file, dest_file)
+        shutil.copystat(src_file_path, dest_file_path)
+
+    def _copy_file_content(self, src_file, dest_file):
+        # copy_file_range copies the data inside the kernel, but it isn't supported by every platform and file system
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(src_file.fileno(), dest_file.fileno(), COPY_BUFFER_SIZE * 64) > 0:
+                    pass
+                return
+            except OSError as exc:
+                if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP) or dest_file.tell() != 0:
+                    raise
+        shutil.copyfileobj(src_file, dest_file, COPY_BUFFER_SIZE)
 
     def _create_directory_if_necessary(self, dir_path):
-        subprocess.run(["adb", "shell", "mkdir", "-p", "${}".format(self._convert_string_to_literal(dir_path))], stdout=subprocess.DEVNULL)
+        if dir_path in self._created_dir_paths:
+            return
+        with self._measure(sync_stats.MKDIR_STAGE):
+            os.makedirs(dir_path, exist_ok=True)
+        with self._lock:
+            self._created_dir_paths.add(dir_path)
+
+
+# The ADB copiers are imported only by the syncs that use them, see adb_file_copiers
+def __getattr__(name):
+    if name in ("ADBFileCopier", "BatchADBFileCopier", "TarADBFileCopier"):
+        import musicsync.core.adb_file_copiers as adb_file_copiers
+        return getattr(adb_file_copiers, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-    def _push_file(self, src_file_path, dest_file_path):
-        subprocess.run(["adb", "push", src_file_path, dest_file_path], stdout=subprocess.DEVNULL)
+def get_src_file_path(copy_file_function):
+    get_src_file_path = getattr(copy_file_function, "get_src_file_path", None)
+    if get_src_file_path is not None:
+        return get_src_file_path()
+    return None
 
-    def _verify_device_connection(self, stderr_str):
-        if ((b"no devices/emulators found" in stderr_str) or (b"device unauthorized" in stderr_str)):
-            raise FileCopierError("The device is not connected correctly.")
+# A stream function receives the arguments of a command and writes the file to its standard input
+def get_stream_function(copy_file_function):
+    get_stream_function = getattr(copy_file_function, "get_stream_function", None)
+    if get_stream_function is not None:
+        return get_stream_function()
+    return None
 
 
 class FileCopierError(RuntimeError):
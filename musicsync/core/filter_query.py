@@ -0,0 +1,239 @@
+import os
+import re
+import operator
+
+# A query is a boolean expression over the song fields, for example:
+#     (rating >= 4 or genre ~ "Jazz") and year >= 1990
+# The comparison operators are ==, !=, <, <=, >, >= and ~ (the string contains the value, ignoring the case), the
+# string comparisons ignore the case and the multi-value fields (genre and artist) match if one of their values does.
+FILE_FIELDS = ("path", "extension", "size") # Fields known from the scan of the source, without reading the song tags
+TAG_FIELDS = ("rating", "year", "genre", "artist", "duration")
+NUMBER_FIELDS = ("size", "rating", "year", "duration")
+SIZE_MULTIPLIERS = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+_TOKEN_REGEX = re.compile(r"""
+    \s*(?:
+        (?P<number>\d+(?:\.\d+)?[kKmMgG]?)(?![\w.])|
+        (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|
+        (?P<operator>==|!=|<=|>=|<|>|~|=)|
+        (?P<parenthesis>[()])|
+        (?P<word>[A-Za-z_]\w*)
+    )""", re.VERBOSE)
+_COMPARISON_OPERATORS = {
+    "==": operator.eq,
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "~": lambda value, searched_value: searched_value in value,
+}
+_KEYWORDS = ("and", "or", "not")
+_UNKNOWN = object() # Value of the tag fields while only the file fields are known
+
+
+# The query is parsed only once: the returned predicate gets a record and returns True, False or None if the result
+# depends on fields that the record doesn't know yet
+def compile_query(query):
+    parser = _Parser(_tokenize(query))
+    predicate, _ = parser.parse()
+    return predicate
+
+def _tokenize(query):
+    tokens = []
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = _TOKEN_REGEX.match(query, position)
+        if match is None:
+            character_position = len(query) - len(query[position:].lstrip())
+            raise FilterQueryError("Unexpected \"{}\" at position {} of the filter query.".format(query[character_position], character_position))
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        position = match.end()
+    return tokens
+
+
+class FileRecord():
+    __slots__ = ("_path", "_size")
+
+    def __init__(self, path, size):
+        self._path = path
+        self._size = size
+
+    def get_field(self, field):
+        if field == "path":
+            return self._path
+        elif field == "extension":
+            return os.path.splitext(self._path)[1][1:]
+        elif field == "size":
+            return self._size
+        return _UNKNOWN
+
+
+class SongRecord(FileRecord):
+    __slots__ = ("_song_metadata",)
+
+    def __init__(self, song_metadata, size=None):
+        super().__init__(song_metadata.path, size)
+        self._song_metadata = song_metadata
+
+    def get_field(self, field):
+        if field == "size" and self._size is None:
+            self._size = _get_file_size(self._path)
+        if field in TAG_FIELDS:
+            return getattr(self._song_metadata, field)
+        return super().get_field(field)
+
+
+def _get_file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+# Recursive descent parser of the grammar:
+#     expression := and_expression ("or" and_expression)*
+#     and_expression := not_expression ("and" not_expression)*
+#     not_expression := "not" not_expression | "(" expression ")" | field operator value
+# Every parse method returns the compiled predicate and its cost, used to evaluate the cheap checks first.
+class _Parser():
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._position = 0
+
+    def parse(self):
+        if not self._tokens:
+            raise FilterQueryError("The filter query is empty.")
+        result = self._parse_expression()
+        if self._position < len(self._tokens):
+            raise FilterQueryError("Unexpected \"{}\" in the filter query.".format(self._tokens[self._position][1]))
+        return result
+
+    def _parse_expression(self):
+        operands = [self._parse_and_expression()]
+        while self._accept_keyword("or"):
+            operands.append(self._parse_and_expression())
+        return _compile_or(operands) if len(operands) > 1 else operands[0]
+
+    def _parse_and_expression(self):
+        operands = [self._parse_not_expression()]
+        while self._accept_keyword("and"):
+            operands.append(self._parse_not_expression())
+        return _compile_and(operands) if len(operands) > 1 else operands[0]
+
+    def _parse_not_expression(self):
+        if self._accept_keyword("not"):
+            return _compile_not(self._parse_not_expression())
+        if self._accept("parenthesis", "("):
+            result = self._parse_expression()
+            if not self._accept("parenthesis", ")"):
+                raise FilterQueryError("Missing \")\" in the filter query.")
+            return result
+        return self._parse_comparison()
+
+    def _parse_comparison(self):
+        field = self._expect("word", "a field").lower()
+        if field not in FILE_FIELDS + TAG_FIELDS:
+            raise FilterQueryError("Unknown field \"{}\" in the filter query, valid fields: {}.".format(field, ", ".join(FILE_FIELDS + TAG_FIELDS)))
+        operator_symbol = self._expect("operator", "an operator")
+        token_type, token_value = self._next("a value")
+        if field in NUMBER_FIELDS:
+            if token_type != "number" or operator_symbol == "~":
+                raise FilterQueryError("The field \"{}\" must be compared with a number.".format(field))
+            value = _parse_number(token_value)
+        else:
+            if token_type not in ("string", "word", "number") or token_value in _KEYWORDS:
+                raise FilterQueryError("The field \"{}\" must be compared with a string.".format(field))
+            value = _parse_string(token_value) if token_type == "string" else token_value
+            value = value.casefold()
+        cost = 0 if field in FILE_FIELDS else 1
+        return (_compile_comparison(field, _COMPARISON_OPERATORS[operator_symbol], value), cost)
+
+    def _accept_keyword(self, keyword):
+        if self._position < len(self._tokens) and self._tokens[self._position][0] == "word" and self._tokens[self._position][1].lower() == keyword:
+            self._position += 1
+            return True
+        return False
+
+    def _accept(self, token_type, token_value):
+        if self._position < len(self._tokens) and self._tokens[self._position] == (token_type, token_value):
+            self._position += 1
+            return True
+        return False
+
+    def _expect(self, token_type, description):
+        next_token_type, next_token_value = self._next(description)
+        if next_token_type != token_type:
+            raise FilterQueryError("Expected {} instead of \"{}\" in the filter query.".format(description, next_token_value))
+        return next_token_value
+
+    def _next(self, description):
+        if self._position >= len(self._tokens):
+            raise FilterQueryError("Expected {} at the end of the filter query.".format(description))
+        token = self._tokens[self._position]
+        self._position += 1
+        return token
+
+
+def _parse_number(text):
+    multiplier = SIZE_MULTIPLIERS.get(text[-1].lower())
+    if multiplier is not None:
+        return float(text[:-1]) * multiplier
+    return float(text)
+
+def _parse_string(text):
+    return re.sub(r"\\(.)", r"\1", text[1:-1])
+
+def _compile_comparison(field, compare, value):
+    def predicate(record):
+        field_value = record.get_field(field)
+        if field_value is _UNKNOWN:
+            return None
+        if field_value is None: # Like the other filters, songs without the field never match
+            return False
+        if isinstance(field_value, (list, tuple)):
+            return any(compare(current_value.casefold(), value) for current_value in field_value)
+        if isinstance(field_value, str):
+            return compare(field_value.casefold(), value)
+        return compare(field_value, value)
+    return predicate
+
+# The operands are evaluated from the cheapest one, the and and or results are None only if no operand decides them
+def _compile_and(operands):
+    predicates = [predicate for predicate, _ in sorted(operands, key=lambda operand: operand[1])]
+    def predicate(record):
+        result = True
+        for current_predicate in predicates:
+            current_result = current_predicate(record)
+            if current_result is False:
+                return False
+            if current_result is None:
+                result = None
+        return result
+    return (predicate, max(cost for _, cost in operands))
+
+def _compile_or(operands):
+    predicates = [predicate for predicate, _ in sorted(operands, key=lambda operand: operand[1])]
+    def predicate(record):
+        result = False
+        for current_predicate in predicates:
+            current_result = current_predicate(record)
+            if current_result is True:
+                return True
+            if current_result is None:
+                result = None
+        return result
+    return (predicate, max(cost for _, cost in operands))
+
+def _compile_not(operand):
+    operand_predicate, cost = operand
+    def predicate(record):
+        result = operand_predicate(record)
+        return None if result is None else not result
+    return (predicate, cost)
+
+
+class FilterQueryError(ValueError):
+    pass
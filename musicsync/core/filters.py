@@ -1,6 +1,11 @@
+import re
 import abc
+import unicodedata
 
-from musicsync.core.songs_metadata import get_rating, get_year, get_genre, get_artist, NoGettableMetadata
+import musicsync.core.filter_query as filter_query
+from musicsync.core.songs_metadata import get_song_metadata, NoGettableMetadata
+
+TAG_VALUES_SEPARATORS_REGEX = re.compile(r"[;/,]")
 
 
 def _check_interval(value, minimum, maximum):
@@ -14,14 +19,55 @@ def _check_interval(value, minimum, maximum):
         maximum_check = value <= maximum
     return minimum_check and maximum_check
 
+# Different spellings of the same name, like "Beyoncé" written with a combining accent or "BEYONCÉ", are equal after
+# the normalization
+def _normalize_tag_value(value):
+    return unicodedata.normalize("NFKC", value).casefold().strip()
+
+# Many taggers store multiple values in a single one, like "Rock; Pop" or "Artist1/Artist2", so the tokens contain
+# both every whole value and its parts
+def _get_tag_tokens(values):
+    tokens = set()
+    for value in values:
+        tokens.add(_normalize_tag_value(value))
+        tokens.update(_normalize_tag_value(part) for part in TAG_VALUES_SEPARATORS_REGEX.split(value))
+    return tokens
+
 
 class Filter:
     @abc.abstractmethod
     def check(self, song_path):
         pass
 
+    # The Controller reads the metadata of every song only once and passes it to all the filters, subclasses
+    # that don't need it can only implement check
+    def check_metadata(self, song_metadata):
+        return self.check(song_metadata.path)
+
+    # The Controller calls it before reading the metadata: it returns True or False if the file path and size are
+    # enough to check the song, None otherwise
+    def check_file(self, file_path, size):
+        return None
+
+    # The settings that decide which songs pass the filter, saved by the sync journal: an interrupted plan is resumed
+    # only with the same filters. They must be JSON values.
+    def get_settings(self):
+        return {"filter": type(self).__name__}
+
+
+class MetadataFilter(Filter):
+    def check(self, song_path):
+        try:
+            return self.check_metadata(get_song_metadata(song_path))
+        except NoGettableMetadata:
+            return False
+
+    @abc.abstractmethod
+    def check_metadata(self, song_metadata):
+        pass
+
 
-class RatingFilter(Filter):
+class RatingFilter(MetadataFilter):
     def __init__(self, minimum_rating=None, maximum_rating=None):
         self._minimum_rating = minimum_rating
         self._maximum_rating = maximum_rating
@@ -32,15 +78,14 @@ class RatingFilter(Filter):
     def set_maximum_rating(self, maximum_rating):
         self._maximum_rating = maximum_rating
 
-    def check(self, song_path):
-        try:
-            song_rating = get_rating(song_path)
-            return _check_interval(song_rating, self._minimum_rating, self._maximum_rating)
-        except NoGettableMetadata:
-            return False
+    def check_metadata(self, song_metadata):
+        return _check_interval(song_metadata.rating, self._minimum_rating, self._maximum_rating)
+
+    def get_settings(self):
+        return {"filter": "rating", "minimum": self._minimum_rating, "maximum": self._maximum_rating}
 
 
-class YearFilter(Filter):
+class YearFilter(MetadataFilter):
     def __init__(self, minimum_year=None, maximum_year=None):
         self._minimum_year = minimum_year
         self._maximum_year = maximum_year
@@ -51,32 +96,52 @@ class YearFilter(Filter):
     def set_maximum_year(self, maximum_year):
         self._maximum_year = maximum_year
 
-    def check(self, song_path):
-        try:
-            song_year = get_year(song_path)
-            return _check_interval(song_year, self._minimum_year, self._maximum_year)
-        except NoGettableMetadata:
-            return False
+    def check_metadata(self, song_metadata):
+        return _check_interval(song_metadata.year, self._minimum_year, self._maximum_year)
+
+    def get_settings(self):
+        return {"filter": "year", "minimum": self._minimum_year, "maximum": self._maximum_year}
 
 
-class GenreFilter(Filter):
+class GenreFilter(MetadataFilter):
     def __init__(self, genres):
-        self._genres = genres
+        self._genres = frozenset(_normalize_tag_value(genre) for genre in genres)
 
-    def check(self, song_path):
-        try:
-            song_genre = get_genre(song_path)
-            return any(current_genre in song_genre for current_genre in self._genres)
-        except NoGettableMetadata:
+    def check_metadata(self, song_metadata):
+        song_genre = song_metadata.genre
+        if song_genre is None:
             return False
+        return not self._genres.isdisjoint(_get_tag_tokens(song_genre))
+
+    def get_settings(self):
+        return {"filter": "genre", "genres": sorted(self._genres)}
+
 
-class ArtistFilter(Filter):
+class ArtistFilter(MetadataFilter):
     def __init__(self, artists):
-        self._artists = artists
-    
-    def check(self, song_path):
-        try:
-            song_artist = get_artist(song_path)
-            return any(current_artist in song_artist for current_artist in self._artists)
-        except NoGettableMetadata:
+        self._artists = frozenset(_normalize_tag_value(artist) for artist in artists)
+
+    def check_metadata(self, song_metadata):
+        song_artist = song_metadata.artist
+        if song_artist is None:
             return False
+        return not self._artists.isdisjoint(_get_tag_tokens(song_artist))
+
+    def get_settings(self):
+        return {"filter": "artist", "artists": sorted(self._artists)}
+
+
+# It checks the songs with a filter query, see filter_query.py for the syntax
+class QueryFilter(MetadataFilter):
+    def __init__(self, query):
+        self._query = query
+        self._predicate = filter_query.compile_query(query)
+
+    def check_file(self, file_path, size):
+        return self._predicate(filter_query.FileRecord(file_path, size))
+
+    def check_metadata(self, song_metadata):
+        return self._predicate(filter_query.SongRecord(song_metadata)) is True
+
+    def get_settings(self):
+        return {"filter": "query", "query": self._query}
@@ -1,25 +1,86 @@
+import shutil
 import warnings
+import functools
+import subprocess
 
-# pydub raises a warning during import if it couldn't find ffmpeg or avconv (programs used to convert
-# audio files to another format), the following lines set ffmpeg__and_avconv_not_found_flag to True in that case
-# without raising warning or exceptions not to have to handle them in the import format_conversion statement in
-# other modules. In this way, the other modules have to handle this exception only if pydub is effectively used.
-ffmpeg__and_avconv_not_found_flag = False
-with warnings.catch_warnings(record=True) as w:
-    warnings.filterwarnings(action="always", message="Couldn't find ffmpeg or avconv", category=RuntimeWarning)
-    import pydub
-    if len(w) > 0:
-        ffmpeg__and_avconv_not_found_flag = True
-
-def _raise_exception_if_converter_does_not_work():
+FFMPEG_MUXERS = {"aac": "adts", "m4a": "ipod"} # Output formats whose ffmpeg muxer has a different name
+COVER_ART_FORMATS = ("mp3", "flac", "m4a") # Output formats that can store the cover art as an attached picture
+STREAMABLE_FORMATS = ("mp3", "opus", "ogg", "aac") # Output formats that ffmpeg can write to a pipe without seeking back to fix the header
+
+@functools.lru_cache(maxsize=None)
+def _get_ffmpeg_path():
+    return shutil.which("ffmpeg")
+
+# pydub is imported only when a song is converted without ffmpeg, which is rare and slow to import. It raises a warning
+# during import if it couldn't find ffmpeg or avconv (programs used to convert audio files to another format): the
+# warning is turned into FormatConverterNotFound, which the callers have to handle only if pydub is effectively used.
+@functools.lru_cache(maxsize=None)
+def _import_pydub():
+    with warnings.catch_warnings(record=True) as w:
+        warnings.filterwarnings(action="always", message="Couldn't find ffmpeg or avconv", category=RuntimeWarning)
+        import pydub
+        import pydub.utils
+        import pydub.exceptions
+    return (pydub, len(w) > 0)
+
+def _raise_exception_if_converter_does_not_work(ffmpeg__and_avconv_not_found_flag):
     if ffmpeg__and_avconv_not_found_flag:
         raise FormatConverterNotFound("Couldn't find ffmpeg or avconv.")
 
 def get_convert_song_function(input_filename, format, bitrate=None):
-    return lambda output_filename : convert_song(input_filename, output_filename, format, bitrate)
+    return ConvertSongFunction(input_filename, format, bitrate)
 
 def convert_song(input_filename, output_filename, format, bitrate=None):
-    _raise_exception_if_converter_does_not_work()
+    if _get_ffmpeg_path() is not None:
+        _convert_song_with_ffmpeg(input_filename, output_filename, format, bitrate)
+    else:
+        _convert_song_with_pydub(input_filename, output_filename, format, bitrate)
+
+# ffmpeg reads and writes the song in small chunks, so the used memory doesn't depend on the song length
+def _convert_song_with_ffmpeg(input_filename, output_filename, format, bitrate=None):
+    completed_process = subprocess.run(_get_ffmpeg_args(input_filename, output_filename, format, bitrate), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if completed_process.returncode != 0:
+        raise FormatConvertersionError("Output file encording failed: {}".format(completed_process.stderr.decode("utf-8", "replace").strip()))
+
+def _get_ffmpeg_args(input_filename, output_filename, format, bitrate=None):
+    args = [_get_ffmpeg_path(), "-nostdin", "-y", "-v", "error", "-i", input_filename, "-map", "0:a", "-map_metadata", "0"]
+    if format in COVER_ART_FORMATS:
+        args += ["-map", "0:v?", "-c:v", "copy"]
+    if bitrate is not None:
+        args += ["-b:a", bitrate]
+    return args + ["-f", FFMPEG_MUXERS.get(format, format), output_filename]
+
+# The ffmpeg process is killed as soon as the task running the conversion is cancelled
+async def convert_song_async(input_filename, output_filename, format, bitrate=None):
+    import asyncio # Only the asyncio engine uses it, so the other runs don't import it
+    if _get_ffmpeg_path() is None:
+        await asyncio.get_running_loop().run_in_executor(None, _convert_song_with_pydub, input_filename, output_filename, format, bitrate)
+        return
+    process = await asyncio.create_subprocess_exec(*_get_ffmpeg_args(input_filename, output_filename, format, bitrate), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise FormatConvertersionError("Output file encording failed: {}".format(stderr.decode("utf-8", "replace").strip()))
+
+# The converted song is written to the standard input of the process started with consumer_args while it is encoded
+def stream_converted_song(input_filename, consumer_args, format, bitrate=None):
+    ffmpeg_process = subprocess.Popen(_get_ffmpeg_args(input_filename, "pipe:1", format, bitrate), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    consumer_process = subprocess.Popen(consumer_args, stdin=ffmpeg_process.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    ffmpeg_process.stdout.close() # The consumer must receive EOF when ffmpeg exits
+    _, consumer_stderr = consumer_process.communicate()
+    _, ffmpeg_stderr = ffmpeg_process.communicate()
+    if ffmpeg_process.returncode != 0:
+        raise FormatConvertersionError("Output file encording failed: {}".format(ffmpeg_stderr.decode("utf-8", "replace").strip()))
+    if consumer_process.returncode != 0:
+        raise OSError("Converted song writing failed: {}".format(consumer_stderr.decode("utf-8", "replace").strip()))
+
+def _convert_song_with_pydub(input_filename, output_filename, format, bitrate=None):
+    pydub, ffmpeg__and_avconv_not_found_flag = _import_pydub()
+    _raise_exception_if_converter_does_not_work(ffmpeg__and_avconv_not_found_flag)
     song = pydub.AudioSegment.from_file(input_filename)
     try:
         song.export(output_filename, format=format, bitrate=bitrate, tags=pydub.utils.mediainfo(input_filename).get("TAG", {})) # See https://github.com/jiaaro/pydub/issues/44
@@ -27,6 +88,22 @@ def convert_song(input_filename, output_filename, format, bitrate=None):
         raise FormatConvertersionError("Output file encording failed.")
 
 
+class ConvertSongFunction():
+    def __init__(self, input_filename, format, bitrate=None):
+        self.input_filename = input_filename
+        self.format = format
+        self.bitrate = bitrate
+
+    def __call__(self, output_filename):
+        convert_song(self.input_filename, output_filename, self.format, self.bitrate)
+
+    # It returns None if the song can't be converted while it is written
+    def get_stream_function(self):
+        if _get_ffmpeg_path() is None or self.format not in STREAMABLE_FORMATS:
+            return None
+        return lambda consumer_args : stream_converted_song(self.input_filename, consumer_args, self.format, self.bitrate)
+
+
 class FormatConverterNotFound(RuntimeError):
     pass
 
@@ -0,0 +1,94 @@
+import os
+import threading
+
+from musicsync.core.songs_metadata import SongMetadata, get_song_metadata, NoGettableMetadata
+
+SCHEMA_VERSION = 2 # Increase this value after changing the songs table, the old index is dropped and rebuilt
+COMMIT_INTERVAL = 500 # Number of written songs after which the pending changes are committed
+LIST_SEPARATOR = "\0"
+
+def get_default_cache_dir_path():
+    if os.name == "nt":
+        return os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "MusicSync", "Cache")
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "musicsync")
+
+DEFAULT_INDEX_PATH = os.path.join(get_default_cache_dir_path(), "metadata_index.sqlite3")
+
+
+# It stores the metadata of the songs already parsed, a song is parsed again only if its size or its modification time changed.
+# It can be used by several threads: the songs are parsed in parallel, while the database accesses are serialized.
+class MetadataIndex():
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        import sqlite3 # The module is imported by the CLI for its default path, but the index is used only by some syncs
+        self._create_directory_if_necessary(os.path.dirname(path))
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._uncommitted_songs_count = 0
+        self._setup_schema()
+
+    def _create_directory_if_necessary(self, dir_path):
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+    def _setup_schema(self):
+        user_version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        if user_version != SCHEMA_VERSION:
+            self._connection.execute("DROP TABLE IF EXISTS songs")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS songs (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inspectable INTEGER, rating REAL, year INTEGER, genre TEXT, artist TEXT, duration REAL, codec TEXT, bitrate INTEGER)")
+        self._connection.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        self._connection.commit()
+
+    def get_song_metadata(self, song_path, size=None, mtime_ns=None):
+        song_path = os.path.abspath(song_path)
+        if size is None or mtime_ns is None:
+            stat_result = os.stat(song_path)
+            size, mtime_ns = stat_result.st_size, stat_result.st_mtime_ns
+        with self._lock:
+            row = self._connection.execute("SELECT inspectable, rating, year, genre, artist, duration, codec, bitrate FROM songs WHERE path = ? AND size = ? AND mtime_ns = ?", (song_path, size, mtime_ns)).fetchone()
+        if row is None:
+            return self._parse_and_store_song_metadata(song_path, size, mtime_ns)
+        return self._get_song_metadata_from_row(song_path, row)
+
+    def _parse_and_store_song_metadata(self, song_path, size, mtime_ns):
+        try:
+            song_metadata = get_song_metadata(song_path)
+        except NoGettableMetadata:
+            self._store_row((song_path, size, mtime_ns, False, None, None, None, None, None, None, None))
+            raise
+        self._store_row((song_path, size, mtime_ns, True, song_metadata.rating, song_metadata.year, self._join_list(song_metadata.genre), self._join_list(song_metadata.artist), song_metadata.duration, song_metadata.codec, song_metadata.bitrate))
+        return song_metadata
+
+    def _store_row(self, row):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            self._uncommitted_songs_count += 1
+            if self._uncommitted_songs_count >= COMMIT_INTERVAL:
+                self._commit()
+
+    def _get_song_metadata_from_row(self, song_path, row):
+        inspectable, rating, year, genre, artist, duration, codec, bitrate = row
+        if not inspectable:
+            raise NoGettableMetadata("The song wasn't inspectable when it was indexed.")
+        return SongMetadata(song_path, rating, year, self._split_list(genre), self._split_list(artist), duration, codec, bitrate)
+
+    def _join_list(self, values):
+        if values is None:
+            return None
+        return LIST_SEPARATOR.join(values)
+
+    def _split_list(self, joined_values):
+        if joined_values is None:
+            return None
+        return joined_values.split(LIST_SEPARATOR)
+
+    def commit(self):
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        self._connection.commit()
+        self._uncommitted_songs_count = 0
+
+    def close(self):
+        self.commit()
+        self._connection.close()
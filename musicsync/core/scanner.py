@@ -0,0 +1,63 @@
+import os
+import queue
+import concurrent.futures
+
+DEFAULT_SCAN_THREADS = 8 # Directories listed at the same time, useful on network shares where every listing waits for a round trip
+SCANNED_DIRECTORIES_PER_THREAD = 2 # Directories listed ahead of the caller by every thread
+
+
+# Slotted, because a large library has millions of them
+class ScannedFile():
+    __slots__ = ("path", "size", "mtime_ns")
+
+    def __init__(self, path, size, mtime_ns):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+
+
+# It yields the list of the files with one of the given extensions of every directory in the tree, while the next
+# directories are still being listed by the threads. The order of the directories is not defined. Only a few
+# directories are listed ahead of the caller, otherwise the files of a large library would pile up in the results while
+# the caller plans the first songs; the directories still to list are kept as a stack of paths.
+def scan_directories(root_path, extensions, threads=DEFAULT_SCAN_THREADS):
+    extensions = tuple(extension.lower() for extension in extensions)
+    results = queue.Queue()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    try:
+        unlisted_dir_paths = [root_path]
+        listing_directories_count = 0 # Submitted directories whose result hasn't been taken yet
+        while unlisted_dir_paths or listing_directories_count > 0:
+            while unlisted_dir_paths and listing_directories_count < threads * SCANNED_DIRECTORIES_PER_THREAD:
+                executor.submit(_scan_directory, unlisted_dir_paths.pop(), extensions, results)
+                listing_directories_count += 1
+            subdir_paths, scanned_files = results.get()
+            listing_directories_count -= 1
+            unlisted_dir_paths.extend(reversed(subdir_paths))
+            if scanned_files:
+                yield scanned_files
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def _scan_directory(dir_path, extensions, results):
+    subdir_paths = []
+    scanned_files = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                _scan_entry(entry, extensions, subdir_paths, scanned_files)
+    except OSError:
+        pass # Like os.walk, directories that can't be listed are skipped
+    finally:
+        results.put((subdir_paths, sorted(scanned_files, key=lambda scanned_file: scanned_file.path)))
+
+def _scan_entry(entry, extensions, subdir_paths, scanned_files):
+    try:
+        if entry.is_dir():
+            if not entry.is_symlink(): # Like os.walk, symbolic links to directories aren't followed
+                subdir_paths.append(entry.path)
+        elif entry.name.lower().endswith(extensions): # The extension is checked before getting the file stats
+            stat_result = entry.stat()
+            scanned_files.append(ScannedFile(entry.path, stat_result.st_size, stat_result.st_mtime_ns))
+    except OSError:
+        pass
@@ -1,14 +1,67 @@
-import mutagen
+import os
+import sys
 
-def get_rating(song_path):
-    if song_path.endswith(".mp3"):
-        return _get_mp3_rating(song_path)
-    elif song_path.endswith(".flac"):
-        return _get_flac_rating(song_path)
+
+# A library has millions of songs but only a few thousands artists and genres: their values are interned, so the songs
+# of the same artist share the same strings
+class SongMetadata():
+    __slots__ = ("path", "rating", "year", "genre", "artist", "duration", "codec", "bitrate")
+
+    def __init__(self, path, rating=None, year=None, genre=None, artist=None, duration=None, codec=None, bitrate=None):
+        self.path = path
+        self.rating = rating
+        self.year = year
+        self.genre = intern_values(genre)
+        self.artist = intern_values(artist)
+        self.duration = duration
+        self.codec = codec
+        self.bitrate = bitrate # Bits per second of the audio stream
+
+
+def intern_values(values):
+    if values is None:
+        return None
+    return tuple(sys.intern(str(value)) for value in values)
+
+
+# The song file is parsed only once, every field of the returned SongMetadata comes from the same mutagen object
+def get_song_metadata(song_path):
+    song = _get_mutagen_song(song_path)
+    extension = os.path.splitext(song_path)[1].lower() # The scanner accepts the extensions in any case
+    if extension == ".mp3":
+        return _get_mp3_song_metadata(song_path, song)
+    elif extension == ".flac":
+        return _get_flac_song_metadata(song_path, song)
+    return SongMetadata(song_path, duration=_get_duration(song), bitrate=_get_bitrate(song))
+
+# mutagen is imported when the first song is parsed, so the syncs that don't read any tag don't import it
+def _get_mutagen_song(song_path):
+    import mutagen
+    try:
+        song = mutagen.File(song_path)
+    except mutagen.MutagenError as exc:
+        raise NoGettableMetadata(str(exc))
+    if song is None:
+        raise NoGettableMetadata("Unknown file type.")
+    return song
+
+def _get_duration(song):
+    if song.info is not None:
+        return song.info.length
+    return None
+
+# mutagen computes the bitrate from the stream headers, it is 0 when it is unknown
+def _get_bitrate(song):
+    if song.info is not None and getattr(song.info, "bitrate", 0):
+        return song.info.bitrate
     return None
 
-def _get_mp3_rating(song_path):
-    id3 = mutagen.id3.ID3(song_path)
+def _get_mp3_song_metadata(song_path, song):
+    import mutagen.id3
+    id3 = song.tags if song.tags is not None else mutagen.id3.ID3()
+    return SongMetadata(song_path, _get_mp3_rating(id3), _get_mp3_year(id3), _get_mp3_genre(id3), _get_id3_text(id3, "TPE1"), _get_duration(song), "mp3", _get_bitrate(song))
+
+def _get_mp3_rating(id3):
     popm_key = _get_first_popm_key(id3.keys())
     if popm_key:
         popm = id3.get(popm_key)
@@ -22,46 +75,64 @@ def _get_first_popm_key(str_list):
             return key
     return None
 
-def _get_flac_rating(song_path):
-    song = _get_mutagen_song(song_path)
+def _get_mp3_year(id3):
+    date_list = _get_id3_text(id3, "TDRC")
+    if date_list:
+        return _parse_year(str(date_list[0]))
+    return None
+
+def _get_mp3_genre(id3):
+    if "TCON" in id3:
+        return id3["TCON"].genres
+    return None
+
+def _get_id3_text(id3, frame_id):
+    if frame_id in id3:
+        return list(id3[frame_id].text)
+    return None
+
+def _get_flac_song_metadata(song_path, song):
+    return SongMetadata(song_path, _get_flac_rating(song), _get_flac_year(song), song.get("genre"), song.get("artist"), _get_duration(song), "flac", _get_bitrate(song))
+
+def _get_flac_rating(song):
     rating_list = song.get("rating")
     if rating_list:
         rating = int(rating_list[0]) / 20.0
         return rating
     return None
 
-def _get_mutagen_song(song_path):
+def _get_flac_year(song):
+    year_list = song.get("year")
+    if year_list:
+        return _parse_year(year_list[0])
+    date_list = song.get("date")
+    if date_list:
+        return _parse_year(date_list[0])
+    return None
+
+def _parse_year(date_string):
     try:
-        return mutagen.File(song_path, easy=True)
-    except (mutagen.mp3.HeaderNotFoundError, mutagen.flac.error) as exc:
-        raise NoGettableMetadata(str(exc))
+        return int(date_string.split('-')[0])
+    except ValueError:
+        return None
 
 
-def get_year(song_path):
-    song = _get_mutagen_song(song_path)
-    try:
-        return int(song["year"][0])
-    except KeyError:
-        pass
-    try:
-        return int(song["date"][0].split('-')[0])
-    except KeyError:
-        pass
+def get_rating(song_path):
+    if song_path.endswith((".mp3", ".flac")):
+        return get_song_metadata(song_path).rating
     return None
 
 
+def get_year(song_path):
+    return get_song_metadata(song_path).year
+
+
 def get_artist(song_path):
-    song = _get_mutagen_song(song_path)
-    if "artist" in song:
-        return song["artist"]
-    return None
+    return get_song_metadata(song_path).artist
 
 
 def get_genre(song_path):
-    song = _get_mutagen_song(song_path)
-    if "genre" in song:
-        return song["genre"]
-    return None
+    return get_song_metadata(song_path).genre
 
 
 class NoGettableMetadata(RuntimeError):
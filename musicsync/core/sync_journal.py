@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+import threading
+
+import musicsync.core.sync_plan as sync_plan
+from musicsync.core.metadata_index import get_default_cache_dir_path
+
+DEFAULT_JOURNAL_DIR_PATH = os.path.join(get_default_cache_dir_path(), "journals")
+JOURNAL_VERSION = 1
+
+
+# It records the plan of a sync and the plan items completed so far, one JSON object per line, so an interrupted sync
+# can be resumed without scanning the source and checking the filters again. Every source and destination pair has
+# its own journal file, which is removed when the sync ends.
+class SyncJournal():
+    def __init__(self, dir_path=DEFAULT_JOURNAL_DIR_PATH):
+        self._dir_path = dir_path
+        self._file = None
+        self._indexes = {} # id of the plan item -> index of the plan item in the journal
+        self._items_count = 0
+        self._lock = threading.Lock() # The asyncio engine completes the transfers in several threads
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+    # It returns the plan of the interrupted sync without its completed items and the completed items, or None if
+    # there isn't an interrupted sync with the same settings
+    def load(self, src, dest, settings):
+        journal_path = self._get_journal_path(src, dest)
+        if not os.path.isfile(journal_path):
+            return None
+        try:
+            plan_items, done_indexes = self._read_journal(journal_path, src, dest, settings)
+        except (ValueError, KeyError):
+            return None
+        if plan_items is None:
+            return None
+        plan = sync_plan.SyncPlan()
+        done_plan_items = []
+        self._indexes = {}
+        self._items_count = len(plan_items)
+        for index, plan_item in enumerate(plan_items):
+            self._indexes[id(plan_item)] = index
+            if index in done_indexes:
+                done_plan_items.append(plan_item)
+            else:
+                plan.add_item(plan_item)
+        self._open(journal_path, "a")
+        return (plan, done_plan_items)
+
+    def _read_journal(self, journal_path, src, dest, settings):
+        plan_items = []
+        done_indexes = set()
+        planned_flag = False
+        with open(journal_path, "r", encoding="utf-8") as journal_file:
+            header = json.loads(journal_file.readline())
+            if header != self._get_header(src, dest, settings):
+                return (None, None)
+            for line in journal_file:
+                if not line.endswith("\n"):
+                    break # The last line was being written when the sync was interrupted
+                record = json.loads(line)
+                if "item" in record:
+                    plan_items.append(sync_plan.PlanItem.from_dict(record["item"]))
+                elif "planned" in record:
+                    planned_flag = True
+                elif "done" in record:
+                    done_indexes.add(record["done"])
+        if not planned_flag:
+            return (None, None) # The sync was interrupted while it was planned
+        return (plan_items, done_indexes)
+
+    # The plan items can be added while the sync is running, but the sync can be resumed only after complete_planning
+    def start(self, src, dest, settings):
+        self._open(self._get_journal_path(src, dest), "w")
+        self._indexes = {}
+        self._items_count = 0
+        self._write_record(self._get_header(src, dest, settings))
+
+    def add_items(self, plan_items):
+        with self._lock:
+            for plan_item in plan_items:
+                self._indexes[id(plan_item)] = self._items_count
+                self._items_count += 1
+                self._write_record({"item": plan_item.to_dict()})
+
+    def complete_planning(self):
+        with self._lock:
+            self._write_record({"planned": True})
+            self._file.flush()
+
+    def add_done_items(self, plan_items):
+        with self._lock:
+            for plan_item in plan_items:
+                self._write_record({"done": self._indexes[id(plan_item)]})
+            self._file.flush()
+
+    # It is called when the sync ends, an interrupted sync keeps its journal
+    def finish(self, src, dest):
+        self.close()
+        journal_path = self._get_journal_path(src, dest)
+        if os.path.isfile(journal_path):
+            os.unlink(journal_path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self, journal_path, mode):
+        self.close()
+        self._file = open(journal_path, mode, encoding="utf-8")
+
+    def _write_record(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _get_header(self, src, dest, settings):
+        return {"version": JOURNAL_VERSION, "src": os.path.abspath(src), "dest": dest, "settings": settings}
+
+    def _get_journal_path(self, src, dest):
+        key = "\0".join((os.path.abspath(src), dest))
+        return os.path.join(self._dir_path, hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest() + ".jsonl")
@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import posixpath
+
+MANIFEST_FILENAME = ".musicsync_manifest.json"
+MANIFEST_VERSION = 1
+SYNCED_STATE = "synced"
+CHANGED_STATE = "changed" # The source file or the encoder settings changed after the last sync
+UNKNOWN_STATE = "unknown"
+
+
+def load_sync_manifest(file_copier, dest):
+    entries = _parse_entries(file_copier.read_file(os.path.join(dest, MANIFEST_FILENAME)))
+    return SyncManifest(file_copier, dest, entries)
+
+# The entries are created while the JSON is decoded, so the dicts of the whole manifest are never in memory together
+# with its entries
+def _parse_entries(data):
+    if data is None:
+        return {}
+    try:
+        manifest = json.loads(data.decode("utf-8"), object_hook=_decode_entry)
+    except (ValueError, KeyError, TypeError):
+        return {}
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    entries = manifest.get("files", {})
+    if not isinstance(entries, dict) or not all(isinstance(entry, ManifestEntry) for entry in entries.values()):
+        return {}
+    return entries
+
+# The objects with an integer mtime_ns are the entries, the files object and the manifest itself are kept as dicts
+def _decode_entry(entry_dict):
+    if isinstance(entry_dict.get("mtime_ns"), int):
+        return ManifestEntry.from_dict(entry_dict)
+    return entry_dict
+
+
+# An entry of the manifest as it is kept in memory. The encoder settings are the same for almost every entry, so their
+# strings are interned.
+class ManifestEntry():
+    __slots__ = ("src", "size", "mtime_ns", "format", "bitrate")
+
+    def __init__(self, src, size, mtime_ns, output_format=None, output_bitrate=None):
+        self.src = src
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.format = _intern(output_format)
+        self.bitrate = _intern(output_bitrate)
+
+    def to_dict(self):
+        return {"src": self.src, "size": self.size, "mtime_ns": self.mtime_ns, "format": self.format, "bitrate": self.bitrate}
+
+    @staticmethod
+    def from_dict(entry_dict):
+        return ManifestEntry(entry_dict["src"], entry_dict["size"], entry_dict["mtime_ns"], entry_dict.get("format"), entry_dict.get("bitrate"))
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+# It keeps track of the files synced to the destination, so the Controller can skip them without probing the destination file by file
+class SyncManifest():
+    # The loaded entries are kept as they are, without copying them, the manifest of a large library is big
+    def __init__(self, file_copier, dest, entries=None):
+        self._file_copier = file_copier
+        self._dest = dest
+        self._entries = entries if entries is not None else {}
+        self._listed_paths = None
+        self._changed_flag = False
+
+    # It replaces the recorded entries with the ones of the files that really exist in the destination
+    def rebuild(self):
+        files_stats = self._file_copier.list_files(self._dest)
+        self._listed_paths = set(self._get_relative_path(file_path) for file_path in files_stats)
+        self._entries = {path: entry for path, entry in self._entries.items() if path in self._listed_paths}
+        self._changed_flag = True
+
+    # The source file is compared with the one recorded by the last sync through its size and its modification time,
+    # which change when a song is retagged or ripped again
+    def get_state(self, file_path_dest, size, mtime_ns, output_format=None, output_bitrate=None):
+        relative_path = self._get_relative_path(file_path_dest)
+        entry = self._entries.get(relative_path)
+        if entry is not None:
+            if entry.size == size and entry.mtime_ns == mtime_ns and entry.format == output_format and entry.bitrate == output_bitrate:
+                return SYNCED_STATE
+            return CHANGED_STATE
+        if self._listed_paths is not None and relative_path in self._listed_paths:
+            return SYNCED_STATE
+        return UNKNOWN_STATE
+
+    def add_entry(self, file_path_src, file_path_dest, output_format=None, output_bitrate=None):
+        stat_result = os.stat(file_path_src)
+        self._entries[self._get_relative_path(file_path_dest)] = ManifestEntry(os.path.abspath(file_path_src), stat_result.st_size, stat_result.st_mtime_ns, output_format, output_bitrate)
+        self._changed_flag = True
+
+    # Files found by the listing of the destination don't have an entry until the Controller meets their source file
+    def add_entry_if_missing(self, file_path_src, file_path_dest, output_format=None, output_bitrate=None):
+        if self._get_relative_path(file_path_dest) not in self._entries:
+            self.add_entry(file_path_src, file_path_dest, output_format, output_bitrate)
+
+    def remove_entry(self, file_path_dest):
+        if self._entries.pop(self._get_relative_path(file_path_dest), None) is not None:
+            self._changed_flag = True
+
+    def save(self):
+        if not self._changed_flag:
+            return
+        data = json.dumps({"version": MANIFEST_VERSION, "files": {path: entry.to_dict() for path, entry in self._entries.items()}}, ensure_ascii=False)
+        self._file_copier.write_file(data.encode("utf-8"), os.path.join(self._dest, MANIFEST_FILENAME))
+        self._changed_flag = False
+
+    def _get_relative_path(self, file_path_dest):
+        # Destination paths are compared in the Unix format because ADB listings always use it
+        return posixpath.relpath(file_path_dest.replace("\\", "/"), self._dest.replace("\\", "/"))
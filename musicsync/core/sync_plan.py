@@ -0,0 +1,123 @@
+import os
+import json
+
+COPY_ACTION = "copy"
+CONVERT_ACTION = "convert"
+SKIP_ACTION = "skip"
+DELETE_ACTION = "delete" # Used by the mirror mode for the destination files that the source doesn't produce anymore
+ACTIONS = (COPY_ACTION, CONVERT_ACTION, SKIP_ACTION, DELETE_ACTION)
+
+
+# The roots of the files of a plan, shared by its items. The items of the songs keep only their path relative to the
+# roots, and their absolute paths are joined when they are used.
+class PlanRoots():
+    __slots__ = ("src", "dest", "output_extension")
+
+    def __init__(self, src, dest, output_extension=None):
+        self.src = src
+        self.dest = dest
+        self.output_extension = output_extension # Extension of the destination files, if they are converted
+
+    def get_path_src(self, relative_path):
+        return os.path.join(self.src, relative_path)
+
+    def get_path_dest(self, relative_path):
+        path_dest = os.path.join(self.dest, relative_path)
+        if self.output_extension is not None:
+            return os.path.splitext(path_dest)[0] + self.output_extension
+        return path_dest
+
+
+# The plan of a large library has millions of items, so they are slotted to make them smaller, and their paths, which
+# take most of their memory, are relative to the roots when they have them
+class PlanItem():
+    __slots__ = ("action", "_path_src", "_path_dest", "_roots", "size", "estimated_size", "estimated_transcode_seconds", "song_flag", "update_flag")
+
+    # With roots, path_src is relative to them and path_dest is None, because it is derived from path_src
+    def __init__(self, action, path_src, path_dest, size, estimated_size=None, estimated_transcode_seconds=0.0, song_flag=True, update_flag=False, roots=None):
+        self.action = action
+        self._path_src = path_src
+        self._path_dest = path_dest
+        self._roots = roots
+        self.size = size
+        self.estimated_size = estimated_size if estimated_size is not None else size # Size of the file in the destination
+        self.estimated_transcode_seconds = estimated_transcode_seconds
+        self.song_flag = song_flag # False for the related files, like lyrics
+        self.update_flag = update_flag # True if the file replaces an outdated one in the destination
+
+    @property
+    def path_src(self):
+        if self._roots is None:
+            return self._path_src
+        return self._roots.get_path_src(self._path_src)
+
+    @property
+    def path_dest(self):
+        if self._roots is None:
+            return self._path_dest
+        return self._roots.get_path_dest(self._path_src)
+
+    def to_dict(self):
+        return {
+            "action": self.action,
+            "src": self.path_src,
+            "dest": self.path_dest,
+            "size": self.size,
+            "estimated_size": self.estimated_size,
+            "estimated_transcode_seconds": self.estimated_transcode_seconds,
+            "song": self.song_flag,
+            "update": self.update_flag,
+        }
+
+    @staticmethod
+    def from_dict(plan_item_dict):
+        return PlanItem(plan_item_dict["action"], plan_item_dict["src"], plan_item_dict["dest"], plan_item_dict["size"], plan_item_dict["estimated_size"],
+            plan_item_dict["estimated_transcode_seconds"], plan_item_dict["song"], plan_item_dict["update"])
+
+
+# It contains everything a sync is going to do, computed before touching the destination
+class SyncPlan():
+    def __init__(self):
+        self.items = []
+
+    def add_item(self, plan_item):
+        self.items.append(plan_item)
+
+    def get_items(self, action):
+        return [plan_item for plan_item in self.items if plan_item.action == action]
+
+    def get_work_items(self):
+        return [plan_item for plan_item in self.items if plan_item.action != SKIP_ACTION]
+
+    def get_songs_count(self, action):
+        return sum(1 for plan_item in self.items if plan_item.action == action and plan_item.song_flag)
+
+    # The updated songs are also counted by get_songs_count, as songs to copy or to convert
+    def get_updated_songs_count(self):
+        return sum(1 for plan_item in self.items if plan_item.update_flag and plan_item.song_flag)
+
+    def get_estimated_bytes(self):
+        return sum(plan_item.estimated_size for plan_item in self.get_work_items())
+
+    def get_estimated_transcode_seconds(self):
+        return sum(plan_item.estimated_transcode_seconds for plan_item in self.items)
+
+    def get_summary(self):
+        return "Songs to copy: {}, songs to convert: {}, songs to update: {}, songs to skip: {}, files to delete: {}, estimated bytes: {}, estimated transcoding time: {:.0f} s".format(
+            self.get_songs_count(COPY_ACTION), self.get_songs_count(CONVERT_ACTION), self.get_updated_songs_count(), self.get_songs_count(SKIP_ACTION),
+            len(self.get_items(DELETE_ACTION)), self.get_estimated_bytes(), self.get_estimated_transcode_seconds())
+
+    def to_dict(self):
+        return {
+            "items": [plan_item.to_dict() for plan_item in self.items],
+            "estimated_bytes": self.get_estimated_bytes(),
+            "estimated_transcode_seconds": self.get_estimated_transcode_seconds(),
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, ensure_ascii=False)
+
+
+# The plans of a sync to several destinations are written together, indexed by destination
+def get_plans_json(dests, plans):
+    return json.dumps({dest: plan.to_dict() for dest, plan in zip(dests, plans)}, indent=2, ensure_ascii=False)
@@ -0,0 +1,65 @@
+import time
+
+PLANNING_STAGE = "planning"
+DELETING_STAGE = "deleting"
+TRANSFERRING_STAGE = "transferring"
+FINISHING_STAGE = "finishing" # The journal and the sync manifest are saved
+DEFAULT_PROGRESS_INTERVAL = 0.25 # Minimum seconds between two calls of the progress listener
+
+
+# A snapshot of the progress of a sync, it isn't modified by the controller after it has been created
+class SyncProgress():
+    def __init__(self, stage, planned_items_count, done_items_count, planned_bytes, done_bytes, elapsed_seconds, done_paths=()):
+        self.stage = stage
+        self.planned_items_count = planned_items_count
+        self.done_items_count = done_items_count
+        self.planned_bytes = planned_bytes # Estimated, the size of the converted songs is known only after the conversion
+        self.done_bytes = done_bytes
+        self.elapsed_seconds = elapsed_seconds
+        self.done_paths = done_paths # Destination paths of the files completed since the previous snapshot sent to the listener
+
+    def get_bytes_per_second(self):
+        if self.elapsed_seconds <= 0:
+            return 0.0
+        return self.done_bytes / self.elapsed_seconds
+
+    # It returns None until the ETA can be estimated
+    def get_eta_seconds(self):
+        if self.done_bytes == 0:
+            return None
+        return self.elapsed_seconds * max(self.planned_bytes - self.done_bytes, 0) / self.done_bytes
+
+    def to_dict(self):
+        return {
+            "stage": self.stage,
+            "planned_items": self.planned_items_count,
+            "done_items": self.done_items_count,
+            "planned_bytes": self.planned_bytes,
+            "done_bytes": self.done_bytes,
+            "elapsed_seconds": self.elapsed_seconds,
+            "bytes_per_second": self.get_bytes_per_second(),
+            "eta_seconds": self.get_eta_seconds(),
+        }
+
+
+# The controller updates the progress for every file, while a GUI can't redraw itself so often. The updates are
+# coalesced, and the listener receives the last snapshot at most once every interval, together with all the paths
+# completed since its previous call. The listener is called by the thread that runs the sync, so it must only pass the
+# snapshot to its own thread (e.g. through a Qt signal).
+class ProgressThrottle():
+    def __init__(self, listener, interval=DEFAULT_PROGRESS_INTERVAL):
+        self._listener = listener
+        self._interval = interval
+        self._done_paths = []
+        self._last_call_time = None
+
+    # The snapshot is created by get_progress only when the listener is called
+    def update(self, get_progress, done_path=None, force_flag=False):
+        if done_path is not None:
+            self._done_paths.append(done_path)
+        now = time.monotonic()
+        if not force_flag and self._last_call_time is not None and now - self._last_call_time < self._interval:
+            return
+        self._last_call_time = now
+        done_paths, self._done_paths = tuple(self._done_paths), []
+        self._listener(get_progress(done_paths))
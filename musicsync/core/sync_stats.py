@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+SCAN_STAGE = "scan"
+METADATA_STAGE = "metadata"
+FILTER_STAGE = "filter"
+CONVERT_STAGE = "convert"
+EXISTS_STAGE = "exists"
+MKDIR_STAGE = "mkdir"
+TRANSFER_STAGE = "transfer"
+STAGES = (SCAN_STAGE, METADATA_STAGE, FILTER_STAGE, CONVERT_STAGE, EXISTS_STAGE, MKDIR_STAGE, TRANSFER_STAGE)
+STAGES_NAMES = {EXISTS_STAGE: "existence check"}
+PROMETHEUS_PREFIX = "musicsync_"
+
+
+# It measures the time spent in every stage of a sync, the number of operations and the bytes of every stage. The
+# stages can be measured by several threads at the same time, and a stage measured inside another one in the same
+# thread (e.g. a conversion made while the file is transferred) is subtracted from the outer one.
+class SyncStats():
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.counts = dict.fromkeys(STAGES, 0)
+        self.bytes = dict.fromkeys(STAGES, 0)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start_time = time.monotonic()
+        self._end_time = None
+
+    @contextlib.contextmanager
+    def measure(self, stage, count=1):
+        measurements = self._get_measurements()
+        measurement = [time.perf_counter(), 0.0] # Start time, time of the nested measurements
+        measurements.append(measurement)
+        try:
+            yield
+        finally:
+            measurements.pop()
+            elapsed_seconds = time.perf_counter() - measurement[0]
+            if measurements:
+                measurements[-1][1] += elapsed_seconds
+            self.add(stage, elapsed_seconds - measurement[1], count)
+
+    def _get_measurements(self):
+        if not hasattr(self._local, "measurements"):
+            self._local.measurements = []
+        return self._local.measurements
+
+    # It is used directly when the time isn't measured by measure, e.g. by the asyncio tasks
+    def add(self, stage, seconds=0.0, count=0, bytes_count=0):
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.counts[stage] += count
+            self.bytes[stage] += bytes_count
+
+    def stop(self):
+        self._end_time = time.monotonic()
+
+    def get_total_seconds(self):
+        end_time = self._end_time if self._end_time is not None else time.monotonic()
+        return end_time - self._start_time
+
+    def get_summary(self):
+        stages_texts = []
+        for stage in STAGES:
+            stage_text = "{} {:.2f} s ({}".format(STAGES_NAMES.get(stage, stage), self.seconds[stage], self.counts[stage])
+            if self.bytes[stage] > 0:
+                stage_text += ", {:.1f} MiB".format(self.bytes[stage] / 1024 ** 2)
+            stages_texts.append(stage_text + ")")
+        return "Stages: {}, total {:.2f} s.".format(", ".join(stages_texts), self.get_total_seconds())
+
+    def to_dict(self):
+        return {
+            "total_seconds": self.get_total_seconds(),
+            "stages": {stage: {"seconds": self.seconds[stage], "count": self.counts[stage], "bytes": self.bytes[stage]} for stage in STAGES},
+        }
+
+
+# Every sync appends a line, so the file keeps the history of the syncs
+def append_json_line(path, sync_stats, extra_fields={}):
+    record = {"time": time.time()}
+    record.update(extra_fields)
+    record.update(sync_stats.to_dict())
+    with open(path, "a", encoding="utf-8") as json_lines_file:
+        json_lines_file.write(json.dumps(record) + "\n")
+
+# The file is written in the text format read by the textfile collector of the Prometheus node exporter, which could
+# read it at any time, so it is replaced atomically
+def write_prometheus_textfile(path, sync_stats, extra_gauges={}):
+    lines = [
+        "# HELP {}stage_seconds Time spent in every stage of the last sync.".format(PROMETHEUS_PREFIX),
+        "# TYPE {}stage_seconds gauge".format(PROMETHEUS_PREFIX),
+    ]
+    lines += ['{}stage_seconds{{stage="{}"}} {}'.format(PROMETHEUS_PREFIX, stage, sync_stats.seconds[stage]) for stage in STAGES]
+    lines += [
+        "# HELP {}stage_operations Operations made by every stage of the last sync.".format(PROMETHEUS_PREFIX),
+        "# TYPE {}stage_operations gauge".format(PROMETHEUS_PREFIX),
+    ]
+    lines += ['{}stage_operations{{stage="{}"}} {}'.format(PROMETHEUS_PREFIX, stage, sync_stats.counts[stage]) for stage in STAGES]
+    lines += [
+        "# HELP {}stage_bytes Bytes processed by every stage of the last sync.".format(PROMETHEUS_PREFIX),
+        "# TYPE {}stage_bytes gauge".format(PROMETHEUS_PREFIX),
+    ]
+    lines += ['{}stage_bytes{{stage="{}"}} {}'.format(PROMETHEUS_PREFIX, stage, sync_stats.bytes[stage]) for stage in STAGES]
+    gauges = {"sync_seconds": sync_stats.get_total_seconds(), "sync_end_time_seconds": time.time()}
+    gauges.update(extra_gauges)
+    for name, value in gauges.items():
+        lines += ["# TYPE {}{} gauge".format(PROMETHEUS_PREFIX, name), "{}{} {}".format(PROMETHEUS_PREFIX, name, value)]
+    partial_path = path + ".tmp"
+    with open(partial_path, "w", encoding="utf-8") as textfile:
+        textfile.write("\n".join(lines) + "\n")
+    os.replace(partial_path, path)
+
+
+# The conversion functions are called by the file copiers, so they are wrapped to measure the conversions. The
+# transcode cache converts the song when the copier asks for its source file, while the streamed conversions are
+# measured as transfers.
+class MeasuredCopyFileFunction():
+    def __init__(self, copy_file_function, sync_stats, stage):
+        self._copy_file_function = copy_file_function
+        self._sync_stats = sync_stats
+        self._stage = stage
+
+    def __call__(self, dest_file_path):
+        with self._sync_stats.measure(self._stage):
+            self._copy_file_function(dest_file_path)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._copy_file_function, name)
+        if name == "get_src_file_path":
+            return self._get_measured_function(attribute)
+        return attribute
+
+    def _get_measured_function(self, function):
+        def measured_function(*args):
+            with self._sync_stats.measure(self._stage):
+                return function(*args)
+        return measured_function
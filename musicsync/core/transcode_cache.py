@@ -0,0 +1,136 @@
+import os
+import shutil
+import hashlib
+import threading
+import contextlib
+
+import musicsync.core.format_conversion as format_conversion
+import musicsync.core.sync_stats as sync_stats
+from musicsync.core.metadata_index import get_default_cache_dir_path
+
+DEFAULT_CACHE_DIR_PATH = os.path.join(get_default_cache_dir_path(), "transcodes")
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3 # Bytes
+EVICTION_TARGET_RATIO = 0.9 # The eviction frees some more space than necessary not to run after every conversion
+TEMPORARY_FILE_SUFFIX = ".part"
+
+
+# It stores the converted songs indexed by source file identity and encoder settings, so the same song converted with
+# the same settings for another destination is only copied. The least recently used songs are removed when the size
+# of the cache exceeds max_size, but only by evict, which the controllers call at the end of the sync: until then the
+# copiers can read the cached songs, see CachedConvertSongFunction.get_src_file_path.
+class TranscodeCache():
+    sync_stats = None # SyncStats of the running sync, set by the controller
+
+    def __init__(self, dir_path=DEFAULT_CACHE_DIR_PATH, max_size=DEFAULT_MAX_SIZE):
+        self._dir_path = dir_path
+        self._max_size = max_size
+        self._size = None
+        self._lock = threading.Lock() # Conversions can run in parallel threads
+        self._songs_locks = {} # Cached file path -> [lock held while the song is converted, threads using the lock]
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+    def get_convert_song_function(self, input_filename, format, bitrate=None):
+        return CachedConvertSongFunction(self, input_filename, format, bitrate)
+
+    def convert_song(self, input_filename, output_filename, format, bitrate=None):
+        shutil.copyfile(self.get_converted_song(input_filename, format, bitrate), output_filename)
+
+    # It returns the path of the converted song in the cache, converting it if it isn't cached yet. The threads that
+    # ask for a song while it is being converted wait for that conversion instead of starting another one.
+    def get_converted_song(self, input_filename, format, bitrate=None):
+        cached_file_path = self._get_cached_file_path(input_filename, format, bitrate)
+        self._acquire_song_lock(cached_file_path)
+        try:
+            if os.path.isfile(cached_file_path):
+                os.utime(cached_file_path) # The modification time is used as last access time
+            else:
+                self._add_song(input_filename, cached_file_path, format, bitrate)
+        finally:
+            self._release_song_lock(cached_file_path)
+        return cached_file_path
+
+    # The lock of a song exists only while some threads use it
+    def _acquire_song_lock(self, cached_file_path):
+        with self._lock:
+            song_lock = self._songs_locks.setdefault(cached_file_path, [threading.Lock(), 0])
+            song_lock[1] += 1
+        song_lock[0].acquire()
+
+    def _release_song_lock(self, cached_file_path):
+        with self._lock:
+            song_lock = self._songs_locks[cached_file_path]
+            song_lock[0].release()
+            song_lock[1] -= 1
+            if song_lock[1] == 0:
+                del self._songs_locks[cached_file_path]
+
+    def _get_cached_file_path(self, input_filename, format, bitrate):
+        stat_result = os.stat(input_filename)
+        key = "\0".join((os.path.abspath(input_filename), str(stat_result.st_size), str(stat_result.st_mtime_ns), format, str(bitrate)))
+        return os.path.join(self._dir_path, hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest() + "." + format)
+
+    def _add_song(self, input_filename, cached_file_path, format, bitrate):
+        temporary_file_path = "{}.{}{}".format(cached_file_path, threading.get_ident(), TEMPORARY_FILE_SUFFIX)
+        try:
+            with self._measure_conversion(): # The time waited by the other threads for the same song isn't a conversion
+                format_conversion.convert_song(input_filename, temporary_file_path, format, bitrate)
+            os.replace(temporary_file_path, cached_file_path)
+        finally:
+            if os.path.isfile(temporary_file_path):
+                os.unlink(temporary_file_path)
+        with self._lock:
+            self._update_size(os.path.getsize(cached_file_path))
+
+    def _measure_conversion(self):
+        if self.sync_stats is None:
+            return contextlib.nullcontext()
+        return self.sync_stats.measure(sync_stats.CONVERT_STAGE)
+
+    def _update_size(self, added_size):
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._list_cached_files())
+        else:
+            self._size += added_size
+
+    # It removes the least recently used songs if the cache is too big, no copier must be reading the cached songs
+    def evict(self):
+        with self._lock:
+            self._update_size(0)
+            if self._size > self._max_size:
+                self._evict_least_recently_used_songs()
+
+    def _evict_least_recently_used_songs(self):
+        target_size = self._max_size * EVICTION_TARGET_RATIO
+        for file_path, size, _ in sorted(self._list_cached_files(), key=lambda cached_file: cached_file[2]):
+            if self._size <= target_size:
+                break
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    def _list_cached_files(self):
+        cached_files = []
+        with os.scandir(self._dir_path) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith(TEMPORARY_FILE_SUFFIX):
+                    stat_result = entry.stat()
+                    cached_files.append((entry.path, stat_result.st_size, stat_result.st_mtime_ns))
+        return cached_files
+
+
+class CachedConvertSongFunction():
+    def __init__(self, transcode_cache, input_filename, format, bitrate=None):
+        self._transcode_cache = transcode_cache
+        self.input_filename = input_filename
+        self.format = format
+        self.bitrate = bitrate
+
+    def __call__(self, output_filename):
+        self._transcode_cache.convert_song(self.input_filename, output_filename, self.format, self.bitrate)
+
+    # The copiers can read the converted song directly from the cache, where it stays until the end of the sync
+    def get_src_file_path(self):
+        return self._transcode_cache.get_converted_song(self.input_filename, self.format, self.bitrate)
@@ -1,25 +1,38 @@
 import os
+import time
 import threading
 from PySide2.QtWidgets import QFileDialog, QMessageBox
 from PySide2.QtUiTools import QUiLoader
 from PySide2.QtCore import QObject, Slot, Signal, QDir
 from PySide2.QtGui import QIcon, QCloseEvent
 
-from musicsync.core.controller import Controller, MusicSyncError
-from musicsync.core.file_copiers import ADBFileCopier, MSCFileCopier
+import musicsync.core.sync_progress as sync_progress
+from musicsync.core.controller import MusicSyncError
+from musicsync.core.file_copiers import MSCFileCopier
 from musicsync.core.filters import RatingFilter, YearFilter, GenreFilter, ArtistFilter
 
 ITEMS_SEPARATOR = ", " # Make sure to modify item separators tips in GUI after changing this value
+PROGRESS_BAR_MAXIMUM = 1000 # Make sure to modify the maximum of the progress bar in the ui file after changing this value
+STAGES_TEXTS = {
+    sync_progress.PLANNING_STAGE: "Planning",
+    sync_progress.DELETING_STAGE: "Deleting",
+    sync_progress.TRANSFERRING_STAGE: "Syncing",
+    sync_progress.FINISHING_STAGE: "Finishing",
+}
 
 # It wraps the window defined in the ui file
 class MainWindow(QObject):
-    show_summary_signal = Signal(int, int)
+    show_summary_signal = Signal(int, int, int, int)
     show_copy_failed_signal = Signal(str)
+    show_progress_signal = Signal(object) # The controller emits it at most a few times per second, see ProgressThrottle
+    copy_ended_signal = Signal()
 
     def __init__(self):
         super(MainWindow, self).__init__()
         self.copying_flag = False
         self.window_closed = False # It is used to stop sync process by the controller if the main window has been closed
+        self.cancelled_flag = False
+        self._controller = None
         self._load_ui()
         self._setup_window_icon()
         self._setup_actions()
@@ -37,8 +50,11 @@ class MainWindow(QObject):
         self.window.srcBrowseButton.clicked.connect(self.browse_src_dirs)
         self.window.destBrowseButton.clicked.connect(self.browse_dest_dirs)
         self.window.syncButton.clicked.connect(self.sync)
+        self.window.cancelButton.clicked.connect(self.cancel)
         self.show_summary_signal.connect(self.show_summary)
         self.show_copy_failed_signal.connect(self.show_copy_failed)
+        self.show_progress_signal.connect(self.show_progress)
+        self.copy_ended_signal.connect(self.reset_progress)
         self.window.transferProtocolBox.currentTextChanged.connect(self.update_srcline)
         self.window.artistsCheckBox.clicked.connect(self.update_artistsline)
         self.window.genresCheckBox.clicked.connect(self.update_genresline)
@@ -84,7 +100,8 @@ class MainWindow(QObject):
         if transfer_protocol_box_index == 0:
             return MSCFileCopier()
         elif transfer_protocol_box_index == 1:
-            return ADBFileCopier()
+            from musicsync.core.adb_file_copiers import BatchADBFileCopier # The ADB copiers are imported only by the syncs that use them
+            return BatchADBFileCopier()
         assert False, "Trasfer protocol not selected."
 
     def _get_filters(self):
@@ -147,6 +164,9 @@ class MainWindow(QObject):
         return QMessageBox.StandardButton.Yes == answer
 
     def _start_copy_process(self, file_copier, filters, src, dest, output_format, output_bitrate):
+        self.cancelled_flag = False
+        self.window.cancelButton.setEnabled(True)
+        self.window.progressBar.setValue(0)
         thread = threading.Thread(target=self._manage_copy, args=(file_copier, filters, src, dest, output_format, output_bitrate))
         thread.start()
 
@@ -154,15 +174,53 @@ class MainWindow(QObject):
         self.copying_flag = True
         self.window.statusbar.showMessage("Syncing songs...")
         try:
-            controller = Controller(file_copier, filters, output_format, output_bitrate)
-            songs_counts = controller.sync(src, dest, lambda: not self.window_closed)
-            copied_songs_count, no_inspectable_songs_count = songs_counts
-            self.show_summary_signal.emit(copied_songs_count, no_inspectable_songs_count)
+            from musicsync.core.async_controller import AsyncController # asyncio is imported by the first sync, not when the window opens
+            controller = AsyncController(file_copier, filters, output_format, output_bitrate) # Closing the window stops the running conversions at once
+            controller.set_progress_listener(self.show_progress_signal.emit)
+            self._controller = controller
+            songs_counts = controller.sync(src, dest, lambda: not (self.window_closed or self.cancelled_flag))
+            copied_songs_count, updated_songs_count, unchanged_songs_count, no_inspectable_songs_count = songs_counts
+            self.show_summary_signal.emit(copied_songs_count, updated_songs_count, unchanged_songs_count, no_inspectable_songs_count)
         except MusicSyncError as exc:
             self.show_copy_failed_signal.emit(str(exc))
         finally:
+            self._controller = None
             self.window.statusbar.showMessage("")
             self.copying_flag = False
+            self.copy_ended_signal.emit()
+
+    # The running conversions and transfers are stopped by the controller, the songs already copied are kept
+    @Slot()
+    def cancel(self):
+        controller = self._controller
+        if controller is None:
+            return
+        answer = QMessageBox.question(self.window, "Stop confirmation", "Do you want to stop the copy process?")
+        if QMessageBox.StandardButton.Yes != answer:
+            return
+        self.cancelled_flag = True
+        controller.cancel()
+        self.window.cancelButton.setEnabled(False)
+        self.window.progressLabel.setText("Stopping...")
+
+    @Slot(object)
+    def show_progress(self, progress):
+        if self.cancelled_flag:
+            return
+        if progress.planned_bytes > 0:
+            self.window.progressBar.setValue(min(PROGRESS_BAR_MAXIMUM, int(PROGRESS_BAR_MAXIMUM * progress.done_bytes / progress.planned_bytes)))
+        eta_seconds = progress.get_eta_seconds()
+        eta_text = time.strftime("%H:%M:%S", time.gmtime(eta_seconds)) if eta_seconds is not None else "--:--:--"
+        self.window.progressLabel.setText("{}: {}/{} files, {:.1f}/{:.1f} MiB, {:.1f} MiB/s, ETA {}".format(STAGES_TEXTS.get(progress.stage, "Syncing"), progress.done_items_count, progress.planned_items_count,
+            progress.done_bytes / 1024 ** 2, progress.planned_bytes / 1024 ** 2, progress.get_bytes_per_second() / 1024 ** 2, eta_text))
+        if progress.done_paths:
+            self.window.statusbar.showMessage(progress.done_paths[-1]) # The last file of the batch is enough to show that the sync is going on
+
+    @Slot()
+    def reset_progress(self):
+        self.window.cancelButton.setEnabled(False)
+        self.window.progressBar.setValue(0)
+        self.window.progressLabel.setText("")
 
     def eventFilter(self, target, event):
         if self.copying_flag and isinstance(event, QCloseEvent):
@@ -178,9 +236,9 @@ class MainWindow(QObject):
             event.ignore()
             return True
 
-    @Slot(int, int)
-    def show_summary(self, copied_songs_count, no_inspectable_songs_count):
-        QMessageBox.information(self.window, "Summary", f"Copied songs: {copied_songs_count}\nNo inspectable songs: {no_inspectable_songs_count}")
+    @Slot(int, int, int, int)
+    def show_summary(self, copied_songs_count, updated_songs_count, unchanged_songs_count, no_inspectable_songs_count):
+        QMessageBox.information(self.window, "Summary", f"Copied songs: {copied_songs_count}\nUpdated songs: {updated_songs_count}\nUnchanged songs: {unchanged_songs_count}\nNo inspectable songs: {no_inspectable_songs_count}")
 
     @Slot(str)
     def show_copy_failed(self, message):
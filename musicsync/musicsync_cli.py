@@ -1,41 +1,73 @@
 import sys
 import argparse
 
-from musicsync.core.file_copiers import MSCFileCopier, ADBFileCopier
-from musicsync.core.filters import RatingFilter, YearFilter, GenreFilter, ArtistFilter
-from musicsync.core.controller import ControllerLogProxy, MusicSyncError
+from musicsync.core.file_copiers import MSCFileCopier, ParallelMSCFileCopier
+from musicsync.core.filters import RatingFilter, YearFilter, GenreFilter, ArtistFilter, QueryFilter
+from musicsync.core.controller import ControllerLogProxy, MusicSyncError, DEFAULT_MAX_DELETIONS
+from musicsync.core.metadata_index import MetadataIndex, DEFAULT_INDEX_PATH
+from musicsync.core.transcode_cache import TranscodeCache, DEFAULT_CACHE_DIR_PATH
+from musicsync.core.sync_journal import SyncJournal, DEFAULT_JOURNAL_DIR_PATH
+from musicsync.core.sync_stats import append_json_line, write_prometheus_textfile
+from musicsync.core.sync_plan import get_plans_json
+from musicsync.core.conversion_policy import ConversionPolicy
+from musicsync.core.scanner import DEFAULT_SCAN_THREADS
 
 MIN_RATING_VALUE = 0
 MAX_RATING_VALUE = 5
+DEFAULT_TRANSCODE_CACHE_SIZE = 10240 # MiB
+MSC_PROTOCOL = "msc"
+ADB_PROTOCOL = "adb"
 
 def main():
     parser = _setup_parser()
     args = parser.parse_args()
     try:
         _validate_args(args)
+        destinations = _setup_destinations(args)
+        filters = _setup_filters(args) # The filter query is parsed here, so its syntax errors are reported like the other arguments errors
     except ValueError as exc:
         parser.error(str(exc))
         sys.exit(1)
-    file_copier = _setup_file_copier(args)
-    filters = _setup_filters(args)
+    file_copiers = [_setup_file_copier(args, protocol, serial) for protocol, serial, _ in destinations]
+    dests = [dest for _, _, dest in destinations]
     output_format, output_bitrate = _setup_format_conversion(args)
-    controller = ControllerLogProxy(file_copier, filters, output_format, output_bitrate, args.log)
+    metadata_index = _setup_metadata_index(args)
+    transcode_cache = _setup_transcode_cache(args)
+    sync_journal = _setup_sync_journal(args)
+    conversion_policy = _setup_conversion_policy(args, output_format, output_bitrate)
+    controller = _setup_controller(args, file_copiers, filters, output_format, output_bitrate, metadata_index, transcode_cache, sync_journal, conversion_policy)
     try:
-        controller.sync(args.src, args.dest)
+        sync_plans = _run_controller(args, controller, dests)
+        if args.dry_run:
+            _print_sync_plans(dests, sync_plans)
+        if args.plan_output is not None:
+            _write_sync_plans(dests, sync_plans, args.plan_output)
+        _write_sync_stats(args, controller, dests)
     except MusicSyncError as exc:
         sys.exit(2)
+    finally:
+        if metadata_index is not None:
+            metadata_index.close()
 
 def _setup_parser():
     parser = argparse.ArgumentParser(description="Sync music library between devices and folders")
     parser.add_argument("src", metavar="<source>", type=str, help="music library source directory")
-    parser.add_argument("dest", metavar="<destination>", type=str, help="music library destination directory")
-    transfer_protocol_group = parser.add_argument_group("transfer protocol")
-    transfer_protocol_mutually_exclusive_group = transfer_protocol_group.add_mutually_exclusive_group(required=True)
+    parser.add_argument("dest", metavar="<destination>", type=str, nargs="+", help="music library destination directory, or several ones synced together: "
+        f"a destination can select its own transfer protocol with the {MSC_PROTOCOL}:<path>, {ADB_PROTOCOL}:<path> and {ADB_PROTOCOL}@<device serial>:<path> prefixes")
+    transfer_protocol_group = parser.add_argument_group("transfer protocol", "used by the destinations without a transfer protocol prefix")
+    transfer_protocol_mutually_exclusive_group = transfer_protocol_group.add_mutually_exclusive_group()
     transfer_protocol_mutually_exclusive_group.add_argument("-m", "--msc", action='store_true', dest="msc", help="Mass Storage Class (MSC)")
     transfer_protocol_mutually_exclusive_group.add_argument("-a", "--adb", action='store_true', dest="adb", help="Android Debug Bridge (ADB)")
+    transfer_protocol_group.add_argument("-p", "--copy-threads", metavar="<arg>", action="store", dest="copy_threads", type=int, default=1, help="number of files copied at the same time with MSC (default: 1)")
+    transfer_protocol_group.add_argument("-T", "--tar", action="store_true", dest="tar", help="send the files to the ADB devices as tar streams, faster with many small files (adb push is used if the device has no tar)")
     format_conversion_group = parser.add_argument_group("format conversion", "set up songs output format and bitrate (every combination that ffmpeg supports)")
     format_conversion_group.add_argument("-f", "--output-format", metavar="<arg>", action="store", dest="output_format", type=str, help="audio format")
     format_conversion_group.add_argument("-b", "--output-bitrate", metavar="<arg>", action="store", dest="output_bitrate", type=str, help="audio format bitrate")
+    format_conversion_group.add_argument("-K", "--keep-codecs", metavar="<arg>", action="store", dest="keep_codecs", type=str, nargs="+", default=[], help="codec(s) of the songs copied without converting them, e.g. mp3")
+    format_conversion_group.add_argument("-C", "--always-convert", action="store_true", dest="always_convert", help="convert also the songs whose bitrate is not greater than the output bitrate, which are copied by default")
+    format_conversion_group.add_argument("-j", "--jobs", metavar="<arg>", action="store", dest="jobs", type=int, default=1, help="number of songs converted at the same time (default: 1)")
+    format_conversion_group.add_argument("-c", "--transcode-cache", metavar="<arg>", action="store", dest="transcode_cache", type=str, nargs="?", const=DEFAULT_CACHE_DIR_PATH, help=f"reuse the songs already converted with the same settings stored in a cache directory (default: {DEFAULT_CACHE_DIR_PATH})")
+    format_conversion_group.add_argument("-s", "--transcode-cache-size", metavar="<arg>", action="store", dest="transcode_cache_size", type=int, default=DEFAULT_TRANSCODE_CACHE_SIZE, help=f"maximum size of the transcode cache in MiB (default: {DEFAULT_TRANSCODE_CACHE_SIZE})")
     rating_filters_group = parser.add_argument_group("rating filters", "set up minimum and/or maximum stars rating of the songs")
     rating_filters_group.add_argument("-r", "--min-rating", metavar="<arg>", action="store", dest="minimum_rating", type=float, help="minimum rating (0-5)")
     rating_filters_group.add_argument("-t", "--max-rating", metavar="<arg>", action="store", dest="maximum_rating", type=float, help="maximum rating (0-5)")
@@ -45,6 +77,23 @@ def _setup_parser():
     other_filters_group = parser.add_argument_group("other filters")
     other_filters_group.add_argument("-g", "--genres", metavar="<arg>", action="store", dest="genres", type=str, nargs="+", help="type(s) of music")
     other_filters_group.add_argument("-i", "--artists", metavar="<arg>", action="store", dest="artists", type=str, nargs="+", help="song artist(s)")
+    other_filters_group.add_argument("-q", "--query", metavar="<arg>", action="store", dest="query", type=str, help="filter query, e.g. '(rating >= 4 or genre ~ \"Jazz\") and year >= 1990'")
+    parser.add_argument("-w", "--scan-threads", metavar="<arg>", action="store", dest="scan_threads", type=int, default=DEFAULT_SCAN_THREADS, help=f"number of source directories listed at the same time (default: {DEFAULT_SCAN_THREADS})")
+    parser.add_argument("-x", "--metadata-index", metavar="<arg>", action="store", dest="metadata_index", type=str, nargs="?", const=DEFAULT_INDEX_PATH, help=f"reuse the songs metadata stored in an index file (default: {DEFAULT_INDEX_PATH})")
+    manifest_group = parser.add_argument_group("sync manifest", "keep track of the synced songs in a manifest file in the destination directory to avoid checking the destination song by song")
+    manifest_group.add_argument("-n", "--manifest", action="store_true", dest="manifest", help="use the sync manifest")
+    manifest_group.add_argument("-v", "--verify", action="store_true", dest="verify", help="rebuild the sync manifest from the files really present in the destination (implies --manifest)")
+    mirror_group = parser.add_argument_group("mirror", "delete the destination songs and lyrics that the source and the filters don't produce anymore")
+    mirror_group.add_argument("-e", "--mirror", action="store_true", dest="mirror", help="enable the mirror mode")
+    mirror_group.add_argument("-k", "--max-deletions", metavar="<arg>", action="store", dest="max_deletions", type=int, default=DEFAULT_MAX_DELETIONS, help=f"maximum number of deleted files, the sync is aborted if more files should be deleted (default: {DEFAULT_MAX_DELETIONS})")
+    parser.add_argument("-R", "--resume", metavar="<arg>", action="store", dest="journal", type=str, nargs="?", const=DEFAULT_JOURNAL_DIR_PATH, help=f"record the progress of the sync in a journal directory and resume the interrupted sync with the same source, destination and settings (default: {DEFAULT_JOURNAL_DIR_PATH})")
+    plan_group = parser.add_argument_group("sync plan", "compute which files are going to be copied, converted or skipped")
+    plan_group.add_argument("-d", "--dry-run", action="store_true", dest="dry_run", help="print the sync plan without modifying the destination")
+    plan_group.add_argument("-o", "--plan-output", metavar="<arg>", action="store", dest="plan_output", type=str, help="write the sync plan to a JSON file")
+    stats_group = parser.add_argument_group("stats", "export the time, the operations and the bytes of every sync stage (scan, metadata, filter, convert, existence check, mkdir, transfer)")
+    stats_group.add_argument("-J", "--stats-json", metavar="<arg>", action="store", dest="stats_json", type=str, help="append the stats of the sync to a JSON lines file")
+    stats_group.add_argument("-P", "--stats-prometheus", metavar="<arg>", action="store", dest="stats_prometheus", type=str, help="write the stats of the sync to a Prometheus textfile collector file (*.prom)")
+    parser.add_argument("-z", "--async", action="store_true", dest="async_engine", help="use the asyncio sync engine, which reads the tags, converts and copies the songs at the same time")
     parser.add_argument("-l", "--log", action="store_true", help="create a log file")
     return parser
 
@@ -54,6 +103,10 @@ def _validate_args(args):
     if args.maximum_rating is not None:
         _validate_rating(args.maximum_rating)
     _validate_format_conversion(args.output_format, args.output_bitrate)
+    _validate_jobs(args.jobs)
+    _validate_copy_threads(args.copy_threads)
+    _validate_scan_threads(args.scan_threads)
+    _validate_transcode_cache_size(args.transcode_cache_size)
 
 def _validate_rating(rating):
     if not _is_rating_valid(rating):
@@ -63,16 +116,72 @@ def _validate_format_conversion(output_format, output_bitrate):
     if output_bitrate is not None and output_format is None:
         raise ValueError("Output format required if output bitrate is selected.")
 
+def _validate_jobs(jobs):
+    if jobs < 1:
+        raise ValueError("The number of jobs must be at least 1.")
+
+def _validate_copy_threads(copy_threads):
+    if copy_threads < 1:
+        raise ValueError("The number of copy threads must be at least 1.")
+
+def _validate_scan_threads(scan_threads):
+    if scan_threads < 1:
+        raise ValueError("The number of scan threads must be at least 1.")
+
+def _validate_transcode_cache_size(transcode_cache_size):
+    if transcode_cache_size <= 0:
+        raise ValueError("The transcode cache size must be greater than 0.")
+
 def _is_rating_valid(rating):
     return rating >= MIN_RATING_VALUE and rating <= MAX_RATING_VALUE
 
-def _setup_file_copier(args):
-    if args.msc:
-        return MSCFileCopier()
-    elif args.adb:
-        return ADBFileCopier()
+# It returns the transfer protocol, the device serial (None if it isn't selected) and the path of every destination
+def _setup_destinations(args):
+    default_protocol = MSC_PROTOCOL if args.msc else ADB_PROTOCOL if args.adb else None
+    destinations = [_parse_destination(dest, default_protocol) for dest in args.dest]
+    if len(set(dest for _, _, dest in destinations)) != len(destinations):
+        raise ValueError("Every destination must be different.")
+    if len(destinations) > 1 and args.journal is not None:
+        raise ValueError("The sync can be resumed only with a single destination.")
+    if len(destinations) > 1 and args.async_engine:
+        raise ValueError("The asyncio engine can sync only a single destination.")
+    return destinations
+
+# The serial of the ADB destinations ends at the last colon, so it can contain the port of the network devices
+def _parse_destination(dest, default_protocol):
+    if dest.startswith(MSC_PROTOCOL + ":"):
+        return MSC_PROTOCOL, None, dest[len(MSC_PROTOCOL) + 1:]
+    if dest.startswith(ADB_PROTOCOL + ":"):
+        return ADB_PROTOCOL, None, dest[len(ADB_PROTOCOL) + 1:]
+    if dest.startswith(ADB_PROTOCOL + "@") and ":" in dest:
+        serial, _, path = dest[len(ADB_PROTOCOL) + 1:].rpartition(":")
+        return ADB_PROTOCOL, serial, path
+    if default_protocol is None:
+        raise ValueError(f"Transfer protocol required for the destination {dest}.")
+    return default_protocol, None, dest
+
+def _setup_file_copier(args, protocol, serial):
+    if protocol == MSC_PROTOCOL and args.async_engine:
+        return MSCFileCopier() # The asyncio engine runs --copy-threads transfers at the same time by itself
+    elif protocol == MSC_PROTOCOL:
+        return ParallelMSCFileCopier(args.copy_threads)
+    elif protocol == ADB_PROTOCOL:
+        import musicsync.core.adb_file_copiers as adb_file_copiers # The ADB copiers are imported only by the runs that use them
+        if args.tar:
+            return adb_file_copiers.TarADBFileCopier(serial=serial)
+        return adb_file_copiers.BatchADBFileCopier(serial=serial)
     assert False, "Trasfer protocol not selected."
 
+def _setup_controller(args, file_copiers, filters, output_format, output_bitrate, metadata_index, transcode_cache, sync_journal, conversion_policy):
+    if len(file_copiers) > 1:
+        from musicsync.core.fan_out_controller import FanOutControllerLogProxy
+        return FanOutControllerLogProxy(file_copiers, filters, output_format, output_bitrate, args.log, metadata_index, args.manifest, args.verify, args.jobs, transcode_cache, args.scan_threads, args.mirror, args.max_deletions, conversion_policy)
+    controller_args = (file_copiers[0], filters, output_format, output_bitrate, args.log, metadata_index, args.manifest, args.verify, args.jobs, transcode_cache, args.scan_threads, args.mirror, args.max_deletions, sync_journal, conversion_policy)
+    if args.async_engine:
+        from musicsync.core.async_controller import AsyncControllerLogProxy # asyncio is imported only by the runs that use it
+        return AsyncControllerLogProxy(*controller_args, transfer_jobs=args.copy_threads)
+    return ControllerLogProxy(*controller_args)
+
 def _setup_filters(args):
     filters = []
     rating_filter = _setup_rating_filter(args)
@@ -87,6 +196,8 @@ def _setup_filters(args):
     artist_filter = _setup_artist_filter(args)
     if artist_filter is not None:
         filters.append(artist_filter)
+    if args.query is not None:
+        filters.append(QueryFilter(args.query))
     return filters
 
 def _setup_rating_filter(args):
@@ -111,16 +222,67 @@ def _setup_year_filter(args):
 
 def _setup_genre_filter(args):
     if args.genres:
-        return args.genres
+        return GenreFilter(args.genres)
     return None
 
 def _setup_artist_filter(args):
     if args.artists:
-        return args.artists
+        return ArtistFilter(args.artists)
+    return None
+
+def _setup_metadata_index(args):
+    if args.metadata_index is not None:
+        return MetadataIndex(args.metadata_index)
+    return None
+
+def _setup_transcode_cache(args):
+    if args.transcode_cache is not None and args.output_format is not None:
+        return TranscodeCache(args.transcode_cache, args.transcode_cache_size * 1024 ** 2)
+    return None
+
+def _setup_sync_journal(args):
+    if args.journal is not None and not args.dry_run:
+        return SyncJournal(args.journal)
     return None
 
 def _setup_format_conversion(args):
     return args.output_format, args.output_bitrate
 
+def _setup_conversion_policy(args, output_format, output_bitrate):
+    return ConversionPolicy(output_format, output_bitrate, args.keep_codecs, not args.always_convert)
+
+# It returns the plans of the destinations, in the same order
+def _run_controller(args, controller, dests):
+    if len(dests) > 1 and args.dry_run:
+        return controller.plan(args.src, dests)
+    elif len(dests) > 1:
+        controller.sync(args.src, dests)
+        return controller.sync_plans
+    elif args.dry_run:
+        return [controller.plan(args.src, dests[0])]
+    controller.sync(args.src, dests[0])
+    return [controller.sync_plan]
+
+# The songs counts of several destinations are added together
+def _write_sync_stats(args, controller, dests):
+    songs_counts = {"copied_songs": controller.copied_songs_count, "updated_songs": controller.updated_songs_count, "unchanged_songs": controller.unchanged_songs_count, "deleted_files": controller.deleted_files_count}
+    if args.stats_json is not None:
+        append_json_line(args.stats_json, controller.sync_stats, dict(src=args.src, dest=dests[0] if len(dests) == 1 else dests, dry_run=args.dry_run, **songs_counts))
+    if args.stats_prometheus is not None:
+        write_prometheus_textfile(args.stats_prometheus, controller.sync_stats, songs_counts)
+
+def _print_sync_plans(dests, sync_plans):
+    for dest, sync_plan in zip(dests, sync_plans):
+        if len(dests) > 1:
+            print(f"{dest}:")
+        for plan_item in sync_plan.get_work_items():
+            print(f"{plan_item.action}: {plan_item.path_src} -> {plan_item.path_dest}")
+        print(sync_plan.get_summary())
+
+# The plans of several destinations are written together, indexed by destination
+def _write_sync_plans(dests, sync_plans, path):
+    with open(path, "w", encoding="utf-8") as plan_file:
+        plan_file.write(sync_plans[0].to_json() if len(dests) == 1 else get_plans_json(dests, sync_plans))
+
 if __name__ == "__main__":
     main()
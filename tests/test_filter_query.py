@@ -0,0 +1,29 @@
+import unittest
+
+from musicsync.core.filter_query import compile_query, SongRecord
+from musicsync.core.songs_metadata import SongMetadata, intern_values
+
+
+# The tags with several values are interned tuples, as they are read by songs_metadata and the metadata index
+class FilterQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.record = SongRecord(SongMetadata("/library/Miles Davis/So What.mp3", 4, 1959, intern_values(["Jazz", "Modal"]), intern_values(["Miles Davis", "John Coltrane"])), 1000)
+
+    def test_tuple_tags_contain(self):
+        self.assertTrue(compile_query('genre ~ "jazz"')(self.record))
+        self.assertTrue(compile_query('artist ~ "coltrane"')(self.record))
+        self.assertFalse(compile_query('artist ~ "evans"')(self.record))
+
+    def test_tuple_tags_equal(self):
+        self.assertTrue(compile_query('genre == "Modal"')(self.record))
+        self.assertTrue(compile_query('artist == "miles davis" and year < 1960')(self.record))
+        self.assertFalse(compile_query('genre == "Rock"')(self.record))
+
+    def test_missing_tags(self):
+        record = SongRecord(SongMetadata("/library/Unknown.flac"), 1000)
+        self.assertFalse(compile_query('genre ~ "jazz"')(record))
+        self.assertTrue(compile_query('not genre ~ "jazz"')(record))
+
+
+if __name__ == "__main__":
+    unittest.main()